@@ -0,0 +1,59 @@
+import argparse
+import contextlib
+import os
+import time
+
+from conoha.command import (
+    CompositeCommand,
+    Context,
+    ListServer,
+    LoadToken,
+    MountImage,
+    StopServerAndWait,
+    WaitServerStatus,
+)
+from conoha.executor import ServerExecutor
+from conoha.simulator import SimulatedConohaRestApi
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--servers", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--page-size", type=int, default=500)
+    args = parser.parse_args()
+
+    api = SimulatedConohaRestApi(servers=args.servers, seed=0)
+    context = Context(
+        argparse.Namespace(user_id="u", password="p", tenant_id="t")
+    )
+    context.set("page_size", args.page_size)
+    context.set("image_id", "rescue-image")
+    command = CompositeCommand()
+    command.append(StopServerAndWait())
+    command.append(MountImage())
+    command.append(WaitServerStatus("RESCUE"))
+    executor = ServerExecutor(api, concurrency=args.concurrency)
+
+    failures = 0
+    start = time.perf_counter()
+    with open(os.devnull, "w") as devnull:
+        with contextlib.redirect_stdout(devnull):
+            LoadToken().execute(api, context)
+            ListServer().execute(api, context)
+            server_ids = context.get("server_ids")
+            for _, error in executor.execute(command, context, server_ids):
+                failures += error is not None
+    elapsed = time.perf_counter() - start
+
+    line = "{} servers mounted ({} failed): {} requests in {:.3f} s"
+    print(line.format(len(server_ids), failures, api.requests, elapsed))
+    print(
+        "{:.0f} requests/s, {:.0f} virtual seconds".format(
+            api.requests / elapsed, api.clock.latest()
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+
+# run through main() so that conoha.__main__ shows up in -X importtime
+COMMAND = [
+    "-c",
+    "from conoha.__main__ import main; main()",
+    "--pretend",
+    "1",
+    "server",
+    "status",
+    "--auth-token",
+    "x",
+    "--server-id",
+    "a",
+]
+
+
+def import_times(stderr):
+    # -X importtime lines: "import time: self | cumulative | name"
+    times = {}
+    for line in stderr.splitlines():
+        prefix, _, fields = line.partition(":")
+        if prefix != "import time":
+            continue
+        _, cumulative, name = fields.split("|")
+        if cumulative.strip().isdigit():
+            times[name.strip()] = int(cumulative) / 1000
+    return times
+
+
+def run(python):
+    start = time.perf_counter()
+    process = subprocess.run(
+        [python, "-X", "importtime"] + COMMAND,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return time.perf_counter() - start, import_times(process.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--budget", type=float, default=40.0, help="ms")
+    parser.add_argument("--python", default=sys.executable)
+    args = parser.parse_args()
+
+    run(args.python)
+    walls = []
+    imports = []
+    heaviest = {}
+    for _ in range(args.runs):
+        wall, times = run(args.python)
+        walls.append(wall * 1000)
+        imports.append(times.get("conoha.__main__", 0.0))
+        for name, cumulative in times.items():
+            heaviest[name] = max(heaviest.get(name, 0.0), cumulative)
+
+    wall = statistics.median(walls)
+    imported = statistics.median(imports)
+    print("wall    {:6.1f} ms (median of {})".format(wall, args.runs))
+    print("import  {:6.1f} ms conoha.__main__".format(imported))
+    for name in sorted(heaviest, key=heaviest.get, reverse=True)[1:11]:
+        print("        {:6.1f} ms {}".format(heaviest[name], name))
+    if imported > args.budget:
+        print(
+            "conoha.__main__ import exceeds budget {:.1f} ms".format(
+                args.budget
+            )
+        )
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+import argparse
+import contextlib
+import multiprocessing
+import os
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from conoha.command import Context, ListServer
+from conoha.conoha import ConohaRestApi
+from conoha.emulator import Emulator, EmulatorServer, service_values
+
+
+def serve(port, latencies):
+    emulator = Emulator(servers=100, latencies=latencies, seed=0)
+    server = EmulatorServer(("127.0.0.1", 0), emulator)
+    port.send(server.url)
+    server.serve_forever()
+
+
+def worker(api, context, count):
+    latencies = []
+    for _ in range(count):
+        start = time.perf_counter()
+        api.get_server_status(context)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--latency", action="append")
+    args = parser.parse_args()
+
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    server = multiprocessing.Process(
+        target=serve,
+        args=(sender, service_values(args.latency, float)),
+        daemon=True,
+    )
+    server.start()
+    url = receiver.recv()
+    endpoints = {"identity": url, "compute": url, "image": url}
+    api = ConohaRestApi(pool_size=args.threads, endpoints=endpoints)
+
+    with open(os.devnull, "w") as devnull:
+        with contextlib.redirect_stdout(devnull):
+            context = Context(
+                argparse.Namespace(user_id="u", password="p", tenant_id="t")
+            )
+            api.generate_token(context)
+            ListServer().execute(api, context)
+            server_ids = context.get("server_ids")
+            contexts = []
+            for index in range(args.threads):
+                worker_context = context.copy()
+                worker_context.set(
+                    "server_id", server_ids[index % len(server_ids)]
+                )
+                contexts.append(worker_context)
+            count = args.requests // args.threads
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=args.threads) as executor:
+                results = executor.map(
+                    lambda c: worker(api, c, count), contexts
+                )
+                latencies = [
+                    latency for result in results for latency in result
+                ]
+            elapsed = time.perf_counter() - start
+    api.close()
+    server.terminate()
+
+    line = "{} requests {} threads: {:.0f} req/s p50: {:.3f} ms p99: {:.3f} ms"
+    print(
+        line.format(
+            len(latencies),
+            args.threads,
+            len(latencies) / elapsed,
+            statistics.median(latencies) * 1000,
+            statistics.quantiles(latencies, n=100)[98] * 1000,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+import argparse
+import json
+import ssl
+import statistics
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.request import Request, urlopen
+
+from conoha.transport import ConnectionPool
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        body = json.dumps({"server": {"status": "ACTIVE"}}).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(certfile, keyfile):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    scheme = "http"
+    if certfile is not None:
+        context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        context.load_cert_chain(certfile, keyfile)
+        server.socket = context.wrap_socket(server.socket, server_side=True)
+        scheme = "https"
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    host, port = server.server_address
+    return server, "{}://{}:{}/v2.1/servers/bench".format(scheme, host, port)
+
+
+def measure(label, count, send):
+    latencies = []
+    for _ in range(count):
+        start = time.perf_counter()
+        send()
+        latencies.append(time.perf_counter() - start)
+    print(
+        "{:<8} mean: {:.3f} ms p50: {:.3f} ms p99: {:.3f} ms".format(
+            label,
+            statistics.mean(latencies) * 1000,
+            statistics.median(latencies) * 1000,
+            statistics.quantiles(latencies, n=100)[98] * 1000,
+        )
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--certfile")
+    parser.add_argument("--keyfile")
+    args = parser.parse_args()
+
+    server, url = start_server(args.certfile, args.keyfile)
+    context = ssl.create_default_context()
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    headers = {"Accept": "application/json"}
+
+    def send_urlopen():
+        request = Request(url, headers=headers)
+        if url.startswith("https"):
+            with urlopen(request, context=context) as response:
+                response.read()
+        else:
+            with urlopen(request) as response:
+                response.read()
+
+    pool = ConnectionPool(context=context)
+
+    def send_pool():
+        with pool.urlopen(Request(url, headers=headers)) as response:
+            response.read()
+
+    measure("urlopen", args.requests, send_urlopen)
+    measure("pool", args.requests, send_pool)
+    pool.close()
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+import argparse
+import multiprocessing
+import os
+import resource
+import ssl
+import tempfile
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.request import Request, urlopen
+
+from conoha.transport import ConnectionPool
+from conoha.upload import Progress, UploadSource, ZeroCopySource
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_PUT(self):
+        remaining = int(self.headers["Content-Length"])
+        while remaining > 0:
+            remaining -= len(self.rfile.read(min(remaining, 1024 * 1024)))
+        self.send_response(204)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port, certfile, keyfile):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    if certfile is not None:
+        context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        context.load_cert_chain(certfile, keyfile)
+        server.socket = context.wrap_socket(server.socket, server_side=True)
+    port.send(server.server_address[1])
+    server.serve_forever()
+
+
+def cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def measure(label, size, send):
+    cpu = cpu_seconds()
+    start = time.perf_counter()
+    send()
+    elapsed = time.perf_counter() - start
+    cpu = cpu_seconds() - cpu
+    gigabytes = size / 1024**3
+    print(
+        "{:<9} {:8.1f} MB/s {:6.2f} CPU-s/GB".format(
+            label, size / elapsed / 1024**2, cpu / gigabytes
+        )
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=512, help="MiB")
+    parser.add_argument("--certfile")
+    parser.add_argument("--keyfile")
+    args = parser.parse_args()
+
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    server = multiprocessing.Process(
+        target=serve,
+        args=(sender, args.certfile, args.keyfile),
+        daemon=True,
+    )
+    server.start()
+    scheme = "http" if args.certfile is None else "https"
+    url = "{}://127.0.0.1:{}/v2/images/bench/file".format(
+        scheme, receiver.recv()
+    )
+    context = ssl.create_default_context()
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+
+    with tempfile.NamedTemporaryFile() as iso:
+        block = os.urandom(1024 * 1024)
+        for _ in range(args.size):
+            iso.write(block)
+        iso.flush()
+        size = args.size * 1024 * 1024
+        headers = {
+            "Content-Type": "application/octet-stream",
+            "Content-Length": str(size),
+        }
+
+        def send_urlopen():
+            with open(iso.name, "rb") as fp:
+                request = Request(url, data=fp, headers=headers, method="PUT")
+                kwargs = {"context": context} if scheme == "https" else {}
+                with urlopen(request, **kwargs) as response:
+                    response.read()
+
+        pool = ConnectionPool(context=context)
+
+        def send_source(source_class):
+            source = source_class(iso.name, progress=Progress(interval=None))
+            request = Request(url, data=source, headers=headers, method="PUT")
+            try:
+                pool.urlopen(request)
+            finally:
+                source.close()
+
+        measure("urlopen", size, send_urlopen)
+        measure("stream", size, lambda: send_source(UploadSource))
+        measure("zero-copy", size, lambda: send_source(ZeroCopySource))
+        pool.close()
+    server.terminate()
+
+
+if __name__ == "__main__":
+    main()
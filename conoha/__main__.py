@@ -1,30 +1,77 @@
 import argparse
-import tomllib
-from pathlib import Path
+import contextlib
+import json
+import os
+import sys
+from functools import partial
 
+from conoha.batch import DEFAULT_PARALLEL, BatchExecutor
 from conoha.command import (
-    CompositeCommand,
+    CheckUploadSource,
     Context,
     DeleteImage,
+    FindUploadedImage,
     GenerateImageId,
     GenerateToken,
     GetServerConsole,
     GetServerStatus,
+    GraphCommand,
+    ListCachedImage,
+    ListCachedServer,
     ListImage,
     ListServer,
+    ListServerDetail,
     LoadSecret,
     LoadToken,
     MountImage,
     SaveSecret,
     StartServer,
     StopServerAndWait,
+    SyncImages,
+    SyncServers,
     UnmountImage,
     UploadImage,
+    WaitServerStatus,
 )
-from conoha.conoha import ConohaRestApi, FakeConohaRestApi
+from conoha.conoha import (
+    ConohaRestApi,
+    FakeConohaRestApi,
+    UnknownRegionError,
+    catalog_regions,
+    image_record,
+    server_record,
+    server_summary,
+)
+from conoha.executor import DEFAULT_CONCURRENCY, ServerExecutor
+from conoha.inventory import DEFAULT_MAX_AGE, Inventory, inventory_path
+from conoha.output import (
+    DEFAULT_OUTPUT,
+    OUTPUT_FORMATS,
+    discarding,
+    emit,
+    writing,
+)
+from conoha.profile import DEFAULT_PROFILES, load_profiles, select_profiles
+from conoha.ratelimit import RateLimiter, parse_limit
+from conoha.retry import (
+    DEFAULT_BACKOFF,
+    DEFAULT_BREAKER_RESET,
+    DEFAULT_BREAKER_THRESHOLD,
+    DEFAULT_MAX_DELAY,
+    DEFAULT_RETRIES,
+    RetryPolicy,
+)
+from conoha.secret import renew_token
+from conoha.trace import ChromeTraceSink, NdjsonSink, TimingSink, Tracer
+from conoha.transport import DEFAULT_POOL_SIZE
+from conoha.upload import DEFAULT_CHUNK_SIZE, DEFAULT_PROGRESS_INTERVAL
+from conoha.wait import DEFAULT_TIMEOUT
 
 
 def version_template():
+    import tomllib
+    from pathlib import Path
+
     project_metadata = Path(__file__).parent.parent.joinpath("pyproject.toml")
     with open(project_metadata, mode="rb") as metadata:
         version_number = tomllib.load(metadata)["tool"]["poetry"]["version"]
@@ -33,526 +80,1088 @@ def version_template():
 
 def generate_token(api, args):
     context = Context(args)
-    command = CompositeCommand()
+    command = GraphCommand()
     command.append(LoadSecret())
     command.append(GenerateToken(force=True))
     command.append(SaveSecret())
     command.execute(api, context)
+    emit(
+        {
+            "auth_token": context.get("auth_token"),
+            "expires_at": context.get("expires_at"),
+        }
+    )
+
+
+def open_inventory(args, context):
+    if args.cache:
+        inventory = Inventory(inventory_path(args.secret))
+        context.set("inventory", inventory)
+
+
+def fan_out(label, targets, list_items):
+    import contextvars
+    from concurrent.futures import ThreadPoolExecutor
+
+    def fetch(api, context):
+        LoadToken().execute(api, context)
+        return list_items(api, context)
+
+    failures = 0
+    with ThreadPoolExecutor(max_workers=max(len(targets), 1)) as executor:
+        futures = [
+            executor.submit(
+                contextvars.copy_context().run, fetch, api, context
+            )
+            for _, api, context in targets
+        ]
+        # targets are fetched side by side and printed in order
+        for (name, _, _), future in zip(targets, futures):
+            try:
+                items = future.result()
+            except Exception as error:
+                failures += 1
+                print("{}: {}".format(name, error), file=sys.stderr)
+                continue
+            for item in items:
+                emit({label: name, **item})
+    return failures
+
+
+def list_regions(api, args, list_items):
+    context = Context(args)
+    LoadToken().execute(api, context)
+    if context.get("catalog") is None:
+        renew_token(
+            context, api.generate_token, rejected=context.get("auth_token")
+        )
+    regions = catalog_regions(context.get("catalog"))
+    for region in args.regions or []:
+        if region not in regions:
+            raise UnknownRegionError(region, regions)
+    targets = []
+    for region in args.regions or regions:
+        region_context = context.copy()
+        region_context.set("region", region)
+        targets.append((region, api, region_context))
+    return fan_out("region", targets, list_items)
+
+
+def profile_api(api, args, name):
+    if args.apis is None:
+        target_api = create_api(args)
+        target_api.tracer = api.tracer
+        return target_api
+    key = ("profile", name) + tuple(
+        repr(getattr(args, option)) for option in API_OPTIONS
+    )
+    return args.apis.get(key, partial(create_api, args))
+
+
+def list_profiles(api, args, list_items):
+    try:
+        profiles = select_profiles(
+            load_profiles(args.profiles_file), args.profiles
+        )
+    except (OSError, ValueError) as error:
+        print("profiles: {}".format(error), file=sys.stderr)
+        return 1
+    targets = []
+    try:
+        # every profile gets its own token cache and connection pool
+        for name, profile in profiles:
+            profile_args = argparse.Namespace(**vars(args))
+            for key, value in profile.items():
+                setattr(profile_args, key, value)
+            targets.append(
+                (
+                    name,
+                    profile_api(api, profile_args, name),
+                    Context(profile_args),
+                )
+            )
+        return fan_out("profile", targets, list_items)
+    finally:
+        if args.apis is None:
+            for _, target_api, _ in targets:
+                target_api.close()
+
+
+def is_profile_fan_out(args):
+    return bool(
+        getattr(args, "profiles", None) or getattr(args, "all_profiles", False)
+    )
+
+
+def is_fan_out(args):
+    return is_profile_fan_out(args) or bool(
+        getattr(args, "regions", None) or getattr(args, "all_regions", False)
+    )
+
+
+def list_targets(api, args, list_items):
+    if is_profile_fan_out(args):
+        return list_profiles(api, args, list_items)
+    return list_regions(api, args, list_items)
 
 
 def list_server(api, args):
+    if is_fan_out(args):
+        if args.detail:
+            return list_targets(
+                api,
+                args,
+                lambda api, context: [
+                    server_summary(server)
+                    for server in api.iter_servers(context, detail=True)
+                ],
+            )
+        return list_targets(
+            api,
+            args,
+            lambda api, context: [
+                server_record(server) for server in api.iter_servers(context)
+            ],
+        )
     context = Context(args)
-    command = CompositeCommand()
-    command.append(LoadToken())
-    command.append(ListServer())
+    open_inventory(args, context)
+    command = GraphCommand()
+    if args.cache:
+        command.append(SyncServers())
+        command.append(ListCachedServer(detail=args.detail))
+    else:
+        command.append(LoadToken())
+        if args.detail:
+            command.append(ListServerDetail())
+        else:
+            command.append(ListServer())
     command.execute(api, context)
 
 
-def start_server(api, args):
+def load_server_ids(api, args, context):
+    inventory = context.get("inventory")
+    if args.all:
+        if inventory is not None:
+            return [server["id"] for server in inventory.servers()]
+        with discarding():
+            ListServer().execute(api, context)
+        return context.get("server_ids")
+    if args.server_id_file is not None:
+        with open(args.server_id_file, "r") as fp:
+            server_ids = [
+                line.strip()
+                for line in fp
+                if line.strip() and not line.startswith("#")
+            ]
+    else:
+        server_ids = args.server_ids
+    if inventory is not None:
+        server_ids = [inventory.resolve_server(ref) for ref in server_ids]
+    return server_ids
+
+
+def execute_servers(api, args, command, key=None, field="result"):
     context = Context(args)
-    command = CompositeCommand()
-    command.append(LoadToken())
-    command.append(StartServer())
-    command.execute(api, context)
+    open_inventory(args, context)
+    if args.cache:
+        SyncServers().execute(api, context)
+    LoadToken().execute(api, context)
+    server_ids = load_server_ids(api, args, context)
+    executor = ServerExecutor(api, concurrency=args.concurrency)
+    failures = 0
+    for worker_context, error in executor.execute(
+        command, context, server_ids
+    ):
+        server_id = worker_context.get("server_id")
+        if error is None:
+            result = "success" if key is None else worker_context.get(key)
+            emit({"id": server_id, field: result})
+        else:
+            failures += 1
+            print("{}: {}".format(server_id, error), file=sys.stderr)
+    return failures
+
+
+def start_server(api, args):
+    return execute_servers(api, args, StartServer())
 
 
 def stop_server(api, args):
-    context = Context(args)
-    command = CompositeCommand()
-    command.append(LoadToken())
-    command.append(StopServerAndWait())
-    command.execute(api, context)
+    return execute_servers(api, args, StopServerAndWait())
+
+
+def get_profile_server_status(api, args):
+    server_ids = None
+    if not args.all:
+        server_ids = set(load_server_ids(api, args, Context(args)))
+    found = set()
+
+    def list_statuses(api, context):
+        statuses = [
+            {"id": server["id"], "status": server["status"]}
+            for server in api.iter_servers(context, detail=True)
+            if server_ids is None or server["id"] in server_ids
+        ]
+        found.update(status["id"] for status in statuses)
+        return statuses
+
+    failures = list_profiles(api, args, list_statuses)
+    for server_id in sorted((server_ids or set()) - found):
+        failures += 1
+        print("{}: not found".format(server_id), file=sys.stderr)
+    return failures
 
 
 def get_server_status(api, args):
+    if is_profile_fan_out(args):
+        return get_profile_server_status(api, args)
+    # the fake api has no servers to list, under --pretend every server is
+    # asked for on its own
+    single = args.server_ids is not None and len(args.server_ids) == 1
+    if not args.cache and not args.all and (single or args.pretend):
+        return execute_servers(
+            api, args, GetServerStatus(), "server_status", "status"
+        )
     context = Context(args)
-    command = CompositeCommand()
-    command.append(LoadToken())
-    command.append(GetServerStatus())
-    command.execute(api, context)
+    open_inventory(args, context)
+    command = GraphCommand()
+    if args.cache:
+        command.append(SyncServers())
+    else:
+        command.append(LoadToken())
+        command.append(ListServerDetail())
+    with discarding():
+        command.execute(api, context)
+    if args.cache:
+        servers = context.get("inventory").servers()
+    else:
+        servers = context.get("servers")
+    statuses = {server["id"]: server["status"] for server in servers}
+    if args.all:
+        server_ids = list(statuses)
+    else:
+        server_ids = load_server_ids(api, args, context)
+    failures = 0
+    for server_id in server_ids:
+        if server_id in statuses:
+            emit({"id": server_id, "status": statuses[server_id]})
+        else:
+            failures += 1
+            print("{}: not found".format(server_id), file=sys.stderr)
+    return failures
 
 
-def get_server_console(api, args):
+def wait_server(api, args):
+    import statistics
+
     context = Context(args)
-    command = CompositeCommand()
-    command.append(LoadToken())
-    command.append(GetServerConsole())
-    command.execute(api, context)
+    open_inventory(args, context)
+    if args.cache:
+        SyncServers().execute(api, context)
+    LoadToken().execute(api, context)
+    server_ids = list(dict.fromkeys(load_server_ids(api, args, context)))
+    durations = {}
+    errors = []
+    for server_id, status, elapsed in api.wait_servers(
+        context, server_ids, args.status
+    ):
+        if status != args.status:
+            errors.append(server_id)
+            print(
+                "{}: server is in {} state".format(server_id, status),
+                file=sys.stderr,
+            )
+            continue
+        durations[server_id] = elapsed
+        emit(
+            {
+                "id": server_id,
+                "status": args.status,
+                "seconds": round(elapsed, 1),
+            }
+        )
+    pending = [
+        server_id
+        for server_id in server_ids
+        if server_id not in durations and server_id not in errors
+    ]
+    for server_id in pending:
+        print(
+            "{}: timed out waiting for {}".format(server_id, args.status),
+            file=sys.stderr,
+        )
+    if durations:
+        print(
+            "{}: {}/{} servers, median {:.1f}s, max {:.1f}s".format(
+                args.status,
+                len(durations),
+                len(server_ids),
+                statistics.median(durations.values()),
+                max(durations.values()),
+            ),
+            file=sys.stderr,
+        )
+    return len(pending) + len(errors)
+
+
+def get_server_console(api, args):
+    return execute_servers(
+        api, args, GetServerConsole(), "console_url", "console_url"
+    )
 
 
 def list_image(api, args):
+    if is_fan_out(args):
+        return list_targets(
+            api,
+            args,
+            lambda api, context: [
+                image_record(image) for image in api.iter_images(context)
+            ],
+        )
     context = Context(args)
-    command = CompositeCommand()
-    command.append(LoadToken())
-    command.append(ListImage())
+    open_inventory(args, context)
+    command = GraphCommand()
+    if args.cache:
+        command.append(SyncImages())
+        command.append(ListCachedImage())
+    else:
+        command.append(LoadToken())
+        command.append(ListImage())
     command.execute(api, context)
 
 
 def generate_image(api, args):
     context = Context(args)
-    command = CompositeCommand()
+    command = GraphCommand()
     command.append(LoadToken())
     command.append(GenerateImageId())
     command.execute(api, context)
+    emit({"id": context.get("image_id")})
 
 
 def upload_image(api, args):
     context = Context(args)
-    command = CompositeCommand()
+    command = GraphCommand()
     command.append(LoadToken())
+    command.append(CheckUploadSource())
+    if not args.force:
+        command.append(FindUploadedImage())
     command.append(UploadImage())
     command.execute(api, context)
+    if context.get("uploaded_image_id") is not None:
+        emit({"id": context.get("uploaded_image_id"), "result": "skipped"})
+    else:
+        record = {"id": context.get("image_id"), "result": "success"}
+        emit({**record, **(context.get("digests") or {})})
 
 
 def delete_image(api, args):
     context = Context(args)
-    command = CompositeCommand()
+    # a deleted image must not linger in the cache, even without --cache
+    if args.secret is not None and os.path.exists(inventory_path(args.secret)):
+        context.set("inventory", Inventory(inventory_path(args.secret)))
+    command = GraphCommand()
     command.append(LoadToken())
     command.append(DeleteImage())
     command.execute(api, context)
+    emit({"id": context.get("image_id"), "result": "success"})
 
 
 def mount_image(api, args):
     context = Context(args)
-    command = CompositeCommand()
+    command = GraphCommand()
     command.append(LoadToken())
     command.append(StopServerAndWait())
     command.append(MountImage())
-    command.append(GetServerStatus())
+    command.append(WaitServerStatus("RESCUE"))
     command.execute(api, context)
+    emit(
+        {
+            "id": context.get("server_id"),
+            "admin_pass": context.get("admin_pass"),
+        }
+    )
 
 
 def unmount_image(api, args):
     context = Context(args)
-    command = CompositeCommand()
+    command = GraphCommand()
     command.append(LoadToken())
     command.append(UnmountImage())
-    command.append(GetServerStatus())
+    command.append(WaitServerStatus("ACTIVE"))
     command.execute(api, context)
+    emit({"id": context.get("server_id"), "result": "success"})
 
 
-def create_parser():
-    formatter = argparse.ArgumentDefaultsHelpFormatter
-    parser = argparse.ArgumentParser(prog="conoha", formatter_class=formatter)
-    parser.add_argument(
-        "--pretend",
-        help="テスト実行します",
-    )
-    subparsers = parser.add_subparsers(required=True)
+def run_batch(api, args):
+    context = Context(args)
+    LoadToken().execute(api, context)
+    executor = BatchExecutor(api, parallel=args.parallel)
+    if args.file == "-":
+        source = contextlib.nullcontext(sys.stdin)
+    else:
+        source = open(args.file, "r")
+    results = sys.stdout
+    failures = 0
+    # results own stdout, whatever the operations print goes to stderr
+    with source as lines, contextlib.redirect_stdout(sys.stderr):
+        for result in executor.execute(context, lines):
+            if not result["ok"]:
+                failures += 1
+            print(json.dumps(result), file=results, flush=True)
+    return failures
 
-    # token
-    token_parser = subparsers.add_parser(
-        "token",
-        help="トークン関連",
-    )
-    token_subparser = token_parser.add_subparsers(required=True)
 
-    # generate
-    generate_token_parser = token_subparser.add_parser(
-        "generate",
-        help="トークンを生成します",
-        formatter_class=formatter,
-    )
-    generate_token_parser.set_defaults(func=generate_token)
-    generate_token_parser.add_argument(
+def add_credential_arguments(parser, auth_token=True):
+    credential_group = parser.add_argument_group("認証情報")
+    credential_group.add_argument(
         "--secret",
         help="トークンファイル",
     )
-    generate_token_parser.add_argument(
+    if auth_token:
+        credential_group.add_argument(
+            "--auth-token",
+            help="トークン",
+        )
+    credential_group.add_argument(
         "--user-id",
         help="ConoHa VPS API ユーザID",
     )
-    generate_token_parser.add_argument(
+    credential_group.add_argument(
         "--password",
         help="ConoHa VPS API パスワード",
     )
-    generate_token_parser.add_argument(
+    credential_group.add_argument(
         "--tenant-id",
         help="ConoHa VPS テナントID",
     )
 
-    # server
-    server_parser = subparsers.add_parser(
-        "server",
-        help="サーバ関連",
-    )
-    server_subparser = server_parser.add_subparsers(required=True)
 
-    ## list
-    list_server_parser = server_subparser.add_parser(
-        "list",
-        help="サーバを一覧表示します",
-        formatter_class=formatter,
-    )
-    list_server_parser.set_defaults(func=list_server)
-    list_server_parser.add_argument(
-        "--secret",
-        help="トークンファイル",
+def add_server_target_arguments(parser):
+    target_group = parser.add_mutually_exclusive_group(required=True)
+    target_group.add_argument(
+        "--server-id",
+        dest="server_ids",
+        nargs="+",
+        action="extend",
+        help="サーバID",
     )
-    list_server_parser.add_argument(
-        "--auth-token",
-        help="トークン",
+    target_group.add_argument(
+        "--server-id-file",
+        help="サーバIDを1行毎に記載したファイル",
     )
-    list_server_parser.add_argument(
-        "--user-id",
-        help="ConoHa VPS API ユーザID",
+    target_group.add_argument(
+        "--all",
+        action="store_true",
+        help="全てのサーバを対象にします",
     )
-    list_server_parser.add_argument(
-        "--password",
-        help="ConoHa VPS API パスワード",
-    )
-    list_server_parser.add_argument(
-        "--tenant-id",
-        help="ConoHa VPS テナントID",
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=DEFAULT_CONCURRENCY,
+        help="同時に操作するサーバ数",
     )
+    add_cache_arguments(parser)
 
-    ## start
-    start_server_parser = server_subparser.add_parser(
-        "start",
-        help="サーバを起動します",
-        formatter_class=formatter,
-    )
-    start_server_parser.set_defaults(func=start_server)
-    start_server_parser.add_argument(
-        "--secret",
-        help="トークンファイル",
+
+def add_cache_arguments(parser):
+    parser.add_argument(
+        "--cache",
+        action="store_true",
+        help="トークンファイルと同じ場所のローカルキャッシュを使用します",
     )
-    start_server_parser.add_argument(
-        "--auth-token",
-        help="トークン",
+    parser.add_argument(
+        "--max-age",
+        type=float,
+        default=DEFAULT_MAX_AGE,
+        help="キャッシュを再同期せずに使用する秒数",
     )
-    start_server_parser.add_argument(
-        "--user-id",
-        help="ConoHa VPS API ユーザID",
+
+
+def add_page_arguments(parser):
+    parser.add_argument(
+        "--page-size",
+        type=int,
+        help="1回のリクエストで取得する件数",
     )
-    start_server_parser.add_argument(
-        "--password",
-        help="ConoHa VPS API パスワード",
+    parser.add_argument(
+        "--prefetch",
+        action="store_true",
+        help="表示中に次のページを先読みします",
     )
-    start_server_parser.add_argument(
-        "--tenant-id",
-        help="ConoHa VPS テナントID",
+
+
+def add_generate_token_arguments(parser):
+    add_credential_arguments(parser, auth_token=False)
+
+
+def add_list_server_arguments(parser):
+    add_credential_arguments(parser)
+    parser.add_argument(
+        "--detail",
+        action="store_true",
+        help="名前, ステータス, アドレス, プランも表示します",
     )
-    start_server_parser.add_argument(
-        "--server-id",
-        required=True,
-        help="サーバID",
+    parser.add_argument(
+        "--status",
+        dest="filter_status",
+        help="指定したステータスのサーバのみ表示します (--detail 指定時)",
     )
+    parser.add_argument(
+        "--name",
+        dest="filter_name",
+        help="名前が一致するサーバのみ表示します (--detail 指定時)",
+    )
+    add_page_arguments(parser)
+    add_cache_arguments(parser)
+    add_region_arguments(parser)
+    add_profile_arguments(parser)
 
-    ## stop
-    stop_server_parser = server_subparser.add_parser(
-        "stop",
-        help="サーバを停止します",
-        formatter_class=formatter,
-    )
-    stop_server_parser.set_defaults(func=stop_server)
-    stop_server_parser.add_argument(
-        "--secret",
-        help="トークンファイル",
+
+def add_region_arguments(parser):
+    region_group = parser.add_mutually_exclusive_group()
+    region_group.add_argument(
+        "--regions",
+        nargs="+",
+        help="指定したリージョンを並行して一覧表示します",
+    )
+    region_group.add_argument(
+        "--all-regions",
+        action="store_true",
+        help="サービスカタログの全リージョンを並行して一覧表示します",
     )
-    stop_server_parser.add_argument(
-        "--auth-token",
-        help="トークン",
+
+
+def add_profile_arguments(parser):
+    profile_group = parser.add_mutually_exclusive_group()
+    profile_group.add_argument(
+        "--profiles",
+        type=profile_names,
+        metavar="NAME[,NAME...]",
+        help="指定したプロファイルのアカウントで並行して実行します",
+    )
+    profile_group.add_argument(
+        "--all-profiles",
+        action="store_true",
+        help="プロファイルファイルの全アカウントで並行して実行します",
     )
-    stop_server_parser.add_argument(
-        "--user-id",
-        help="ConoHa VPS API ユーザID",
+
+
+def add_server_arguments(parser):
+    add_credential_arguments(parser)
+    add_server_target_arguments(parser)
+
+
+def add_server_status_arguments(parser):
+    add_server_arguments(parser)
+    add_profile_arguments(parser)
+
+
+def add_stop_server_arguments(parser):
+    add_server_arguments(parser)
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=DEFAULT_TIMEOUT,
+        help="停止を待つ最大秒数",
     )
-    stop_server_parser.add_argument(
-        "--password",
-        help="ConoHa VPS API パスワード",
+
+
+def add_wait_server_arguments(parser):
+    add_server_arguments(parser)
+    parser.add_argument(
+        "--status",
+        required=True,
+        choices=["ACTIVE", "SHUTOFF", "RESCUE"],
+        help="待つステータス",
     )
-    stop_server_parser.add_argument(
-        "--tenant-id",
-        help="ConoHa VPS テナントID",
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=DEFAULT_TIMEOUT,
+        help="全てのサーバを待つ最大秒数",
     )
-    stop_server_parser.add_argument(
-        "--server-id",
+
+
+def add_list_image_arguments(parser):
+    add_credential_arguments(parser)
+    add_page_arguments(parser)
+    add_cache_arguments(parser)
+    add_region_arguments(parser)
+    add_profile_arguments(parser)
+
+
+def add_generate_image_arguments(parser):
+    add_credential_arguments(parser)
+    parser.add_argument(
+        "--image-name",
         required=True,
-        help="サーバID",
+        help="イメージ名",
     )
 
-    ## status
-    get_server_status_parser = server_subparser.add_parser(
-        "status",
-        help="サーバのステータスを確認します",
-        formatter_class=formatter,
+
+def add_delete_image_arguments(parser):
+    add_credential_arguments(parser)
+    parser.add_argument(
+        "--image-id",
+        required=True,
+        help="イメージID",
     )
-    get_server_status_parser.set_defaults(func=get_server_status)
-    get_server_status_parser.add_argument(
-        "--secret",
-        help="トークンファイル",
+
+
+def add_upload_image_arguments(parser):
+    add_delete_image_arguments(parser)
+    parser.add_argument(
+        "--iso-file",
+        required=True,
+        help="ISO ファイル (- で標準入力, .gz/.xz/.zst は展開しながら送信)",
     )
-    get_server_status_parser.add_argument(
-        "--auth-token",
-        help="トークン",
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=DEFAULT_CHUNK_SIZE,
+        help="1回に読み込み送信するバイト数",
     )
-    get_server_status_parser.add_argument(
-        "--user-id",
-        help="ConoHa VPS API ユーザID",
+    parser.add_argument(
+        "--zero-copy",
+        action="store_true",
+        help="通常ファイルを sendfile/mmap で送信します (送信時のハッシュ計算は行いません)",
     )
-    get_server_status_parser.add_argument(
-        "--password",
-        help="ConoHa VPS API パスワード",
+    parser.add_argument(
+        "--progress-interval",
+        type=float,
+        default=DEFAULT_PROGRESS_INTERVAL,
+        help="進捗を表示する間隔 (秒)",
     )
-    get_server_status_parser.add_argument(
-        "--tenant-id",
-        help="ConoHa VPS テナントID",
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="同一内容のイメージが存在してもアップロードします",
     )
-    get_server_status_parser.add_argument(
+
+
+def add_mount_image_arguments(parser):
+    add_credential_arguments(parser)
+    parser.add_argument(
         "--server-id",
         required=True,
         help="サーバID",
     )
-
-    ## console
-    get_server_console_parser = server_subparser.add_parser(
-        "console",
-        help="サーバのコンソールアクセスURLを確認します",
-        formatter_class=formatter,
-    )
-    get_server_console_parser.set_defaults(func=get_server_console)
-    get_server_console_parser.add_argument(
-        "--secret",
-        help="トークンファイル",
-    )
-    get_server_console_parser.add_argument(
-        "--auth-token",
-        help="トークン",
-    )
-    get_server_console_parser.add_argument(
-        "--user-id",
-        help="ConoHa VPS API ユーザID",
-    )
-    get_server_console_parser.add_argument(
-        "--password",
-        help="ConoHa VPS API パスワード",
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=DEFAULT_TIMEOUT,
+        help="マウント完了を待つ最大秒数",
     )
-    get_server_console_parser.add_argument(
-        "--tenant-id",
-        help="ConoHa VPS テナントID",
+    parser.add_argument(
+        "--image-id",
+        required=True,
+        help="イメージID",
     )
-    get_server_console_parser.add_argument(
+
+
+def add_unmount_image_arguments(parser):
+    add_credential_arguments(parser)
+    parser.add_argument(
         "--server-id",
         required=True,
         help="サーバID",
     )
-
-    # image
-    image_parser = subparsers.add_parser(
-        "image", help="ISOイメージ関連", formatter_class=formatter
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=DEFAULT_TIMEOUT,
+        help="アンマウント完了を待つ最大秒数",
     )
-    image_subparser = image_parser.add_subparsers(required=True)
 
-    ## list
-    list_image_parser = image_subparser.add_parser(
-        "list",
-        help="イメージを一覧表示します",
-        formatter_class=formatter,
-    )
-    list_image_parser.set_defaults(func=list_image)
-    list_image_parser.add_argument(
-        "--secret",
-        help="トークンファイル",
-    )
-    list_image_parser.add_argument(
-        "--auth-token",
-        help="トークン",
-    )
-    list_image_parser.add_argument(
-        "--user-id",
-        help="ConoHa VPS API ユーザID",
-    )
-    list_image_parser.add_argument(
-        "--password",
-        help="ConoHa VPS API パスワード",
-    )
-    list_image_parser.add_argument(
-        "--tenant-id",
-        help="ConoHa VPS テナントID",
-    )
 
-    ## generate
-    generate_image_parser = image_subparser.add_parser(
-        "generate",
-        help="イメージIDを作成します",
-        formatter_class=formatter,
-    )
-    generate_image_parser.set_defaults(func=generate_image)
-    generate_image_parser.add_argument(
-        "--secret",
-        help="トークンファイル",
-    )
-    generate_image_parser.add_argument(
-        "--auth-token",
-        help="トークン",
-    )
-    generate_image_parser.add_argument(
-        "--user-id",
-        help="ConoHa VPS API ユーザID",
-    )
-    generate_image_parser.add_argument(
-        "--password",
-        help="ConoHa VPS API パスワード",
-    )
-    generate_image_parser.add_argument(
-        "--tenant-id",
-        help="ConoHa VPS テナントID",
+def add_batch_arguments(parser):
+    add_credential_arguments(parser)
+    parser.add_argument(
+        "file",
+        help="1行1操作の NDJSON ファイル (- で標準入力)",
     )
-    generate_image_parser.add_argument(
-        "--image-name",
-        required=True,
-        help="イメージ名",
+    parser.add_argument(
+        "--parallel",
+        type=int,
+        default=DEFAULT_PARALLEL,
+        help="同時に実行する操作数",
     )
 
-    ## delete
-    delete_image_parser = image_subparser.add_parser(
-        "delete",
-        help="イメージを削除します",
-        formatter_class=formatter,
-    )
-    delete_image_parser.set_defaults(func=delete_image)
-    delete_image_parser.add_argument(
-        "--secret",
-        help="トークンファイル",
-    )
-    delete_image_parser.add_argument(
-        "--auth-token",
-        help="トークン",
-    )
-    delete_image_parser.add_argument(
-        "--user-id",
-        help="ConoHa VPS API ユーザID",
-    )
-    delete_image_parser.add_argument(
-        "--password",
-        help="ConoHa VPS API パスワード",
-    )
-    delete_image_parser.add_argument(
-        "--tenant-id",
-        help="ConoHa VPS テナントID",
-    )
-    delete_image_parser.add_argument(
-        "--image-id",
-        required=True,
-        help="イメージID",
+
+def add_daemon_arguments(parser):
+    parser.add_argument(
+        "--socket",
+        help="Unix ソケットのパス (既定は環境変数 CONOHA_SOCKET)",
     )
 
-    ## upload
-    upload_image_parser = image_subparser.add_parser(
-        "upload",
-        help="ISOイメージをアップロードします",
-        formatter_class=formatter,
+
+def start_daemon(api, args):
+    from conoha.daemon import ApiCache, serve
+
+    apis = ApiCache()
+    return serve(args.socket, partial(execute, apis=apis, environ={}), apis)
+
+
+def request_daemon(args, message):
+    from conoha.daemon import request, socket_path
+
+    try:
+        path = socket_path(args.socket)
+    except PermissionError as error:
+        print(error, file=sys.stderr)
+        return 1
+    reply = request(path, message)
+    if reply is None:
+        print("daemon is not running", file=sys.stderr)
+        return 1
+    return reply["exit"]
+
+
+def stop_daemon(api, args):
+    return request_daemon(args, {"stop": True})
+
+
+def get_daemon_status(api, args):
+    return request_daemon(args, {"status": True})
+
+
+# group: (help, {command: (help, handler, add_arguments)})
+COMMANDS = {
+    "token": (
+        "トークン関連",
+        {
+            "generate": (
+                "トークンを生成します",
+                generate_token,
+                add_generate_token_arguments,
+            ),
+        },
+    ),
+    "server": (
+        "サーバ関連",
+        {
+            "list": (
+                "サーバを一覧表示します",
+                list_server,
+                add_list_server_arguments,
+            ),
+            "start": (
+                "サーバを起動します",
+                start_server,
+                add_server_arguments,
+            ),
+            "stop": (
+                "サーバを停止します",
+                stop_server,
+                add_stop_server_arguments,
+            ),
+            "status": (
+                "サーバのステータスを確認します",
+                get_server_status,
+                add_server_status_arguments,
+            ),
+            "wait": (
+                "サーバが指定したステータスになるまで待ちます",
+                wait_server,
+                add_wait_server_arguments,
+            ),
+            "console": (
+                "サーバのコンソールアクセスURLを確認します",
+                get_server_console,
+                add_server_arguments,
+            ),
+        },
+    ),
+    "image": (
+        "ISOイメージ関連",
+        {
+            "list": (
+                "イメージを一覧表示します",
+                list_image,
+                add_list_image_arguments,
+            ),
+            "generate": (
+                "イメージIDを作成します",
+                generate_image,
+                add_generate_image_arguments,
+            ),
+            "delete": (
+                "イメージを削除します",
+                delete_image,
+                add_delete_image_arguments,
+            ),
+            "upload": (
+                "ISOイメージをアップロードします",
+                upload_image,
+                add_upload_image_arguments,
+            ),
+            "mount": (
+                "イメージをマウントします",
+                mount_image,
+                add_mount_image_arguments,
+            ),
+            "unmount": (
+                "イメージをアンマウントします",
+                unmount_image,
+                add_unmount_image_arguments,
+            ),
+        },
+    ),
+    "batch": (
+        "一括実行関連",
+        {
+            "run": (
+                "NDJSON の操作を一括実行し結果を NDJSON で出力します",
+                run_batch,
+                add_batch_arguments,
+            ),
+        },
+    ),
+    "daemon": (
+        "常駐プロセス関連",
+        {
+            "start": (
+                "トークンと接続を保持する常駐プロセスを起動します",
+                start_daemon,
+                add_daemon_arguments,
+            ),
+            "stop": (
+                "常駐プロセスを停止します",
+                stop_daemon,
+                add_daemon_arguments,
+            ),
+            "status": (
+                "常駐プロセスの状態を確認します",
+                get_daemon_status,
+                add_daemon_arguments,
+            ),
+        },
+    ),
+}
+
+
+def profile_names(value):
+    return [name for name in value.split(",") if name]
+
+
+def field_names(value):
+    return [name for name in value.split(",") if name]
+
+
+def rate_limit(value):
+    try:
+        return parse_limit(value)
+    except ValueError as error:
+        raise argparse.ArgumentTypeError(str(error))
+
+
+GLOBAL_OPTIONS = [
+    "--pretend",
+    "--pool-size",
+    "--identity-url",
+    "--compute-url",
+    "--image-url",
+    "--trace",
+    "--chrome-trace",
+    "--retries",
+    "--retry-backoff",
+    "--retry-max-delay",
+    "--breaker-threshold",
+    "--breaker-reset",
+    "--rate-limit",
+    "--region",
+    "--profiles-file",
+    "--output",
+    "--fields",
+]
+
+# options that shape the api, the daemon keeps one warm api for each
+# combination it is asked for
+API_OPTIONS = [
+    "pretend",
+    "pool_size",
+    "identity_url",
+    "compute_url",
+    "image_url",
+    "retries",
+    "retry_backoff",
+    "retry_max_delay",
+    "retry_actions",
+    "breaker_threshold",
+    "breaker_reset",
+    "rate_limit",
+]
+
+# files the daemon has to resolve against the client's directory
+PATH_OPTIONS = ["secret", "server_id_file", "iso_file", "profiles_file"]
+
+# commands with these run in the calling process: tracing writes local
+# files and "-" reads the caller's stdin
+LOCAL_OPTIONS = [
+    "--no-daemon",
+    "--pretend",
+    "--trace",
+    "--chrome-trace",
+    "--timings",
+    "-h",
+    "--help",
+]
+
+
+def selected_command(argv):
+    group = None
+    skip = False
+    for arg in argv:
+        if skip:
+            skip = False
+        elif group is None:
+            if arg in COMMANDS:
+                group = arg
+            else:
+                # values of the global options are not subcommand names
+                skip = arg in GLOBAL_OPTIONS
+        elif arg in COMMANDS[group][1]:
+            return group, arg
+    return group, None
+
+
+def create_parser(argv=None, environ=os.environ):
+    if argv is None:
+        argv = sys.argv[1:]
+    selected_group, selected = selected_command(argv)
+    formatter = argparse.ArgumentDefaultsHelpFormatter
+    parser = argparse.ArgumentParser(prog="conoha", formatter_class=formatter)
+    parser.add_argument(
+        "--pretend",
+        help="テスト実行します",
     )
-    upload_image_parser.set_defaults(func=upload_image)
-    upload_image_parser.add_argument(
-        "--secret",
-        help="トークンファイル",
+    parser.add_argument(
+        "--no-daemon",
+        action="store_true",
+        help="常駐プロセスが起動していても転送せずに実行します",
     )
-    upload_image_parser.add_argument(
-        "--auth-token",
-        help="トークン",
+    parser.add_argument(
+        "--pool-size",
+        type=int,
+        default=DEFAULT_POOL_SIZE,
+        help="ホスト毎に保持するHTTPS接続数",
+    )
+    for service, name in [
+        ("identity", "Identity"),
+        ("compute", "Compute"),
+        ("image", "Image"),
+    ]:
+        environment = "CONOHA_{}_URL".format(service.upper())
+        parser.add_argument(
+            "--{}-url".format(service),
+            default=environ.get(environment),
+            help="{} API のベースURL (環境変数 {})".format(name, environment),
+        )
+    parser.add_argument(
+        "--region",
+        default=environ.get("CONOHA_REGION"),
+        help="サービスカタログから使うリージョン (環境変数 CONOHA_REGION)",
     )
-    upload_image_parser.add_argument(
-        "--user-id",
-        help="ConoHa VPS API ユーザID",
+    parser.add_argument(
+        "--profiles-file",
+        default=environ.get("CONOHA_PROFILES"),
+        help="アカウント毎のトークンファイル等を記載したプロファイルファイル"
+        " (環境変数 CONOHA_PROFILES, 既定 {})".format(DEFAULT_PROFILES),
     )
-    upload_image_parser.add_argument(
-        "--password",
-        help="ConoHa VPS API パスワード",
+    parser.add_argument(
+        "--output",
+        choices=OUTPUT_FORMATS,
+        default=DEFAULT_OUTPUT,
+        help="結果の出力形式 (table 以外は1件毎に書き出します)",
     )
-    upload_image_parser.add_argument(
-        "--tenant-id",
-        help="ConoHa VPS テナントID",
+    parser.add_argument(
+        "--fields",
+        type=field_names,
+        metavar="FIELD[,FIELD...]",
+        help="出力する項目",
     )
-    upload_image_parser.add_argument(
-        "--image-id",
-        required=True,
-        help="イメージID",
+    parser.add_argument(
+        "--trace",
+        help="リクエスト毎の計測結果を NDJSON で追記するファイル",
     )
-    upload_image_parser.add_argument(
-        "--iso-file",
-        required=True,
-        help="ISO ファイル",
+    parser.add_argument(
+        "--chrome-trace",
+        help="Chrome trace 形式で計測結果を書き出すファイル",
     )
-
-    ## mount
-    mount_image_parser = image_subparser.add_parser(
-        "mount",
-        help="イメージをマウントします",
-        formatter_class=formatter,
+    parser.add_argument(
+        "--timings",
+        action="store_true",
+        help="終了時に処理毎の所要時間を標準エラー出力に表示します",
     )
-    mount_image_parser.set_defaults(func=mount_image)
-    mount_image_parser.add_argument(
-        "--secret",
-        help="トークンファイル",
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=DEFAULT_RETRIES,
+        help="一時的なエラー (429, 5xx, 通信エラー) を再試行する回数",
     )
-    mount_image_parser.add_argument(
-        "--auth-token",
-        help="トークン",
+    parser.add_argument(
+        "--retry-backoff",
+        type=float,
+        default=DEFAULT_BACKOFF,
+        help="再試行間隔の基準秒数 (full jitter で倍々に伸ばします)",
     )
-    mount_image_parser.add_argument(
-        "--user-id",
-        help="ConoHa VPS API ユーザID",
+    parser.add_argument(
+        "--retry-max-delay",
+        type=float,
+        default=DEFAULT_MAX_DELAY,
+        help="再試行間隔の上限秒数 (Retry-After がこれを超える場合は諦めます)",
     )
-    mount_image_parser.add_argument(
-        "--password",
-        help="ConoHa VPS API パスワード",
+    parser.add_argument(
+        "--retry-actions",
+        action="store_true",
+        help="起動, 停止, マウント等のサーバ操作も再試行します",
     )
-    mount_image_parser.add_argument(
-        "--tenant-id",
-        help="ConoHa VPS テナントID",
+    parser.add_argument(
+        "--breaker-threshold",
+        type=int,
+        default=DEFAULT_BREAKER_THRESHOLD,
+        help="ホストへのリクエストを遮断するまでの連続失敗回数",
     )
-    mount_image_parser.add_argument(
-        "--server-id",
-        required=True,
-        help="サーバID",
+    parser.add_argument(
+        "--breaker-reset",
+        type=float,
+        default=DEFAULT_BREAKER_RESET,
+        help="遮断したホストへ再度リクエストするまでの秒数",
     )
-    mount_image_parser.add_argument(
-        "--image-id",
-        required=True,
-        help="イメージID",
+    parser.add_argument(
+        "--rate-limit",
+        type=rate_limit,
+        action="append",
+        metavar="SERVICE=RATE[:BURST]",
+        help="サービス毎の毎秒リクエスト数の上限 (429 を受けると自動で絞ります)",
     )
+    subparsers = parser.add_subparsers(required=True)
 
-    ## unmount
-    unmount_image_parser = image_subparser.add_parser(
-        "unmount",
-        help="イメージをアンマウントします",
-        formatter_class=formatter,
-    )
-    unmount_image_parser.set_defaults(func=unmount_image)
-    unmount_image_parser.add_argument(
-        "--secret",
-        help="トークンファイル",
-    )
-    unmount_image_parser.add_argument(
-        "--auth-token",
-        help="トークン",
-    )
-    unmount_image_parser.add_argument(
-        "--user-id",
-        help="ConoHa VPS API ユーザID",
-    )
-    unmount_image_parser.add_argument(
-        "--password",
-        help="ConoHa VPS API パスワード",
-    )
-    unmount_image_parser.add_argument(
-        "--tenant-id",
-        help="ConoHa VPS テナントID",
-    )
-    unmount_image_parser.add_argument(
-        "--server-id",
-        required=True,
-        help="サーバID",
-    )
+    # only the selected subcommand gets its arguments, the rest are listed
+    # for --help and error messages
+    for group, (group_help, commands) in COMMANDS.items():
+        group_parser = subparsers.add_parser(
+            group, help=group_help, formatter_class=formatter
+        )
+        command_subparsers = group_parser.add_subparsers(required=True)
+        if group != selected_group:
+            continue
+        for command, (command_help, func, add_arguments) in commands.items():
+            command_parser = command_subparsers.add_parser(
+                command,
+                help=command_help,
+                formatter_class=formatter,
+            )
+            command_parser.set_defaults(func=func)
+            if command == selected:
+                add_arguments(command_parser)
 
     return parser
 
 
-if __name__ == "__main__":
-    parser = create_parser()
-    args = parser.parse_args()
+def validate_arguments(parser, args):
     func = args.func.__name__
 
     if func == "generate_token":
@@ -563,7 +1172,7 @@ if __name__ == "__main__":
                 or args.tenant_id is None
             ):
                 parser.error("トークンファイル又はユーザID, パスワード, テナントIDを指定して下さい")
-    else:
+    elif hasattr(args, "secret") and not is_profile_fan_out(args):
         if args.secret is None and args.auth_token is None:
             if (
                 args.user_id is None
@@ -572,9 +1181,157 @@ if __name__ == "__main__":
             ):
                 parser.error("トークンファイル、トークン又はユーザID, パスワード, テナントIDを指定して下さい")
 
+    if getattr(args, "cache", False) and args.secret is None:
+        parser.error(
+            "--cache を使用する場合はトークンファイルを指定して下さい"
+        )
+
+    if getattr(args, "regions", None) or getattr(args, "all_regions", False):
+        if args.cache:
+            parser.error("--cache と --regions は同時に指定できません")
+        if args.pretend:
+            parser.error("--pretend と --regions は同時に指定できません")
+
+    if func == "run_batch" and (args.output != "text" or args.fields):
+        parser.error("batch run の結果は常に NDJSON で出力します")
+
+    if is_profile_fan_out(args):
+        if any(
+            getattr(args, key, None) is not None
+            for key in [
+                "secret",
+                "auth_token",
+                "user_id",
+                "password",
+                "tenant_id",
+            ]
+        ):
+            parser.error("--profiles と認証情報は同時に指定できません")
+        if args.cache:
+            parser.error("--cache と --profiles は同時に指定できません")
+        if getattr(args, "regions", None) or getattr(
+            args, "all_regions", False
+        ):
+            parser.error("--regions と --profiles は同時に指定できません")
+        if args.pretend:
+            parser.error("--pretend と --profiles は同時に指定できません")
+
+
+def create_api(args):
+    endpoints = {
+        service: getattr(args, "{}_url".format(service))
+        for service in ["identity", "compute", "image"]
+        if getattr(args, "{}_url".format(service)) is not None
+    }
     if args.pretend:
-        api = FakeConohaRestApi()
+        api = FakeConohaRestApi(endpoints=endpoints)
     else:
-        api = ConohaRestApi()
+        api = ConohaRestApi(pool_size=args.pool_size, endpoints=endpoints)
+
+    api.retry = RetryPolicy(
+        retries=args.retries,
+        backoff=args.retry_backoff,
+        max_delay=args.retry_max_delay,
+        retry_actions=args.retry_actions,
+        breaker_threshold=args.breaker_threshold,
+        breaker_reset=args.breaker_reset,
+    )
+    if args.rate_limit:
+        api.limiter = RateLimiter(args.rate_limit)
+    return api
+
+
+def execute(argv, cwd=None, apis=None, environ=os.environ):
+    parser = create_parser(argv, environ)
+    args = parser.parse_args(argv)
+    func = args.func.__name__
+    validate_arguments(parser, args)
+
+    if cwd is not None:
+        for option in PATH_OPTIONS:
+            value = getattr(args, option, None)
+            if value is not None and value != "-":
+                setattr(args, option, os.path.join(cwd, value))
+
+    args.apis = apis
+    if apis is None:
+        api = create_api(args)
+    else:
+        key = tuple(repr(getattr(args, option)) for option in API_OPTIONS)
+        api = apis.get(key, partial(create_api, args))
+
+    # a warm api is shared between requests, only a local run traces
+    sinks = []
+    if apis is None and args.trace is not None:
+        sinks.append(NdjsonSink(args.trace))
+    if apis is None and args.chrome_trace is not None:
+        sinks.append(ChromeTraceSink(args.chrome_trace))
+    if apis is None and args.timings:
+        sinks.append(TimingSink())
+    if sinks:
+        api.tracer = Tracer(sinks)
+
+    try:
+        with writing(args.output, args.fields):
+            if api.tracer is None:
+                failed = args.func(api, args)
+            else:
+                with api.tracer.span(func, "cli"):
+                    failed = args.func(api, args)
+    # the regions are only known once the catalog is fetched
+    except UnknownRegionError as error:
+        parser.error(
+            "不明なリージョンです: {} (指定できるリージョン: {})".format(
+                error.region, ", ".join(error.regions)
+            )
+        )
+    finally:
+        if api.tracer is not None:
+            api.tracer.close()
+        if apis is None and api.retry.retried:
+            print("retries: {}".format(api.retry.retried), file=sys.stderr)
+    return 1 if failed else 0
 
-    args.func(api, args)
+
+def environment_arguments(environ):
+    arguments = []
+    for service in ["identity", "compute", "image"]:
+        url = environ.get("CONOHA_{}_URL".format(service.upper()))
+        if url:
+            arguments += ["--{}-url".format(service), url]
+    if environ.get("CONOHA_REGION"):
+        arguments += ["--region", environ["CONOHA_REGION"]]
+    if environ.get("CONOHA_PROFILES"):
+        arguments += ["--profiles-file", environ["CONOHA_PROFILES"]]
+    return arguments
+
+
+# "-" as a value, given either way, reads the caller's stdin
+def reads_stdin(argv):
+    return any(arg == "-" or arg.partition("=")[2] == "-" for arg in argv)
+
+
+def is_forwardable(argv):
+    group, _ = selected_command(argv)
+    # a batch swaps the process wide stdout, it runs in its own process
+    if group in [None, "daemon", "batch"] or reads_stdin(argv):
+        return False
+    return not any(arg.partition("=")[0] in LOCAL_OPTIONS for arg in argv)
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    status = None
+    if is_forwardable(argv):
+        from conoha.daemon import forward
+
+        status = forward(environment_arguments(os.environ) + argv)
+    if status is None:
+        status = execute(argv)
+    if status:
+        sys.exit(status)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,544 @@
+import asyncio
+import inspect
+import os
+import ssl
+import sys
+from abc import ABC, abstractmethod
+from email.parser import BytesParser
+from functools import partial
+from http.client import HTTPMessage
+from io import BytesIO
+from urllib.error import HTTPError
+from urllib.parse import urlsplit
+
+from conoha.command import LoadSecret, SaveSecret
+from conoha.conoha import (
+    ConohaRestApi,
+    RestApi,
+    check_replayable,
+    image_record,
+    server_record,
+    server_summary,
+)
+from conoha.digest import find_duplicate_image
+from conoha.inventory import changes_since
+from conoha.pagination import apaginate
+from conoha.retry import RetryPolicy
+from conoha.secret import (
+    has_credentials,
+    load_secret,
+    needs_token,
+    save_secret,
+    secret_lock,
+)
+from conoha.transport import (
+    Response,
+    find_proxy,
+    proxy_address,
+    proxy_headers,
+)
+from conoha.upload import source_size
+
+DEFAULT_CONCURRENCY = 64
+
+CHUNK_SIZE = 64 * 1024
+
+
+class AsyncConnectionPool:
+    def __init__(
+        self,
+        pool_size=DEFAULT_CONCURRENCY,
+        concurrency=DEFAULT_CONCURRENCY,
+        context=None,
+    ):
+        self.pool_size = pool_size
+        self.concurrency = concurrency
+        self.context = context
+        self.__idle = {}
+        self.__proxies = {}
+        self.__semaphore = None
+
+    @property
+    def semaphore(self):
+        if self.__semaphore is None:
+            self.__semaphore = asyncio.Semaphore(self.concurrency)
+        return self.__semaphore
+
+    def proxy(self, scheme, hostname, port):
+        key = (scheme, hostname, port)
+        if key not in self.__proxies:
+            host = hostname if port is None else "{}:{}".format(hostname, port)
+            self.__proxies[key] = find_proxy(scheme, host)
+        return self.__proxies[key]
+
+    async def connect(self, scheme, hostname, port):
+        proxy = self.proxy(scheme, hostname, port)
+        if scheme == "https":
+            if self.context is None:
+                self.context = ssl.create_default_context()
+            if proxy is not None:
+                return await self.tunnel(proxy, hostname, port or 443)
+            return await asyncio.open_connection(
+                hostname, port or 443, ssl=self.context
+            )
+        if proxy is not None:
+            return await asyncio.open_connection(*proxy_address(proxy))
+        return await asyncio.open_connection(hostname, port or 80)
+
+    # TLS to the server inside a CONNECT tunnel, as http.client does
+    async def tunnel(self, proxy, hostname, port):
+        reader, writer = await asyncio.open_connection(*proxy_address(proxy))
+        authority = "{}:{}".format(
+            "[{}]".format(hostname) if ":" in hostname else hostname, port
+        )
+        lines = [
+            "CONNECT {} HTTP/1.1".format(authority),
+            "Host: {}".format(authority),
+        ]
+        for name, value in proxy_headers(proxy).items():
+            lines.append("{}: {}".format(name, value))
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+        await writer.drain()
+        status_line = (await reader.readuntil(b"\r\n")).decode("latin-1")
+        while await reader.readuntil(b"\r\n") != b"\r\n":
+            pass
+        if status_line.split(" ", 2)[1:2] != ["200"]:
+            writer.close()
+            raise OSError(
+                "Tunnel connection failed: {}".format(
+                    status_line.split(" ", 1)[-1].strip()
+                )
+            )
+        await writer.start_tls(self.context, server_hostname=hostname)
+        return reader, writer
+
+    async def acquire(self, key):
+        idle = self.__idle.get(key)
+        while idle:
+            reader, writer = idle.pop()
+            if not reader.at_eof() and not writer.is_closing():
+                return (reader, writer), True
+            writer.close()
+        return await self.connect(*key), False
+
+    def release(self, key, connection):
+        idle = self.__idle.setdefault(key, [])
+        if len(idle) < self.pool_size:
+            idle.append(connection)
+        else:
+            connection[1].close()
+
+    async def close(self):
+        idle, self.__idle = self.__idle, {}
+        for connections in idle.values():
+            for _, writer in connections:
+                writer.close()
+                await writer.wait_closed()
+
+    async def urlopen(self, request):
+        url = urlsplit(request.full_url)
+        key = (url.scheme, url.hostname, url.port)
+        body = request.data
+        position = body.tell() if hasattr(body, "seek") else None
+        async with self.semaphore:
+            while True:
+                connection, reused = await self.acquire(key)
+                try:
+                    await self.send(connection, request, body)
+                    status, reason, headers, payload, keep_alive = (
+                        await self.receive(connection, request)
+                    )
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    connection[1].close()
+                    if not reused:
+                        raise
+                    if position is not None:
+                        body.seek(position)
+                    elif body is not None and not isinstance(body, bytes):
+                        raise
+                    continue
+                except BaseException:
+                    connection[1].close()
+                    raise
+                if keep_alive:
+                    self.release(key, connection)
+                else:
+                    connection[1].close()
+                break
+        if not 200 <= status < 300:
+            raise HTTPError(
+                request.full_url, status, reason, headers, BytesIO(payload)
+            )
+        return Response(status, reason, headers, payload)
+
+    async def send(self, connection, request, body):
+        _, writer = connection
+        headers = {
+            name.title(): value for name, value in request.header_items()
+        }
+        headers.setdefault("Host", request.host)
+        selector = request.selector
+        url = urlsplit(request.full_url)
+        proxy = self.proxy(url.scheme, url.hostname, url.port)
+        if proxy is not None and url.scheme == "http":
+            # a plain HTTP proxy is sent the absolute URL
+            selector = request.full_url
+            headers.update(proxy_headers(proxy))
+        if body is None:
+            if request.get_method() in ("POST", "PUT", "PATCH"):
+                headers["Content-Length"] = "0"
+        elif isinstance(body, bytes):
+            headers["Content-Length"] = str(len(body))
+        elif "Content-Length" not in headers:
+            headers["Transfer-Encoding"] = "chunked"
+        lines = ["{} {} HTTP/1.1".format(request.get_method(), selector)]
+        for name, value in headers.items():
+            lines.append("{}: {}".format(name, value))
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+        if isinstance(body, bytes):
+            writer.write(body)
+        elif body is not None:
+            chunked = "Transfer-Encoding" in headers
+            if hasattr(body, "read"):
+                body = iter(partial(body.read, CHUNK_SIZE), b"")
+            for chunk in body:
+                if chunked:
+                    writer.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+                else:
+                    writer.write(chunk)
+                await writer.drain()
+            if chunked:
+                writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+    async def receive(self, connection, request):
+        reader, _ = connection
+        status_line = await reader.readuntil(b"\r\n")
+        version, status, reason = (
+            status_line.decode("latin-1").rstrip("\r\n").split(" ", 2) + [""]
+        )[:3]
+        status = int(status)
+        header_lines = []
+        while (line := await reader.readuntil(b"\r\n")) != b"\r\n":
+            header_lines.append(line)
+        headers = BytesParser(_class=HTTPMessage).parsebytes(
+            b"".join(header_lines)
+        )
+        connection_header = (headers.get("Connection") or "").lower()
+        keep_alive = version == "HTTP/1.1" and connection_header != "close"
+        if (
+            request.get_method() == "HEAD"
+            or status in (204, 304)
+            or 100 <= status < 200
+        ):
+            payload = b""
+        elif (headers.get("Transfer-Encoding") or "").lower() == "chunked":
+            chunks = []
+            while size := int(
+                (await reader.readuntil(b"\r\n")).split(b";")[0], 16
+            ):
+                chunks.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+            while await reader.readuntil(b"\r\n") != b"\r\n":
+                pass
+            payload = b"".join(chunks)
+        elif headers.get("Content-Length") is not None:
+            payload = await reader.readexactly(int(headers["Content-Length"]))
+        else:
+            payload = await reader.read()
+            keep_alive = False
+        return status, reason, headers, payload, keep_alive
+
+
+# conoha.secret.renew_token for coroutines, the lock is waited for on a
+# worker thread so the other tasks keep running
+async def renew_token(context, generate, rejected=None):
+    path = context.get("secret")
+    if path is None:
+        return await generate(context)
+    lock = secret_lock(path)
+    await asyncio.to_thread(lock.__enter__)
+    try:
+        if os.path.exists(path):
+            load_secret(context)
+        if needs_token(context, rejected):
+            await generate(context)
+        save_secret(context)
+    finally:
+        lock.__exit__(None, None, None)
+
+
+class AsyncConohaRestApi(ConohaRestApi):
+    def __init__(
+        self,
+        pool_size=DEFAULT_CONCURRENCY,
+        concurrency=DEFAULT_CONCURRENCY,
+        clock=None,
+        endpoints=None,
+    ):
+        RestApi.__init__(self, clock, endpoints)
+        self.transport = AsyncConnectionPool(pool_size, concurrency)
+        self.retry = RetryPolicy()
+
+    async def urlopen(self, request):
+        send = self.transport.urlopen
+        if self.limiter is not None:
+            send = partial(self.limited_send, self.service_of(request))
+        if self.retry is None:
+            return await send(request)
+        return await self.retry.acall(request, send, self.clock)
+
+    # every attempt, retries included, takes a token from the bucket
+    async def limited_send(self, service, request):
+        return await self.limiter.acall(
+            service, request, self.transport.urlopen, self.clock
+        )
+
+    async def close(self):
+        await self.transport.close()
+
+    async def authorized_urlopen(self, context, build_request):
+        request = build_request(context)
+        try:
+            return await self.urlopen(request)
+        except HTTPError as error:
+            if error.code != 401 or not has_credentials(context):
+                raise
+            await self.refresh_token(context)
+            check_replayable(request, error)
+        return await self.urlopen(build_request(context))
+
+    async def refresh_token(self, context):
+        await renew_token(
+            context, self.generate_token, rejected=context.get("auth_token")
+        )
+
+    async def generate_token(self, context):
+        request = super().generate_token_request(context)
+        response = await self.urlopen(request)
+        self.generate_token_response(context, response)
+
+    async def list_image(self, context):
+        images = []
+        async for image in self.iter_images(context):
+            image = image_record(image)
+            images.append(image)
+            yield image
+        context.set("images", images)
+
+    def iter_images(self, context):
+        async def fetch_page(marker):
+            response = await self.authorized_urlopen(
+                context,
+                partial(self.list_image_request, marker=marker),
+            )
+            return self.images_page(response)
+
+        return apaginate(fetch_page, prefetch=context.get("prefetch"))
+
+    async def generate_image_id(self, context):
+        response = await self.authorized_urlopen(
+            context, super().generate_image_id_request
+        )
+        self.generate_image_id_response(context, response)
+
+    async def upload_image(self, context):
+        try:
+            response = await self.authorized_urlopen(
+                context, super().upload_image_request
+            )
+            self.upload_image_response(context, response)
+        finally:
+            self.close_upload_source(context)
+
+    async def find_uploaded_image(self, context):
+        iso_file = context.get("iso_file")
+        size = source_size(iso_file)
+        if size is None:
+            return
+        candidates = [
+            image
+            async for image in self.iter_images(context)
+            if image.get("size") == size
+            and image.get("status") == "active"
+            and image["id"] != context.get("image_id")
+        ]
+        image = await asyncio.to_thread(
+            find_duplicate_image, iso_file, candidates
+        )
+        if image is not None:
+            context.set("uploaded_image_id", image["id"])
+            print("already uploaded: {}".format(image["id"]), file=sys.stderr)
+
+    async def delete_image(self, context):
+        response = await self.authorized_urlopen(
+            context, super().delete_image_request
+        )
+        self.delete_image_response(context, response)
+
+    async def list_server(self, context):
+        server_ids = []
+        async for server in self.iter_servers(context):
+            server_ids.append(server["id"])
+            yield server_record(server)
+        context.set("server_ids", server_ids)
+
+    async def list_server_detail(self, context):
+        servers = []
+        async for server in self.iter_servers(context, detail=True):
+            server = server_summary(server)
+            servers.append(server)
+            yield server
+        context.set("servers", servers)
+        context.set("server_ids", [server["id"] for server in servers])
+
+    def iter_servers(self, context, detail=False):
+        if detail:
+            build_request = self.list_server_detail_request
+        else:
+            build_request = self.list_server_request
+
+        async def fetch_page(marker):
+            response = await self.authorized_urlopen(
+                context, partial(build_request, marker=marker)
+            )
+            return self.servers_page(response)
+
+        return apaginate(fetch_page, prefetch=context.get("prefetch"))
+
+    async def wait_servers(self, context, server_ids, status):
+        poll_context = self.wait_servers_context(context)
+        waiter = self.waiter(context, [status])
+        delays = waiter.delays()
+        started = self.clock.monotonic()
+        pending = set(server_ids)
+        first = True
+        while True:
+            async for server in self.iter_servers(poll_context, detail=True):
+                if server["id"] not in pending:
+                    continue
+                finished = self.finished_status(server, status)
+                if finished is None:
+                    continue
+                pending.discard(server["id"])
+                elapsed = self.clock.monotonic() - started
+                if finished == status and not first:
+                    self.transitions.record(status, elapsed)
+                yield server["id"], finished, elapsed
+            if not pending:
+                return
+            first = False
+            try:
+                delay = next(delays)
+            except TimeoutError:
+                return
+            await asyncio.sleep(delay)
+
+    async def sync_servers(self, context, inventory):
+        sync_context = context.copy()
+        since = inventory.since("servers")
+        sync_context.set("changes_since", since)
+        started = changes_since()
+        servers = [
+            server_summary(server)
+            async for server in self.iter_servers(sync_context, detail=True)
+        ]
+        inventory.update_servers(servers, started, full=since is None)
+
+    async def sync_images(self, context, inventory):
+        images = [image async for image in self.iter_images(context)]
+        inventory.update_images(images)
+
+    async def start_server(self, context):
+        response = await self.authorized_urlopen(
+            context, super().start_server_request
+        )
+        self.start_server_response(context, response)
+
+    async def stop_server(self, context):
+        response = await self.authorized_urlopen(
+            context, super().stop_server_request
+        )
+        self.stop_server_response(context, response)
+
+    async def stop_server_and_wait(self, context):
+        context.set("server_status", None)
+        await self.get_server_status(context)
+        if context.get("server_status") not in ["SHUTOFF"]:
+            await self.stop_server(context)
+            print("waiting for shutdown...", file=sys.stderr)
+            await self.wait_server_status(context, ["SHUTOFF"])
+        print("server shutdown completed", file=sys.stderr)
+
+    async def wait_server_status(self, context, statuses):
+        waiter = self.waiter(context, statuses)
+        for delay in waiter.delays():
+            await asyncio.sleep(delay)
+            await self.get_server_status(context)
+            if self.check_server_status(context, statuses):
+                return waiter.done()
+
+    async def get_server_status(self, context):
+        response = await self.authorized_urlopen(
+            context, super().get_server_status_request
+        )
+        self.get_server_status_response(context, response)
+
+    async def get_server_console(self, context):
+        response = await self.authorized_urlopen(
+            context, super().get_server_console_request
+        )
+        self.get_server_console_response(context, response)
+
+    async def mount_image(self, context):
+        response = await self.authorized_urlopen(
+            context, super().mount_image_request
+        )
+        self.mount_image_response(context, response)
+
+    async def unmount_image(self, context):
+        response = await self.authorized_urlopen(
+            context, super().unmount_image_request
+        )
+        self.unmount_image_response(context, response)
+
+
+class AsyncCommand(ABC):
+    @abstractmethod
+    async def execute(self, receiver, context):
+        pass
+
+
+class AsyncCompositeCommand(AsyncCommand):
+    def __init__(self):
+        self.__commands = []
+
+    def append(self, command):
+        self.__commands.append(command)
+
+    async def execute(self, receiver, context):
+        for command in self.__commands:
+            result = command.execute(receiver, context)
+            if inspect.isawaitable(result):
+                await result
+
+
+class AsyncRenewToken(AsyncCommand):
+    async def execute(self, receiver, context):
+        if needs_token(context):
+            await renew_token(context, receiver.generate_token)
+
+
+class AsyncLoadToken(AsyncCompositeCommand):
+    def __init__(self):
+        super().__init__()
+        super().append(LoadSecret())
+        super().append(AsyncRenewToken())
+        super().append(SaveSecret())
+
+
+async def fan_out(receiver, command, contexts):
+    return await asyncio.gather(
+        *(command.execute(receiver, context) for context in contexts),
+        return_exceptions=True,
+    )
@@ -0,0 +1,174 @@
+import json
+
+from conoha.command import (
+    CheckUploadSource,
+    DeleteImage,
+    FindUploadedImage,
+    GenerateImageId,
+    GetServerConsole,
+    GetServerStatus,
+    GraphCommand,
+    ListImage,
+    ListServer,
+    ListServerDetail,
+    MountImage,
+    StartServer,
+    StopServerAndWait,
+    UnmountImage,
+    UploadImage,
+    WaitServerStatus,
+)
+from conoha.output import discarding
+from conoha.upload import DEFAULT_PROGRESS_INTERVAL
+
+DEFAULT_PARALLEL = 1
+
+# record fields copied into the operation's context
+RECORD_KEYS = [
+    "server_id",
+    "image_name",
+    "image_id",
+    "iso_file",
+    "filter_status",
+    "filter_name",
+    "page_size",
+    "timeout",
+    "chunk_size",
+    "zero_copy",
+    "progress_interval",
+]
+
+
+def list_server_command(record):
+    if record.get("detail"):
+        return ListServerDetail()
+    return ListServer()
+
+
+def upload_image_command(record):
+    command = GraphCommand()
+    command.append(CheckUploadSource())
+    if not record.get("force"):
+        command.append(FindUploadedImage())
+    command.append(UploadImage())
+    return command
+
+
+def mount_image_command(record):
+    command = GraphCommand()
+    command.append(StopServerAndWait())
+    command.append(MountImage())
+    command.append(WaitServerStatus("RESCUE"))
+    return command
+
+
+def unmount_image_command(record):
+    command = GraphCommand()
+    command.append(UnmountImage())
+    command.append(WaitServerStatus("ACTIVE"))
+    return command
+
+
+def list_server_result(record):
+    if record.get("detail"):
+        return "servers"
+    return "server_ids"
+
+
+# op: (builds the command for a record, context key reported as result, or
+# a function picking it from the record)
+OPERATIONS = {
+    "server.list": (list_server_command, list_server_result),
+    "server.start": (lambda record: StartServer(), None),
+    "server.stop": (lambda record: StopServerAndWait(), None),
+    "server.status": (lambda record: GetServerStatus(), "server_status"),
+    "server.console": (lambda record: GetServerConsole(), "console_url"),
+    "image.list": (lambda record: ListImage(), "images"),
+    "image.generate": (lambda record: GenerateImageId(), "image_id"),
+    "image.upload": (upload_image_command, "uploaded_image_id"),
+    "image.delete": (lambda record: DeleteImage(), None),
+    "image.mount": (mount_image_command, None),
+    "image.unmount": (unmount_image_command, None),
+}
+
+
+def parse_record(line):
+    record = json.loads(line)
+    if not isinstance(record, dict):
+        raise ValueError("operation must be a JSON object")
+    if record.get("op") not in OPERATIONS:
+        raise ValueError("unknown op: {}".format(record.get("op")))
+    return record
+
+
+class BatchExecutor:
+    def __init__(self, receiver, parallel=DEFAULT_PARALLEL):
+        self.receiver = receiver
+        self.parallel = parallel
+
+    def operation_context(self, context, record):
+        operation_context = context.copy()
+        operation_context.set("progress_interval", DEFAULT_PROGRESS_INTERVAL)
+        for key in RECORD_KEYS:
+            if key in record:
+                operation_context.set(key, record[key])
+        return operation_context
+
+    def run(self, context, number, line):
+        result = {"line": number}
+        try:
+            record = parse_record(line)
+            for key in ["id", "op", "server_id", "image_id"]:
+                if key in record:
+                    result[key] = record[key]
+            build, key = OPERATIONS[record["op"]]
+            operation_context = self.operation_context(context, record)
+            # records are reported in the result, not written out
+            with discarding():
+                build(record).execute(self.receiver, operation_context)
+        except Exception as error:
+            result["ok"] = False
+            result["error"] = str(error)
+            return result
+        result["ok"] = True
+        if callable(key):
+            key = key(record)
+        if key is not None:
+            result["result"] = operation_context.get(key)
+        # a token refreshed by one operation is reused by the next ones
+        if operation_context.get("auth_token") != context.get("auth_token"):
+            context.set("auth_token", operation_context.get("auth_token"))
+            context.set("expires_at", operation_context.get("expires_at"))
+            context.set("catalog", operation_context.get("catalog"))
+        return result
+
+    def execute(self, context, lines):
+        import contextvars
+        from concurrent.futures import (
+            FIRST_COMPLETED,
+            ThreadPoolExecutor,
+            as_completed,
+            wait,
+        )
+
+        with ThreadPoolExecutor(max_workers=self.parallel) as executor:
+            pending = set()
+            for number, line in enumerate(lines, 1):
+                if not line.strip():
+                    continue
+                # keep reading lazily so a streamed batch starts at once
+                if len(pending) >= self.parallel:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield future.result()
+                pending.add(
+                    executor.submit(
+                        contextvars.copy_context().run,
+                        self.run,
+                        context,
+                        number,
+                        line,
+                    )
+                )
+            for future in as_completed(pending):
+                yield future.result()
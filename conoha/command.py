@@ -1,13 +1,58 @@
-import json
 from abc import ABC, abstractmethod
 
+from conoha.conoha import image_record, server_record
+from conoha.output import emit
+from conoha.secret import (
+    load_secret,
+    needs_token,
+    renew_token,
+    save_secret,
+    secret_lock,
+)
+
+DEFAULT_GRAPH_WORKERS = 4
+
+TOKEN_KEYS = ("auth_token", "expires_at", "catalog")
+
+CREDENTIAL_KEYS = TOKEN_KEYS + ("user_id", "password", "tenant_id")
+
+# besides context keys, "secret_file", "server" and "image" stand for the
+# secret file and the remote server and image a command changes
+
 
 class Command(ABC):
+    # context keys the command reads and writes, None is unknown and
+    # orders the command after and before everything in a GraphCommand
+    reads = None
+    writes = None
+
     @abstractmethod
     def execute(self, receiver, context):
         pass
 
 
+# the receiver's list_* methods return records, sync or async iterables,
+# and the commands write them out
+def emit_records(records):
+    if hasattr(records, "__aiter__"):
+        return aemit_records(records)
+    for record in records:
+        emit(record)
+
+
+async def aemit_records(records):
+    async for record in records:
+        emit(record)
+
+
+def run_command(command, receiver, context):
+    tracer = getattr(receiver, "tracer", None)
+    if tracer is None:
+        return command.execute(receiver, context)
+    with tracer.span(type(command).__name__, "command"):
+        return command.execute(receiver, context)
+
+
 class Context:
     def __init__(self, params):
         self.__context = {}
@@ -29,6 +74,26 @@ class Context:
             self.set("image_id", params.image_id)
         if hasattr(params, "iso_file"):
             self.set("iso_file", params.iso_file)
+        if hasattr(params, "filter_status"):
+            self.set("filter_status", params.filter_status)
+        if hasattr(params, "filter_name"):
+            self.set("filter_name", params.filter_name)
+        if hasattr(params, "page_size"):
+            self.set("page_size", params.page_size)
+        if hasattr(params, "prefetch"):
+            self.set("prefetch", params.prefetch)
+        if hasattr(params, "max_age"):
+            self.set("max_age", params.max_age)
+        if hasattr(params, "chunk_size"):
+            self.set("chunk_size", params.chunk_size)
+        if hasattr(params, "zero_copy"):
+            self.set("zero_copy", params.zero_copy)
+        if hasattr(params, "progress_interval"):
+            self.set("progress_interval", params.progress_interval)
+        if hasattr(params, "timeout"):
+            self.set("timeout", params.timeout)
+        if hasattr(params, "region"):
+            self.set("region", params.region)
 
     def set(self, key, value):
         self.__context[key] = value
@@ -36,6 +101,15 @@ class Context:
     def get(self, key):
         return self.__context.get(key)
 
+    def copy(self):
+        context = Context(None)
+        for key, value in self.__context.items():
+            context.set(key, value)
+        return context
+
+    def items(self):
+        return list(self.__context.items())
+
 
 class CompositeCommand(Command):
     def __init__(self):
@@ -44,108 +118,404 @@ class CompositeCommand(Command):
     def append(self, command):
         self.__commands.append(command)
 
+    def commands(self):
+        return list(self.__commands)
+
+    @property
+    def reads(self):
+        return merged_keys(command.reads for command in self.__commands)
+
+    @property
+    def writes(self):
+        return merged_keys(command.writes for command in self.__commands)
+
     def execute(self, receiver, context):
         for command in self.__commands:
-            command.execute(receiver, context)
+            run_command(command, receiver, context)
+
+
+def merged_keys(key_sets):
+    merged = set()
+    for keys in key_sets:
+        if keys is None:
+            return None
+        merged.update(keys)
+    return tuple(sorted(merged))
+
+
+def conflicts(earlier, later):
+    if None in [earlier.reads, earlier.writes, later.reads, later.writes]:
+        return True
+    writes = set(earlier.writes)
+    return bool(
+        writes & set(later.reads)
+        or writes & set(later.writes)
+        or set(earlier.reads) & set(later.writes)
+    )
+
+
+class GraphCommand(CompositeCommand):
+    def __init__(self, max_workers=DEFAULT_GRAPH_WORKERS):
+        super().__init__()
+        self.max_workers = max_workers
+
+    def dependencies(self, commands):
+        return [
+            {
+                index
+                for index, earlier in enumerate(commands[:position])
+                if conflicts(earlier, command)
+            }
+            for position, command in enumerate(commands)
+        ]
+
+    def run(self, receiver, command, context):
+        before = dict(context.items())
+        run_command(command, receiver, context)
+        return {
+            key: value
+            for key, value in context.items()
+            if key not in before or before[key] is not value
+        }
+
+    def sequential(self, dependencies):
+        return all(
+            index - 1 in dependencies[index]
+            for index in range(1, len(dependencies))
+        )
+
+    # each command runs on a copy of the context once the commands it
+    # depends on are merged; when commands running side by side set the
+    # same key, the one appended last wins whichever finishes first.
+    # a chain with nothing to run side by side stays on the calling thread
+    # so Ctrl-C stops it at once
+    def execute(self, receiver, context):
+        import contextvars
+        import threading
+        from concurrent.futures import (
+            FIRST_COMPLETED,
+            ThreadPoolExecutor,
+            wait,
+        )
+
+        commands = self.commands()
+        dependencies = self.dependencies(commands)
+        if self.sequential(dependencies):
+            for command in commands:
+                run_command(command, receiver, context)
+            return
+        cancelled = context.get("cancelled") or threading.Event()
+        owners = {}
+        started = set()
+        finished = set()
+        errors = {}
+        running = {}
+        interrupted = False
+        executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        try:
+            while True:
+                for index, command in enumerate(commands):
+                    if (
+                        errors
+                        or index in started
+                        or not dependencies[index] <= finished
+                    ):
+                        continue
+                    started.add(index)
+                    command_context = context.copy()
+                    command_context.set("cancelled", cancelled)
+                    future = executor.submit(
+                        contextvars.copy_context().run,
+                        self.run,
+                        receiver,
+                        command,
+                        command_context,
+                    )
+                    running[future] = index
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in sorted(done, key=running.get):
+                    index = running.pop(future)
+                    finished.add(index)
+                    if future.exception() is not None:
+                        errors[index] = future.exception()
+                        continue
+                    for key, value in future.result().items():
+                        if owners.get(key, -1) <= index:
+                            owners[key] = index
+                            context.set(key, value)
+        except KeyboardInterrupt:
+            # wake the waiters and drop what has not started yet
+            interrupted = True
+            cancelled.set()
+            raise
+        finally:
+            executor.shutdown(wait=not interrupted, cancel_futures=interrupted)
+        if errors:
+            raise errors[min(errors)]
 
 
 class GenerateToken(Command):
+    reads = CREDENTIAL_KEYS
+    writes = TOKEN_KEYS
+
     def __init__(self, force=False):
         self.force = force
 
     def execute(self, receiver, context):
-        if context.get("auth_token") is None or self.force:
-            receiver.generate_token(context)
+        if self.force or needs_token(context):
+            return receiver.generate_token(context)
+
+
+class RenewToken(Command):
+    reads = CREDENTIAL_KEYS + ("secret", "secret_file")
+    writes = CREDENTIAL_KEYS + ("secret_file",)
+
+    def execute(self, receiver, context):
+        if needs_token(context):
+            return renew_token(context, receiver.generate_token)
 
 
 class SaveSecret(Command):
+    reads = CREDENTIAL_KEYS + ("secret",)
+    writes = ("secret_file",)
+
     def execute(self, receiver, context):
         if context.get("secret") is not None:
-            secrets = {
-                "auth_token": context.get("auth_token"),
-                "user_id": context.get("user_id"),
-                "password": context.get("password"),
-                "tenant_id": context.get("tenant_id"),
-            }
-            with open(context.get("secret"), "w") as fp:
-                json.dump(secrets, fp, indent=2, sort_keys=True)
+            with secret_lock(context.get("secret")):
+                save_secret(context)
 
 
 class LoadSecret(Command):
+    reads = ("secret", "secret_file")
+    writes = CREDENTIAL_KEYS
+
     def execute(self, receiver, context):
         if context.get("secret") is not None:
-            with open(context.get("secret"), "r") as fp:
-                secrets = json.load(fp)
-            context.set("auth_token", secrets.get("auth_token"))
-            for key in ["user_id", "password", "tenant_id"]:
-                if secrets[key]:
-                    context.set(key, secrets[key])
+            load_secret(context)
 
 
 class LoadToken(CompositeCommand):
     def __init__(self):
         super().__init__()
         super().append(LoadSecret())
-        super().append(GenerateToken())
+        super().append(RenewToken())
         super().append(SaveSecret())
 
 
 class GenerateImageId(Command):
+    reads = TOKEN_KEYS + ("image_id", "image_name")
+    writes = ("image_id",)
+
     def execute(self, receiver, context):
         if context.get("image_id") is None:
-            receiver.generate_image_id(context)
+            return receiver.generate_image_id(context)
+
+
+class CheckUploadSource(Command):
+    reads = ("iso_file",)
+    writes = ()
+
+    # fails on a missing or unreadable file, alongside the token request
+    # rather than after it
+    def execute(self, receiver, context):
+        iso_file = context.get("iso_file")
+        if iso_file != "-":
+            with open(iso_file, "rb"):
+                pass
+
+
+class FindUploadedImage(Command):
+    reads = TOKEN_KEYS + ("iso_file", "image_id", "page_size", "prefetch")
+    writes = ("uploaded_image_id",)
+
+    def execute(self, receiver, context):
+        return receiver.find_uploaded_image(context)
 
 
 class UploadImage(Command):
+    reads = TOKEN_KEYS + (
+        "image_id",
+        "iso_file",
+        "uploaded_image_id",
+        "chunk_size",
+        "zero_copy",
+        "progress_interval",
+    )
+    writes = ("upload_source", "image", "digests")
+
     def execute(self, receiver, context):
-        receiver.upload_image(context)
+        if context.get("uploaded_image_id") is None:
+            return receiver.upload_image(context)
 
 
 class DeleteImage(Command):
+    reads = TOKEN_KEYS + ("image_id", "inventory")
+    writes = ("image",)
+
     def execute(self, receiver, context):
-        receiver.delete_image(context)
+        deleted = receiver.delete_image(context)
+        if hasattr(deleted, "__await__"):
+            return self.aforget(deleted, context)
+        self.forget(context)
+
+    async def aforget(self, deleted, context):
+        await deleted
+        self.forget(context)
+
+    def forget(self, context):
+        inventory = context.get("inventory")
+        if inventory is not None:
+            inventory.delete_image(context.get("image_id"))
 
 
 class ListServer(Command):
+    reads = TOKEN_KEYS + ("page_size", "prefetch")
+    writes = ("server_ids",)
+
+    def execute(self, receiver, context):
+        return emit_records(receiver.list_server(context))
+
+
+class ListServerDetail(Command):
+    reads = TOKEN_KEYS + ("page_size", "prefetch")
+    writes = ("servers", "server_ids")
+
     def execute(self, receiver, context):
-        receiver.list_server(context)
+        return emit_records(receiver.list_server_detail(context))
+
+
+class SyncServers(Command):
+    reads = CREDENTIAL_KEYS + ("inventory", "max_age", "secret", "secret_file")
+    writes = CREDENTIAL_KEYS + ("inventory", "secret_file")
+
+    def execute(self, receiver, context):
+        inventory = context.get("inventory")
+        if not inventory.is_fresh("servers", context.get("max_age")):
+            LoadToken().execute(receiver, context)
+            return receiver.sync_servers(context, inventory)
+
+
+class ListCachedServer(Command):
+    reads = ("inventory", "filter_status", "filter_name")
+    writes = ("servers", "server_ids")
+
+    def __init__(self, detail=False):
+        self.detail = detail
+
+    def execute(self, receiver, context):
+        servers = [
+            server
+            for server in context.get("inventory").servers()
+            if context.get("filter_status") in (None, server["status"])
+            and context.get("filter_name") in (None, server["name"])
+        ]
+        for server in servers:
+            if self.detail:
+                emit(server)
+            else:
+                emit(server_record(server))
+        context.set("servers", servers)
+        context.set("server_ids", [server["id"] for server in servers])
 
 
 class StartServer(Command):
+    reads = TOKEN_KEYS + ("server_id",)
+    writes = ("server",)
+
     def execute(self, receiver, context):
-        receiver.start_server(context)
+        return receiver.start_server(context)
 
 
 class StopServer(Command):
+    reads = TOKEN_KEYS + ("server_id",)
+    writes = ("server",)
+
     def execute(self, receiver, context):
-        receiver.stop_server(context)
+        return receiver.stop_server(context)
 
 
 class StopServerAndWait(Command):
+    reads = TOKEN_KEYS + ("server_id", "timeout")
+    writes = ("server", "server_status")
+
+    def execute(self, receiver, context):
+        return receiver.stop_server_and_wait(context)
+
+
+class WaitServerStatus(Command):
+    reads = TOKEN_KEYS + ("server_id", "timeout", "server")
+    writes = ("server_status",)
+
+    def __init__(self, *statuses):
+        self.statuses = list(statuses)
+
     def execute(self, receiver, context):
-        receiver.stop_server_and_wait(context)
+        return receiver.wait_server_status(context, self.statuses)
 
 
 class GetServerStatus(Command):
+    reads = TOKEN_KEYS + ("server_id", "server")
+    writes = ("server_status",)
+
     def execute(self, receiver, context):
-        receiver.get_server_status(context)
+        return receiver.get_server_status(context)
 
 
 class GetServerConsole(Command):
+    reads = TOKEN_KEYS + ("server_id", "server")
+    writes = ("console_url",)
+
     def execute(self, receiver, context):
-        receiver.get_server_console(context)
+        return receiver.get_server_console(context)
 
 
 class ListImage(Command):
+    reads = TOKEN_KEYS + ("page_size", "prefetch", "image")
+    writes = ("images",)
+
     def execute(self, receiver, context):
-        receiver.list_image(context)
+        return emit_records(receiver.list_image(context))
+
+
+class SyncImages(Command):
+    reads = CREDENTIAL_KEYS + (
+        "inventory",
+        "max_age",
+        "secret",
+        "secret_file",
+        "image",
+    )
+    writes = CREDENTIAL_KEYS + ("inventory", "secret_file")
+
+    def execute(self, receiver, context):
+        inventory = context.get("inventory")
+        if not inventory.is_fresh("images", context.get("max_age")):
+            LoadToken().execute(receiver, context)
+            return receiver.sync_images(context, inventory)
+
+
+class ListCachedImage(Command):
+    reads = ("inventory",)
+    writes = ()
+
+    def execute(self, receiver, context):
+        for image in context.get("inventory").images():
+            emit(image_record(image))
 
 
 class MountImage(Command):
+    reads = TOKEN_KEYS + ("server_id", "image_id", "image")
+    writes = ("server", "admin_pass")
+
     def execute(self, receiver, context):
-        receiver.mount_image(context)
+        return receiver.mount_image(context)
 
 
 class UnmountImage(Command):
+    reads = TOKEN_KEYS + ("server_id",)
+    writes = ("server",)
+
     def execute(self, receiver, context):
-        receiver.unmount_image(context)
+        return receiver.unmount_image(context)
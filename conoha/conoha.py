@@ -1,19 +1,204 @@
 import json
-import time
+import sys
 from abc import ABC, abstractmethod
-from urllib.request import Request, urlopen
+from functools import partial
+from urllib.parse import urlencode, urlsplit
+
+from conoha.digest import find_duplicate_image
+from conoha.inventory import changes_since
+from conoha.pagination import paginate
+from conoha.retry import RetryPolicy
+from conoha.secret import has_credentials, renew_token
+from conoha.transport import DEFAULT_POOL_SIZE, ConnectionPool
+from conoha.upload import (
+    DEFAULT_CHUNK_SIZE,
+    Progress,
+    UploadSource,
+    ZeroCopySource,
+    source_size,
+)
+from conoha.wait import (
+    DEFAULT_TIMEOUT,
+    SystemClock,
+    TransitionHistory,
+    Waiter,
+)
 
 USER_AGENT = "curl/8.4.0"
 
+ENDPOINTS = {
+    "identity": "https://identity.c3j1.conoha.io",
+    "compute": "https://compute.c3j1.conoha.io",
+    "image": "https://image-service.c3j1.conoha.io",
+}
+
+API_PATHS = {
+    "identity": "/v3/",
+    "compute": "/v2.1/",
+    "image": "/v2/",
+}
+
+DEFAULT_REGION = "c3j1"
+
+
+class UnknownRegionError(ValueError):
+    def __init__(self, region, regions):
+        super().__init__(
+            "unknown region: {} (available: {})".format(
+                region, ", ".join(regions)
+            )
+        )
+        self.region = region
+        self.regions = regions
+
+
+def catalog_regions(catalog):
+    return sorted(
+        {
+            endpoint["region"]
+            for entry in catalog or []
+            if entry.get("type") in API_PATHS
+            for endpoint in entry.get("endpoints", [])
+            if endpoint.get("interface") == "public"
+        }
+    )
+
+
+# catalog URLs carry the API version (and for compute the tenant), the
+# request builders add their own
+def catalog_base(service, url):
+    url = url.rstrip("/") + "/"
+    index = url.find(API_PATHS[service])
+    if index >= 0:
+        url = url[:index]
+    return url.rstrip("/")
+
+
+def catalog_endpoints(catalog, region=None):
+    regions = catalog_regions(catalog)
+    if region is None:
+        if not regions:
+            return {}
+        region = DEFAULT_REGION if DEFAULT_REGION in regions else regions[0]
+    elif region not in regions:
+        raise UnknownRegionError(region, regions)
+    endpoints = {}
+    for entry in catalog or []:
+        service = entry.get("type")
+        if service not in API_PATHS:
+            continue
+        for endpoint in entry.get("endpoints", []):
+            if (
+                endpoint.get("interface") == "public"
+                and endpoint.get("region") == region
+            ):
+                endpoints[service] = catalog_base(service, endpoint["url"])
+    return endpoints
+
+
+# rebuilding a request reopens its body, which an upload from stdin cannot
+# do; the renewed token is saved so running the command again succeeds
+def check_replayable(request, error):
+    if not getattr(request.data, "replayable", True):
+        raise RuntimeError(
+            "token was renewed but the request body cannot be sent again,"
+            " run the command again"
+        ) from error
+
+
+def server_record(server):
+    return {"id": server["id"]}
+
+
+def image_record(image):
+    return {
+        "id": image["id"],
+        "updated_at": image.get("updated_at"),
+        "name": image.get("name"),
+        "status": image.get("status"),
+    }
+
+
+def server_summary(server):
+    addresses = []
+    for network in server.get("addresses", {}).values():
+        for address in network:
+            addresses.append(address["addr"])
+    flavor = server.get("flavor", {})
+    return {
+        "id": server["id"],
+        "name": server.get("name"),
+        "status": server.get("status"),
+        "addresses": addresses,
+        "flavor": flavor.get("original_name", flavor.get("id")),
+    }
+
 
 class RestApi(ABC):
+    def __init__(self, clock=None, endpoints=None):
+        self.clock = clock or SystemClock()
+        self.transitions = TransitionHistory()
+        self.endpoints = dict(ENDPOINTS)
+        self.endpoints.update(endpoints or {})
+        # explicitly configured endpoints win over the service catalog
+        self.overrides = dict(endpoints or {})
+        self.tracer = None
+        self.retry = None
+        self.limiter = None
+
+    def service_url(self, service, context=None):
+        region = None if context is None else context.get("region")
+        # an override names one host, it cannot stand in for every region;
+        # the identity service only hands out the token
+        if region is not None and service in self.overrides:
+            if service != "identity":
+                raise ValueError(
+                    "region {} cannot be used with a {} URL override".format(
+                        region, service
+                    )
+                )
+        if service in self.overrides or context is None:
+            return self.endpoints[service]
+        catalog = context.get("catalog")
+        if catalog is None:
+            # the token request that fetches the catalog goes out as is
+            if context.get("region") is not None and service != "identity":
+                raise ValueError(
+                    "no service catalog for region {}".format(
+                        context.get("region")
+                    )
+                )
+            return self.endpoints[service]
+        endpoints = catalog_endpoints(catalog, context.get("region"))
+        return endpoints.get(service, self.endpoints[service])
+
+    def endpoint_url(self, service, path, context=None):
+        return self.service_url(service, context).rstrip("/") + path
+
+    def service_of(self, request):
+        matches = []
+        for service, url in self.endpoints.items():
+            if request.full_url.startswith(url.rstrip("/") + "/"):
+                matches.append(service)
+        if len(matches) == 1:
+            return matches[0]
+        # endpoints sharing one base URL, as with the emulator, or taken
+        # from the catalog are told apart by the API version in the path
+        path = urlsplit(request.full_url).path
+        for service, version in API_PATHS.items():
+            if version in path:
+                return service
+        return None
+
     @abstractmethod
     def generate_request(self, params):
         pass
 
     def generate_token_request(self, context):
         params = {}
-        params["url"] = "https://identity.c3j1.conoha.io/v3/auth/tokens"
+        params["url"] = self.endpoint_url(
+            "identity", "/v3/auth/tokens", context
+        )
         params["method"] = "post"
         params["headers"] = {
             "User-Agent": USER_AGENT,
@@ -42,13 +227,24 @@ class RestApi(ABC):
     def generate_token(self, context):
         pass
 
-    def list_image_request(self, context):
+    def page_query(self, context, marker):
+        query = {}
+        if context.get("page_size") is not None:
+            query["limit"] = context.get("page_size")
+        if marker is not None:
+            query["marker"] = marker
+        return query
+
+    def list_image_request(self, context, marker=None):
+        query = {
+            "owner": context.get("tenant_id"),
+            "sort_key": "updated_at",
+            "sort_dir": "desc",
+        }
+        query.update(self.page_query(context, marker))
         params = {}
-        params[
-            "url"
-        ] = "https://image-service.c3j1.conoha.io/v2/images?owner={}".format(
-            context.get("tenant_id")
-        )
+        params["url"] = self.endpoint_url("image", "/v2/images", context)
+        params["url"] += "?" + urlencode(query)
         params["method"] = "get"
         params["headers"] = {
             "User-Agent": USER_AGENT,
@@ -64,7 +260,7 @@ class RestApi(ABC):
 
     def generate_image_id_request(self, context):
         params = {}
-        params["url"] = "https://image-service.c3j1.conoha.io/v2/images"
+        params["url"] = self.endpoint_url("image", "/v2/images", context)
         params["method"] = "post"
         params["headers"] = {
             "User-Agent": USER_AGENT,
@@ -91,10 +287,10 @@ class RestApi(ABC):
 
     def upload_image_request(self, context):
         params = {}
-        params[
-            "url"
-        ] = "https://image-service.c3j1.conoha.io/v2/images/{}/file".format(
-            context.get("image_id")
+        params["url"] = self.endpoint_url(
+            "image",
+            "/v2/images/{}/file".format(context.get("image_id")),
+            context,
         )
         params["method"] = "put"
         params["headers"] = {
@@ -103,19 +299,42 @@ class RestApi(ABC):
             "Content-Type": "application/octet-stream",
             "X-Auth-Token": context.get("auth_token"),
         }
-        params["payload"] = open(context.get("iso_file"), "rb")
+        self.close_upload_source(context)
+        iso_file = context.get("iso_file")
+        progress = Progress(interval=context.get("progress_interval"))
+        if context.get("zero_copy") and source_size(iso_file) is not None:
+            source = ZeroCopySource(iso_file, progress=progress)
+        else:
+            source = UploadSource(
+                iso_file,
+                chunk_size=context.get("chunk_size") or DEFAULT_CHUNK_SIZE,
+                progress=progress,
+            )
+        context.set("upload_source", source)
+        if source.size is not None:
+            params["headers"]["Content-Length"] = str(source.size)
+        params["payload"] = source
         return self.generate_request(params)
 
+    # the source is only set once the request is built, a failure before
+    # that leaves nothing to close
+    def close_upload_source(self, context):
+        source = context.get("upload_source")
+        if source is not None:
+            source.close()
+
     @abstractmethod
     def upload_image(self, context):
         pass
 
+    @abstractmethod
+    def find_uploaded_image(self, context):
+        pass
+
     def delete_image_request(self, context):
         params = {}
-        params[
-            "url"
-        ] = "https://image-service.c3j1.conoha.io/v2/images/{}".format(
-            context.get("image_id")
+        params["url"] = self.endpoint_url(
+            "image", "/v2/images/{}".format(context.get("image_id")), context
         )
         params["method"] = "delete"
         params["headers"] = {
@@ -130,9 +349,12 @@ class RestApi(ABC):
     def delete_image(self, context):
         pass
 
-    def list_server_request(self, context):
+    def list_server_request(self, context, marker=None):
+        query = self.page_query(context, marker)
         params = {}
-        params["url"] = "https://compute.c3j1.conoha.io/v2.1/servers"
+        params["url"] = self.endpoint_url("compute", "/v2.1/servers", context)
+        if query:
+            params["url"] += "?" + urlencode(query)
         params["method"] = "get"
         params["headers"] = {
             "User-Agent": USER_AGENT,
@@ -146,12 +368,47 @@ class RestApi(ABC):
     def list_server(self, context):
         pass
 
+    @abstractmethod
+    def sync_servers(self, context, inventory):
+        pass
+
+    @abstractmethod
+    def sync_images(self, context, inventory):
+        pass
+
+    def list_server_detail_request(self, context, marker=None):
+        query = self.page_query(context, marker)
+        if context.get("changes_since") is not None:
+            query["changes-since"] = context.get("changes_since")
+        if context.get("filter_status") is not None:
+            query["status"] = context.get("filter_status")
+        if context.get("filter_name") is not None:
+            query["name"] = context.get("filter_name")
+        params = {}
+        params["url"] = self.endpoint_url(
+            "compute", "/v2.1/servers/detail", context
+        )
+        if query:
+            params["url"] += "?" + urlencode(query)
+        params["method"] = "get"
+        params["headers"] = {
+            "User-Agent": USER_AGENT,
+            "Accept": "application/json",
+            "X-Auth-Token": context.get("auth_token"),
+        }
+        params["payload"] = None
+        return self.generate_request(params)
+
+    @abstractmethod
+    def list_server_detail(self, context):
+        pass
+
     def start_server_request(self, context):
         params = {}
-        params[
-            "url"
-        ] = "https://compute.c3j1.conoha.io/v2.1/servers/{}/action".format(
-            context.get("server_id")
+        params["url"] = self.endpoint_url(
+            "compute",
+            "/v2.1/servers/{}/action".format(context.get("server_id")),
+            context,
         )
         params["method"] = "post"
         params["headers"] = {
@@ -172,10 +429,10 @@ class RestApi(ABC):
 
     def stop_server_request(self, context):
         params = {}
-        params[
-            "url"
-        ] = "https://compute.c3j1.conoha.io/v2.1/servers/{}/action".format(
-            context.get("server_id")
+        params["url"] = self.endpoint_url(
+            "compute",
+            "/v2.1/servers/{}/action".format(context.get("server_id")),
+            context,
         )
         params["method"] = "post"
         params["headers"] = {
@@ -197,19 +454,57 @@ class RestApi(ABC):
     def stop_server_and_wait(self, context):
         context.set("server_status", None)
         self.get_server_status(context)
-        while context.get("server_status") not in ["SHUTOFF"]:
+        if context.get("server_status") not in ["SHUTOFF"]:
             self.stop_server(context)
-            print("waiting for shutdown...")
-            time.sleep(10)
+            print("waiting for shutdown...", file=sys.stderr)
+            self.wait_server_status(context, ["SHUTOFF"])
+        print("server shutdown completed", file=sys.stderr)
+
+    def waiter(self, context, statuses):
+        timeout = context.get("timeout")
+        return Waiter(
+            statuses[0],
+            clock=self.clock,
+            timeout=DEFAULT_TIMEOUT if timeout is None else timeout,
+            history=self.transitions,
+            cancelled=context.get("cancelled"),
+        )
+
+    def check_server_status(self, context, statuses):
+        server_status = context.get("server_status")
+        if server_status == "ERROR":
+            raise RuntimeError(
+                "server {} is in ERROR state".format(context.get("server_id"))
+            )
+        return server_status in statuses
+
+    def wait_server_status(self, context, statuses):
+        def poll():
             self.get_server_status(context)
-        print("server shutdown completed")
+            return self.check_server_status(context, statuses)
+
+        return self.waiter(context, statuses).wait(poll)
+
+    # one unfiltered listing per poll shows both the servers that are done
+    # and the ones that went to ERROR
+    def wait_servers_context(self, context):
+        poll_context = context.copy()
+        poll_context.set("filter_status", None)
+        poll_context.set("filter_name", None)
+        return poll_context
+
+    # the status a watched server finished with, None while it is pending
+    def finished_status(self, server, status):
+        if server["status"] in (status, "ERROR"):
+            return server["status"]
+        return None
 
     def get_server_status_request(self, context):
         params = {}
-        params[
-            "url"
-        ] = "https://compute.c3j1.conoha.io/v2.1/servers/{}".format(
-            context.get("server_id")
+        params["url"] = self.endpoint_url(
+            "compute",
+            "/v2.1/servers/{}".format(context.get("server_id")),
+            context,
         )
         params["method"] = "get"
         params["headers"] = {
@@ -226,10 +521,12 @@ class RestApi(ABC):
 
     def get_server_console_request(self, context):
         params = {}
-        params[
-            "url"
-        ] = "https://compute.c3j1.conoha.io/v2.1/servers/{}/remote-consoles".format(
-            context.get("server_id")
+        params["url"] = self.endpoint_url(
+            "compute",
+            "/v2.1/servers/{}/remote-consoles".format(
+                context.get("server_id")
+            ),
+            context,
         )
         params["method"] = "post"
         params["headers"] = {
@@ -253,10 +550,10 @@ class RestApi(ABC):
 
     def mount_image_request(self, context):
         params = {}
-        params[
-            "url"
-        ] = "https://compute.c3j1.conoha.io/v2.1/servers/{}/action".format(
-            context.get("server_id")
+        params["url"] = self.endpoint_url(
+            "compute",
+            "/v2.1/servers/{}/action".format(context.get("server_id")),
+            context,
         )
         params["method"] = "post"
         params["headers"] = {
@@ -280,10 +577,10 @@ class RestApi(ABC):
 
     def unmount_image_request(self, context):
         params = {}
-        params[
-            "url"
-        ] = "https://compute.c3j1.conoha.io/v2.1/servers/{}/action".format(
-            context.get("server_id")
+        params["url"] = self.endpoint_url(
+            "compute",
+            "/v2.1/servers/{}/action".format(context.get("server_id")),
+            context,
         )
         params["method"] = "post"
         params["headers"] = {
@@ -305,64 +602,169 @@ class RestApi(ABC):
 
 
 class FakeConohaRestApi(RestApi):
+    def __init__(self, clock=None, endpoints=None):
+        super().__init__(clock, endpoints)
+        self.server_statuses = {}
+
     def generate_request(self, params):
         return params
 
     def generate_token(self, context):
         request = super().generate_token_request(context)
-        print(str(request))
+        print(str(request), file=sys.stderr)
         context.set("auth_token", "fake-token")
 
     def generate_image_id(self, context):
         request = super().generate_image_id_request(context)
-        print(str(request))
+        print(str(request), file=sys.stderr)
         context.set("image_id", "fake-image-id")
 
     def upload_image(self, context):
         request = super().upload_image_request(context)
-        print(str(request))
+        print(str(request), file=sys.stderr)
+        self.close_upload_source(context)
+
+    def find_uploaded_image(self, context):
+        request = super().list_image_request(context)
+        print(str(request), file=sys.stderr)
 
     def delete_image(self, context):
         request = super().delete_image_request(context)
-        print(str(request))
+        print(str(request), file=sys.stderr)
 
     def list_server(self, context):
         request = super().list_server_request(context)
-        print(str(request))
+        print(str(request), file=sys.stderr)
+        context.set("server_ids", [])
+        return []
+
+    def list_server_detail(self, context):
+        request = super().list_server_detail_request(context)
+        print(str(request), file=sys.stderr)
+        context.set("servers", [])
+        context.set("server_ids", [])
+        return []
+
+    def sync_servers(self, context, inventory):
+        request = super().list_server_detail_request(context)
+        print(str(request), file=sys.stderr)
+        inventory.update_servers([], changes_since(), full=True)
+
+    def sync_images(self, context, inventory):
+        request = super().list_image_request(context)
+        print(str(request), file=sys.stderr)
+        inventory.update_images([])
 
     def start_server(self, context):
         request = super().start_server_request(context)
-        print(str(request))
+        print(str(request), file=sys.stderr)
+        self.server_statuses[context.get("server_id")] = "ACTIVE"
 
     def stop_server(self, context):
         request = super().stop_server_request(context)
-        print(str(request))
+        print(str(request), file=sys.stderr)
+        self.server_statuses[context.get("server_id")] = "SHUTOFF"
 
     def get_server_status(self, context):
         request = super().get_server_status_request(context)
-        print(str(request))
-        context.set("server_status", "SHUTOFF")
+        print(str(request), file=sys.stderr)
+        server_status = self.server_statuses.get(
+            context.get("server_id"), "SHUTOFF"
+        )
+        context.set("server_status", server_status)
+
+    def wait_servers(self, context, server_ids, status):
+        poll_context = self.wait_servers_context(context)
+        request = super().list_server_detail_request(poll_context)
+        print(str(request), file=sys.stderr)
+        for server_id in server_ids:
+            self.server_statuses[server_id] = status
+            yield server_id, status, 0.0
 
     def get_server_console(self, context):
         request = super().get_server_console_request(context)
-        print(str(request))
-        print("http://127.0.0.1/")
+        print(str(request), file=sys.stderr)
+        context.set("console_url", "http://127.0.0.1/")
 
     def list_image(self, context):
         request = super().list_image_request(context)
-        print(str(request))
+        print(str(request), file=sys.stderr)
+        context.set("images", [])
+        return []
 
     def mount_image(self, context):
         request = super().mount_image_request(context)
-        print(str(request))
+        print(str(request), file=sys.stderr)
+        self.server_statuses[context.get("server_id")] = "RESCUE"
 
     def unmount_image(self, context):
         request = super().unmount_image_request(context)
-        print(str(request))
+        print(str(request), file=sys.stderr)
+        self.server_statuses[context.get("server_id")] = "ACTIVE"
 
 
 class ConohaRestApi(RestApi):
+    def __init__(
+        self, pool_size=DEFAULT_POOL_SIZE, clock=None, endpoints=None
+    ):
+        super().__init__(clock, endpoints)
+        self.transport = ConnectionPool(pool_size)
+        self.retry = RetryPolicy()
+
+    def urlopen(self, request):
+        send = self.send_request
+        if self.limiter is not None:
+            send = partial(self.limited_send, self.service_of(request))
+        if self.retry is None:
+            return send(request)
+        return self.retry.call(request, send, self.clock)
+
+    # every attempt, retries included, takes a token from the bucket
+    def limited_send(self, service, request):
+        return self.limiter.call(
+            service, request, self.send_request, self.clock
+        )
+
+    def send_request(self, request):
+        if self.tracer is None:
+            return self.transport.urlopen(request)
+        name = "{} {}".format(request.get_method(), request.host)
+        with self.tracer.span(name, "http", url=request.full_url) as span:
+            return self.transport.urlopen(request, span.args)
+
+    def close(self):
+        self.transport.close()
+
+    def authorized_urlopen(self, context, build_request):
+        if self.tracer is None:
+            return self.refreshing_urlopen(context, build_request)
+        name = getattr(build_request, "__name__", None)
+        if name is None:
+            name = build_request.func.__name__
+        with self.tracer.span(name.removesuffix("_request"), "api"):
+            return self.refreshing_urlopen(context, build_request)
+
+    def refreshing_urlopen(self, context, build_request):
+        from urllib.error import HTTPError
+
+        request = build_request(context)
+        try:
+            return self.urlopen(request)
+        except HTTPError as error:
+            if error.code != 401 or not has_credentials(context):
+                raise
+            self.refresh_token(context)
+            check_replayable(request, error)
+        return self.urlopen(build_request(context))
+
+    def refresh_token(self, context):
+        renew_token(
+            context, self.generate_token, rejected=context.get("auth_token")
+        )
+
     def generate_request(self, params):
+        from urllib.request import Request
+
         request = Request(
             params["url"],
             data=params["payload"],
@@ -373,121 +775,286 @@ class ConohaRestApi(RestApi):
 
     def generate_token(self, context):
         request = super().generate_token_request(context)
-        with urlopen(request) as response:
-            if response.status == 201:
-                headers = response.headers
-                key = "x-subject-token"
-                context.set("auth_token", headers[key])
-                print("auth_token: {}".format(headers[key]))
-            else:
-                print("{}: {}".format(response.status, response.reason))
+        with self.urlopen(request) as response:
+            self.generate_token_response(context, response)
+
+    def generate_token_response(self, context, response):
+        if response.status == 201:
+            headers = response.headers
+            key = "x-subject-token"
+            context.set("auth_token", headers[key])
+            body = json.loads(response.read().decode("utf-8"))
+            context.set("expires_at", body["token"].get("expires_at"))
+            context.set("catalog", body["token"].get("catalog"))
+        else:
+            print(
+                "{}: {}".format(response.status, response.reason),
+                file=sys.stderr,
+            )
 
+    # the list_* methods yield records as the pages arrive and leave the
+    # whole listing in the context once they are exhausted
     def list_image(self, context):
-        request = super().list_image_request(context)
-        with urlopen(request) as response:
-            if response.status == 200:
-                body = json.loads(response.read().decode("utf-8"))
-                for image in body["images"]:
-                    print(
-                        "id: {} updated_at: {} name: {} status: {}".format(
-                            image["id"],
-                            image["updated_at"],
-                            image["name"],
-                            image["status"],
-                        )
-                    )
-            else:
-                print("{}: {}".format(response.status, response.reason))
+        images = []
+        for image in self.iter_images(context):
+            image = image_record(image)
+            images.append(image)
+            yield image
+        context.set("images", images)
+
+    def iter_images(self, context):
+        def fetch_page(marker):
+            with self.authorized_urlopen(
+                context, partial(self.list_image_request, marker=marker)
+            ) as response:
+                return self.images_page(response)
+
+        return paginate(fetch_page, prefetch=context.get("prefetch"))
+
+    def find_uploaded_image(self, context):
+        iso_file = context.get("iso_file")
+        size = source_size(iso_file)
+        if size is None:
+            return
+        candidates = [
+            image
+            for image in self.iter_images(context)
+            if image.get("size") == size
+            and image.get("status") == "active"
+            and image["id"] != context.get("image_id")
+        ]
+        image = find_duplicate_image(iso_file, candidates)
+        if image is not None:
+            context.set("uploaded_image_id", image["id"])
+            print("already uploaded: {}".format(image["id"]), file=sys.stderr)
+
+    def images_page(self, response):
+        body = json.loads(response.read().decode("utf-8"))
+        images = body["images"]
+        if body.get("next") is None or not images:
+            return images, None
+        return images, images[-1]["id"]
 
     def generate_image_id(self, context):
-        request = super().generate_image_id_request(context)
-        with urlopen(request) as response:
-            if response.status == 201:
-                body = json.loads(response.read().decode("utf-8"))
-                key = "id"
-                context.set("image_id", body[key])
-                print("id: {}".format(body[key]))
-            else:
-                print("{}: {}".format(response.status, response.reason))
+        with self.authorized_urlopen(
+            context, super().generate_image_id_request
+        ) as response:
+            self.generate_image_id_response(context, response)
+
+    def generate_image_id_response(self, context, response):
+        if response.status == 201:
+            body = json.loads(response.read().decode("utf-8"))
+            key = "id"
+            context.set("image_id", body[key])
+        else:
+            print(
+                "{}: {}".format(response.status, response.reason),
+                file=sys.stderr,
+            )
 
     def upload_image(self, context):
-        request = super().upload_image_request(context)
-        with urlopen(request) as response:
-            if response.status == 204:
-                print("success")
-            else:
-                print("{}: {}".format(response.status, response.reason))
+        try:
+            with self.authorized_urlopen(
+                context, super().upload_image_request
+            ) as response:
+                self.upload_image_response(context, response)
+        finally:
+            self.close_upload_source(context)
+
+    def upload_image_response(self, context, response):
+        if response.status == 204:
+            source = context.get("upload_source")
+            source.progress.summary()
+            if source.digester is not None:
+                context.set("digests", source.digester.hexdigests())
+        else:
+            print(
+                "{}: {}".format(response.status, response.reason),
+                file=sys.stderr,
+            )
 
     def delete_image(self, context):
-        request = super().delete_image_request(context)
-        with urlopen(request) as response:
-            if response.status == 204:
-                print("success")
-            else:
-                print("{}: {}".format(response.status, response.reason))
+        with self.authorized_urlopen(
+            context, super().delete_image_request
+        ) as response:
+            self.delete_image_response(context, response)
+
+    def delete_image_response(self, context, response):
+        if response.status != 204:
+            print(
+                "{}: {}".format(response.status, response.reason),
+                file=sys.stderr,
+            )
 
     def list_server(self, context):
-        request = super().list_server_request(context)
-        with urlopen(request) as response:
-            if response.status == 200:
-                body = json.loads(response.read().decode("utf-8"))
-                for server in body["servers"]:
-                    server["id"]
-                    print("id: {}".format(server["id"]))
-            else:
-                print("{}: {}".format(response.status, response.reason))
+        server_ids = []
+        for server in self.iter_servers(context):
+            server_ids.append(server["id"])
+            yield server_record(server)
+        context.set("server_ids", server_ids)
+
+    def list_server_detail(self, context):
+        servers = []
+        for server in self.iter_servers(context, detail=True):
+            server = server_summary(server)
+            servers.append(server)
+            yield server
+        context.set("servers", servers)
+        context.set("server_ids", [server["id"] for server in servers])
+
+    def iter_servers(self, context, detail=False):
+        if detail:
+            build_request = self.list_server_detail_request
+        else:
+            build_request = self.list_server_request
+
+        def fetch_page(marker):
+            with self.authorized_urlopen(
+                context, partial(build_request, marker=marker)
+            ) as response:
+                return self.servers_page(response)
+
+        return paginate(fetch_page, prefetch=context.get("prefetch"))
+
+    # one listing per poll covers every server, each is yielded with the
+    # status it finished in, the target or ERROR, and the time it took;
+    # servers still pending when the timeout passes are not yielded
+    def wait_servers(self, context, server_ids, status):
+        poll_context = self.wait_servers_context(context)
+        waiter = self.waiter(context, [status])
+        delays = waiter.delays()
+        started = self.clock.monotonic()
+        pending = set(server_ids)
+        first = True
+        while True:
+            for server in self.iter_servers(poll_context, detail=True):
+                if server["id"] not in pending:
+                    continue
+                finished = self.finished_status(server, status)
+                if finished is None:
+                    continue
+                pending.discard(server["id"])
+                elapsed = self.clock.monotonic() - started
+                # a server found done on the first poll made no transition
+                if finished == status and not first:
+                    self.transitions.record(status, elapsed)
+                yield server["id"], finished, elapsed
+            if not pending:
+                return
+            first = False
+            try:
+                delay = next(delays)
+            except TimeoutError:
+                return
+            waiter.sleep(delay)
+
+    def sync_servers(self, context, inventory):
+        sync_context = context.copy()
+        since = inventory.since("servers")
+        sync_context.set("changes_since", since)
+        started = changes_since()
+        servers = (
+            server_summary(server)
+            for server in self.iter_servers(sync_context, detail=True)
+        )
+        inventory.update_servers(servers, started, full=since is None)
+
+    def sync_images(self, context, inventory):
+        inventory.update_images(self.iter_images(context))
+
+    def servers_page(self, response):
+        body = json.loads(response.read().decode("utf-8"))
+        servers = body["servers"]
+        links = body.get("servers_links", [])
+        if not servers or not any(link["rel"] == "next" for link in links):
+            return servers, None
+        return servers, servers[-1]["id"]
 
     def start_server(self, context):
-        request = super().start_server_request(context)
-        with urlopen(request) as response:
-            if response.status == 202:
-                print("success")
-            else:
-                print("{}: {}".format(response.status, response.reason))
+        with self.authorized_urlopen(
+            context, super().start_server_request
+        ) as response:
+            self.start_server_response(context, response)
+
+    def start_server_response(self, context, response):
+        if response.status != 202:
+            print(
+                "{}: {}".format(response.status, response.reason),
+                file=sys.stderr,
+            )
 
     def stop_server(self, context):
-        request = super().stop_server_request(context)
-        with urlopen(request) as response:
-            if response.status == 202:
-                print("success")
-            else:
-                print("{}: {}".format(response.status, response.reason))
+        with self.authorized_urlopen(
+            context, super().stop_server_request
+        ) as response:
+            self.stop_server_response(context, response)
+
+    def stop_server_response(self, context, response):
+        if response.status != 202:
+            print(
+                "{}: {}".format(response.status, response.reason),
+                file=sys.stderr,
+            )
 
     def get_server_status(self, context):
-        request = super().get_server_status_request(context)
-        with urlopen(request) as response:
-            if response.status == 200:
-                body = json.loads(response.read().decode("utf-8"))
-                server_status = body["server"]["status"]
-                context.set("server_status", server_status)
-                print("status: ", server_status)
-            else:
-                print("{}: {}".format(response.status, response.reason))
+        with self.authorized_urlopen(
+            context, super().get_server_status_request
+        ) as response:
+            self.get_server_status_response(context, response)
+
+    def get_server_status_response(self, context, response):
+        if response.status == 200:
+            body = json.loads(response.read().decode("utf-8"))
+            server_status = body["server"]["status"]
+            context.set("server_status", server_status)
+        else:
+            print(
+                "{}: {}".format(response.status, response.reason),
+                file=sys.stderr,
+            )
 
     def get_server_console(self, context):
-        request = super().get_server_console_request(context)
-        with urlopen(request) as response:
-            if response.status == 200:
-                body = json.loads(response.read().decode("utf-8"))
-                url = body["remote_console"]["url"]
-                print(url)
-            else:
-                print("{}: {}".format(response.status, response.reason))
+        with self.authorized_urlopen(
+            context, super().get_server_console_request
+        ) as response:
+            self.get_server_console_response(context, response)
+
+    def get_server_console_response(self, context, response):
+        if response.status == 200:
+            body = json.loads(response.read().decode("utf-8"))
+            url = body["remote_console"]["url"]
+            context.set("console_url", url)
+        else:
+            print(
+                "{}: {}".format(response.status, response.reason),
+                file=sys.stderr,
+            )
 
     def mount_image(self, context):
-        request = super().mount_image_request(context)
-        with urlopen(request) as response:
-            if response.status == 200:
-                body = json.loads(response.read().decode("utf-8"))
-                admin_pass = body["adminPass"]
-                print("adminPass: {}".format(admin_pass))
-            else:
-                print("{}: {}".format(response.status, response.reason))
+        with self.authorized_urlopen(
+            context, super().mount_image_request
+        ) as response:
+            self.mount_image_response(context, response)
+
+    def mount_image_response(self, context, response):
+        if response.status == 200:
+            body = json.loads(response.read().decode("utf-8"))
+            context.set("admin_pass", body["adminPass"])
+        else:
+            print(
+                "{}: {}".format(response.status, response.reason),
+                file=sys.stderr,
+            )
 
     def unmount_image(self, context):
-        request = super().unmount_image_request(context)
-        with urlopen(request) as response:
-            if response.status == 202:
-                print("success")
-            else:
-                print("{}: {}".format(response.status, response.reason))
+        with self.authorized_urlopen(
+            context, super().unmount_image_request
+        ) as response:
+            self.unmount_image_response(context, response)
+
+    def unmount_image_response(self, context, response):
+        if response.status != 202:
+            print(
+                "{}: {}".format(response.status, response.reason),
+                file=sys.stderr,
+            )
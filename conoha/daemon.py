@@ -0,0 +1,237 @@
+import contextvars
+import json
+import os
+import socket
+import sys
+import threading
+
+# channel to the client whose request the current thread is serving
+OUTPUT = contextvars.ContextVar("output", default=None)
+
+
+# a directory only the user can enter, so nobody else can put a socket
+# where the client looks for the daemon
+def private_directory(path):
+    import stat
+
+    try:
+        os.mkdir(path, 0o700)
+    except FileExistsError:
+        pass
+    status = os.lstat(path)
+    if (
+        not stat.S_ISDIR(status.st_mode)
+        or status.st_uid != os.getuid()
+        or status.st_mode & 0o077
+    ):
+        raise PermissionError("{} is not a private directory".format(path))
+    return path
+
+
+def socket_path(path=None):
+    if path is not None:
+        return path
+    path = os.environ.get("CONOHA_SOCKET")
+    if path:
+        return path
+    directory = os.environ.get("XDG_RUNTIME_DIR")
+    if directory:
+        return os.path.join(directory, "conoha-{}.sock".format(os.getuid()))
+    directory = private_directory("/tmp/conoha-{}".format(os.getuid()))
+    return os.path.join(directory, "daemon.sock")
+
+
+def peer_uid(connection):
+    if not hasattr(socket, "SO_PEERCRED"):
+        return None
+    import struct
+
+    credentials = connection.getsockopt(
+        socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i")
+    )
+    _, uid, _ = struct.unpack("3i", credentials)
+    return uid
+
+
+def connect(path):
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(path)
+        uid = peer_uid(connection)
+        if uid is None:
+            uid = os.stat(path).st_uid
+    except OSError:
+        connection.close()
+        return None
+    # the request carries passwords and tokens, only our own daemon gets it
+    if uid != os.getuid():
+        connection.close()
+        print("ignoring {} owned by uid {}".format(path, uid), file=sys.stderr)
+        return None
+    return connection
+
+
+def request(path, message):
+    connection = connect(path)
+    if connection is None:
+        return None
+    with connection:
+        connection.sendall((json.dumps(message) + "\n").encode("utf-8"))
+        with connection.makefile("r", encoding="utf-8") as reader:
+            for line in reader:
+                reply = json.loads(line)
+                if "stdout" in reply:
+                    sys.stdout.write(reply["stdout"])
+                    sys.stdout.flush()
+                elif "stderr" in reply:
+                    sys.stderr.write(reply["stderr"])
+                    sys.stderr.flush()
+                else:
+                    return reply
+    print("daemon closed the connection", file=sys.stderr)
+    return {"exit": 1}
+
+
+# returns None when no daemon is listening, so the caller runs the
+# command itself
+def forward(argv, path=None):
+    try:
+        path = socket_path(path)
+    except PermissionError as error:
+        print(error, file=sys.stderr)
+        return None
+    reply = request(path, {"argv": argv, "cwd": os.getcwd()})
+    if reply is None:
+        return None
+    return reply["exit"]
+
+
+class Channel:
+    def __init__(self, connection):
+        self.connection = connection
+        self.__lock = threading.Lock()
+
+    def send(self, **message):
+        data = (json.dumps(message) + "\n").encode("utf-8")
+        with self.__lock:
+            self.connection.sendall(data)
+
+
+class RoutedStream:
+    def __init__(self, name, fallback):
+        self.name = name
+        self.fallback = fallback
+
+    def write(self, text):
+        channel = OUTPUT.get()
+        if channel is None:
+            return self.fallback.write(text)
+        if text:
+            channel.send(**{self.name: text})
+        return len(text)
+
+    def flush(self):
+        if OUTPUT.get() is None:
+            self.fallback.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.fallback, name)
+
+
+class ApiCache:
+    def __init__(self):
+        self.apis = {}
+        self.__lock = threading.Lock()
+
+    def get(self, key, create):
+        with self.__lock:
+            if key not in self.apis:
+                self.apis[key] = create()
+            return self.apis[key]
+
+    def close(self):
+        with self.__lock:
+            for api in self.apis.values():
+                api.close()
+            self.apis.clear()
+
+
+def exit_status(exit):
+    if exit.code is None:
+        return 0
+    if isinstance(exit.code, int):
+        return exit.code
+    print(exit.code, file=sys.stderr)
+    return 1
+
+
+def serve(path, execute, apis):
+    import socketserver
+    import traceback
+
+    class DaemonHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            if peer_uid(self.connection) not in (None, os.getuid()):
+                return
+            message = json.loads(self.rfile.readline())
+            channel = Channel(self.connection)
+            token = OUTPUT.set(channel)
+            try:
+                status = self.dispatch(message)
+            except SystemExit as exit:
+                status = exit_status(exit)
+            except Exception:
+                traceback.print_exc()
+                status = 1
+            finally:
+                OUTPUT.reset(token)
+            channel.send(exit=status)
+
+        def dispatch(self, message):
+            if "stop" in message:
+                threading.Thread(target=self.server.shutdown).start()
+                return 0
+            if "status" in message:
+                print(
+                    "pid: {} apis: {} requests: {}".format(
+                        os.getpid(), len(apis.apis), self.server.requests
+                    )
+                )
+                return 0
+            self.server.requests += 1
+            return execute(message["argv"], message["cwd"])
+
+    class DaemonServer(socketserver.ThreadingUnixStreamServer):
+        daemon_threads = True
+        requests = 0
+
+    try:
+        path = socket_path(path)
+    except PermissionError as error:
+        print(error, file=sys.stderr)
+        return 1
+    connection = connect(path)
+    if connection is not None:
+        connection.close()
+        print("already running on {}".format(path), file=sys.stderr)
+        return 1
+    if os.path.exists(path):
+        os.unlink(path)
+    # the socket hands out whatever the secret files hold, keep it private
+    umask = os.umask(0o177)
+    try:
+        server = DaemonServer(path, DaemonHandler)
+    finally:
+        os.umask(umask)
+    sys.stdout = RoutedStream("stdout", sys.stdout)
+    sys.stderr = RoutedStream("stderr", sys.stderr)
+    print("listening on {}".format(path), flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(path)
+        apis.close()
+    return 0
@@ -0,0 +1,58 @@
+BUFFER_SIZE = 4 * 1024 * 1024
+
+DEFAULT_ALGORITHMS = ["md5", "sha256"]
+
+
+class Digester:
+    def __init__(self, algorithms=DEFAULT_ALGORITHMS):
+        import hashlib
+
+        self.hashes = {
+            algorithm: hashlib.new(algorithm, usedforsecurity=False)
+            for algorithm in algorithms
+        }
+
+    def update(self, data):
+        for digest in self.hashes.values():
+            digest.update(data)
+
+    def hexdigests(self):
+        return {
+            algorithm: digest.hexdigest()
+            for algorithm, digest in self.hashes.items()
+        }
+
+
+def file_digest(path, algorithms=DEFAULT_ALGORITHMS, buffer_size=BUFFER_SIZE):
+    digester = Digester(algorithms)
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+    with open(path, "rb", buffering=0) as fp:
+        while size := fp.readinto(buffer):
+            digester.update(view[:size])
+    return digester.hexdigests()
+
+
+def matches_image(image, digests):
+    algorithm = image.get("os_hash_algo")
+    if algorithm in digests and image.get("os_hash_value"):
+        return digests[algorithm] == image["os_hash_value"]
+    if image.get("checksum"):
+        return digests["md5"] == image["checksum"]
+    return False
+
+
+def find_duplicate_image(path, candidates):
+    if not candidates:
+        return None
+    import hashlib
+
+    algorithms = set(DEFAULT_ALGORITHMS)
+    for image in candidates:
+        if image.get("os_hash_algo") in hashlib.algorithms_available:
+            algorithms.add(image["os_hash_algo"])
+    digests = file_digest(path, sorted(algorithms))
+    for image in candidates:
+        if matches_image(image, digests):
+            return image
+    return None
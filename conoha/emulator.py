@@ -0,0 +1,683 @@
+import argparse
+import hashlib
+import json
+import random
+import re
+import ssl
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from conoha.ratelimit import TokenBucket
+
+DEFAULT_PORT = 8774
+
+DEFAULT_SERVERS = 10
+
+DEFAULT_TRANSITION_DELAY = 2.0
+
+DEFAULT_TOKEN_TTL = 24 * 60 * 60
+
+SERVICES = ["identity", "compute", "image"]
+
+DEFAULT_REGION = "c3j1"
+
+# action: (statuses it is accepted in, status after the transition)
+SERVER_ACTIONS = {
+    "os-start": (["SHUTOFF"], "ACTIVE"),
+    "os-stop": (["ACTIVE"], "SHUTOFF"),
+    "rescue": (["ACTIVE", "SHUTOFF"], "RESCUE"),
+    "unrescue": (["RESCUE"], "ACTIVE"),
+}
+
+# method, path pattern, Emulator method
+ROUTES = [
+    ("POST", r"/v3/auth/tokens", "post_tokens"),
+    ("GET", r"/v2\.1/servers", "get_servers"),
+    ("GET", r"/v2\.1/servers/detail", "get_servers_detail"),
+    ("GET", r"/v2\.1/servers/([^/]+)", "get_server"),
+    ("POST", r"/v2\.1/servers/([^/]+)/action", "post_server_action"),
+    ("POST", r"/v2\.1/servers/([^/]+)/remote-consoles", "post_console"),
+    ("GET", r"/v2/images", "get_images"),
+    ("POST", r"/v2/images", "post_images"),
+    ("DELETE", r"/v2/images/([^/]+)", "delete_image"),
+    ("PUT", r"/v2/images/([^/]+)/file", "put_image_file"),
+]
+
+
+def timestamp(seconds):
+    moment = datetime.fromtimestamp(seconds, timezone.utc)
+    return moment.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def parse_timestamp(value):
+    return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+
+
+def service_of(path):
+    if path.startswith("/v3/"):
+        return "identity"
+    if path.startswith("/v2.1/"):
+        return "compute"
+    return "image"
+
+
+class EmulatedServer:
+    def __init__(self, server_id, name, address, updated):
+        self.id = server_id
+        self.name = name
+        self.address = address
+        self.status = "ACTIVE"
+        self.target = None
+        self.ready_at = None
+        self.updated = updated
+
+    def settle(self, now):
+        if self.target is not None and now >= self.ready_at:
+            self.status = self.target
+            self.target = None
+            self.updated = self.ready_at
+
+    def summary(self, base):
+        return {
+            "id": self.id,
+            "name": self.name,
+            "links": [
+                {
+                    "rel": "self",
+                    "href": "{}/v2.1/servers/{}".format(base, self.id),
+                }
+            ],
+        }
+
+    def detail(self, base):
+        server = self.summary(base)
+        server["status"] = self.status
+        server["updated"] = timestamp(self.updated)
+        server["addresses"] = {
+            "ext-net": [{"addr": self.address, "version": 4}]
+        }
+        server["flavor"] = {"original_name": "g2l-t-c2m1"}
+        return server
+
+
+class Emulator:
+    def __init__(
+        self,
+        servers=DEFAULT_SERVERS,
+        transition_delay=DEFAULT_TRANSITION_DELAY,
+        token_ttl=DEFAULT_TOKEN_TTL,
+        latencies=None,
+        errors=None,
+        seed=None,
+        clock=time.time,
+        sleep=time.sleep,
+        transition_delays=None,
+        rate_limits=None,
+        regions=None,
+    ):
+        self.transition_delay = transition_delay
+        self.transition_delays = transition_delays or {}
+        self.token_ttl = token_ttl
+        self.latencies = latencies or {}
+        self.errors = errors or {}
+        rate_limits = rate_limits or {}
+        self.buckets = {}
+        for service in SERVICES:
+            limit = rate_limits.get(service, rate_limits.get("*"))
+            if limit is not None:
+                self.buckets[service] = TokenBucket(*limit)
+        self.random = random.Random(seed)
+        self.clock = clock
+        self.sleep = sleep
+        self.lock = threading.Lock()
+        self.tokens = {}
+        self.servers = {}
+        self.images = {}
+        now = self.clock()
+        for index in range(servers):
+            server_id = str(uuid.UUID(int=self.random.getrandbits(128)))
+            self.servers[server_id] = EmulatedServer(
+                server_id,
+                "vps-{:04d}".format(index + 1),
+                "10.{}.{}.{}".format(
+                    index // 65536 % 256, index // 256 % 256, index % 256
+                ),
+                now,
+            )
+        # further regions are served below /regions/NAME and accept the
+        # tokens this one issues
+        self.regions = {}
+        for index, name in enumerate(regions or []):
+            region = Emulator(
+                servers=servers,
+                transition_delay=transition_delay,
+                token_ttl=token_ttl,
+                latencies=latencies,
+                errors=errors,
+                seed=None if seed is None else seed + index + 1,
+                clock=clock,
+                sleep=sleep,
+                transition_delays=transition_delays,
+                rate_limits=rate_limits,
+            )
+            region.tokens = self.tokens
+            self.regions[name] = region
+
+    def delay(self, service):
+        return self.latencies.get(service, self.latencies.get("*", 0.0))
+
+    def injected_error(self, service):
+        rate, status = self.errors.get(
+            service, self.errors.get("*", (0.0, 503))
+        )
+        if rate > 0 and self.random.random() < rate:
+            return status
+        return None
+
+    def is_throttled(self, service):
+        bucket = self.buckets.get(service)
+        return bucket is not None and not bucket.take(self.clock())
+
+    def issue_token(self):
+        token = uuid.uuid4().hex
+        expires = self.clock() + self.token_ttl
+        with self.lock:
+            self.tokens[token] = expires
+        return token, timestamp(expires)
+
+    def is_authorized(self, token):
+        with self.lock:
+            expires = self.tokens.get(token)
+        return expires is not None and self.clock() < expires
+
+    def server(self, server_id):
+        now = self.clock()
+        with self.lock:
+            server = self.servers.get(server_id)
+            if server is not None:
+                server.settle(now)
+        return server
+
+    def list_servers(self, query):
+        now = self.clock()
+        since = query.get("changes-since")
+        with self.lock:
+            servers = sorted(self.servers.values(), key=lambda s: s.name)
+            for server in servers:
+                server.settle(now)
+        if since is not None:
+            since = parse_timestamp(since)
+            servers = [s for s in servers if s.updated >= since]
+        if "status" in query:
+            servers = [s for s in servers if s.status == query["status"]]
+        if "name" in query:
+            pattern = re.compile(query["name"])
+            servers = [s for s in servers if pattern.search(s.name)]
+        return servers
+
+    def act(self, server_id, action):
+        accepted, target = SERVER_ACTIONS[action]
+        now = self.clock()
+        with self.lock:
+            server = self.servers.get(server_id)
+            if server is None:
+                return 404
+            server.settle(now)
+            if server.target is not None or server.status not in accepted:
+                return 409
+            server.target = target
+            server.ready_at = now + self.transition_delays.get(
+                target, self.transition_delay
+            )
+            server.updated = now
+        return None
+
+    def new_image(self, body):
+        image_id = str(uuid.uuid4())
+        now = timestamp(self.clock())
+        image = {
+            "id": image_id,
+            "name": body.get("name"),
+            "status": "queued",
+            "disk_format": body.get("disk_format"),
+            "container_format": body.get("container_format"),
+            "size": None,
+            "checksum": None,
+            "os_hash_algo": None,
+            "os_hash_value": None,
+            "created_at": now,
+            "updated_at": now,
+            "file": "/v2/images/{}/file".format(image_id),
+        }
+        with self.lock:
+            self.images[image_id] = image
+        return image
+
+    def store_image(self, image_id, size, md5, sha512):
+        with self.lock:
+            image = self.images.get(image_id)
+            if image is None:
+                return False
+            image.update(
+                {
+                    "status": "active",
+                    "size": size,
+                    "checksum": md5,
+                    "os_hash_algo": "sha512",
+                    "os_hash_value": sha512,
+                    "updated_at": timestamp(self.clock()),
+                }
+            )
+        return True
+
+    def remove_image(self, image_id):
+        with self.lock:
+            return self.images.pop(image_id, None) is not None
+
+    def list_images(self, query):
+        with self.lock:
+            images = [dict(image) for image in self.images.values()]
+        updated_at = query.get("updated_at", "")
+        if updated_at.startswith("gt:"):
+            images = [i for i in images if i["updated_at"] > updated_at[3:]]
+        key = query.get("sort_key", "created_at")
+        images.sort(
+            key=lambda i: (i[key], i["id"]),
+            reverse=query.get("sort_dir", "desc") == "desc",
+        )
+        return images
+
+    def route(self, method, path):
+        for route_method, pattern, name in ROUTES:
+            match = re.fullmatch(pattern, path)
+            if route_method == method and match:
+                return getattr(self, name), match.groups()
+        return None, ()
+
+    def handle(self, method, path, query, token, body, base):
+        match = re.fullmatch(r"/regions/([^/]+)(/.*)", path)
+        if match is not None and match.group(1) in self.regions:
+            name, path = match.groups()
+            return self.regions[name].handle(
+                method,
+                path,
+                query,
+                token,
+                body,
+                "{}/regions/{}".format(base, name),
+            )
+        service = service_of(path)
+        delay = self.delay(service)
+        if delay > 0:
+            self.sleep(delay)
+        handler, arguments = self.route(method, path)
+        if handler is None:
+            return 404, {"error": "not found"}, {}
+        status = self.injected_error(service)
+        if status is None and self.is_throttled(service):
+            status = 429
+        if status is None and service != "identity":
+            if not self.is_authorized(token):
+                status = 401
+        if status is not None:
+            headers = {"Retry-After": "1"} if status in [429, 503] else {}
+            return status, {"error": status}, headers
+        return handler(query, body, base, *arguments)
+
+    def catalog(self, base):
+        regions = [(DEFAULT_REGION, base)] + [
+            (name, "{}/regions/{}".format(base, name)) for name in self.regions
+        ]
+        services = [
+            ("identity", "keystone", lambda url: base + "/v3"),
+            ("compute", "nova", lambda url: url + "/v2.1"),
+            ("image", "glance", lambda url: url),
+        ]
+        return [
+            {
+                "type": service,
+                "name": name,
+                "endpoints": [
+                    {
+                        "interface": "public",
+                        "region": region,
+                        "region_id": region,
+                        "url": endpoint(url),
+                    }
+                    for region, url in regions
+                ],
+            }
+            for service, name, endpoint in services
+        ]
+
+    def post_tokens(self, query, body, base):
+        token, expires_at = self.issue_token()
+        return (
+            201,
+            {
+                "token": {
+                    "expires_at": expires_at,
+                    "methods": ["password"],
+                    "catalog": self.catalog(base),
+                }
+            },
+            {"X-Subject-Token": token},
+        )
+
+    def get_servers(self, query, body, base, detail=False):
+        servers, more = page(
+            self.list_servers(query), query, lambda server: server.id
+        )
+        if servers is None:
+            return 400, {"error": "marker not found"}, {}
+        if detail:
+            servers = [server.detail(base) for server in servers]
+        else:
+            servers = [server.summary(base) for server in servers]
+        links = []
+        if more:
+            path = "/v2.1/servers/detail" if detail else "/v2.1/servers"
+            href = "{}{}?marker={}".format(base, path, servers[-1]["id"])
+            links.append({"rel": "next", "href": href})
+        return 200, {"servers": servers, "servers_links": links}, {}
+
+    def get_servers_detail(self, query, body, base):
+        return self.get_servers(query, body, base, detail=True)
+
+    def get_server(self, query, body, base, server_id):
+        server = self.server(server_id)
+        if server is None:
+            return 404, {"error": "server not found"}, {}
+        return 200, {"server": server.detail(base)}, {}
+
+    def post_server_action(self, query, body, base, server_id):
+        actions = [key for key in json.loads(body) if key in SERVER_ACTIONS]
+        if len(actions) != 1:
+            return 400, {"error": "unknown action"}, {}
+        status = self.act(server_id, actions[0])
+        if status is not None:
+            return status, {"error": actions[0]}, {}
+        if actions[0] == "rescue":
+            return 200, {"adminPass": uuid.uuid4().hex[:12]}, {}
+        return 202, None, {}
+
+    def post_console(self, query, body, base, server_id):
+        if self.server(server_id) is None:
+            return 404, {"error": "server not found"}, {}
+        url = "{}/vnc_auto.html?token={}".format(base, uuid.uuid4())
+        remote_console = {"protocol": "vnc", "type": "novnc", "url": url}
+        return 200, {"remote_console": remote_console}, {}
+
+    def get_images(self, query, body, base):
+        images, more = page(
+            self.list_images(query), query, lambda image: image["id"]
+        )
+        if images is None:
+            return 400, {"error": "marker not found"}, {}
+        result = {"images": images}
+        if more:
+            result["next"] = "/v2/images?marker={}".format(images[-1]["id"])
+        return 200, result, {}
+
+    def post_images(self, query, body, base):
+        return 201, self.new_image(json.loads(body)), {}
+
+    def delete_image(self, query, body, base, image_id):
+        if not self.remove_image(image_id):
+            return 404, {"error": "image not found"}, {}
+        return 204, None, {}
+
+    def put_image_file(self, query, body, base, image_id):
+        if isinstance(body, bytes):
+            body = [body]
+        size = 0
+        md5 = hashlib.md5(usedforsecurity=False)
+        sha512 = hashlib.sha512()
+        for chunk in body:
+            size += len(chunk)
+            md5.update(chunk)
+            sha512.update(chunk)
+        stored = self.store_image(
+            image_id, size, md5.hexdigest(), sha512.hexdigest()
+        )
+        if not stored:
+            return 404, {"error": "image not found"}, {}
+        return 204, None, {}
+
+
+def page(items, query, key):
+    if "marker" in query:
+        ids = [key(item) for item in items]
+        if query["marker"] not in ids:
+            return None, False
+        start = ids.index(query["marker"]) + 1
+        items = items[start:]
+    limit = int(query["limit"]) if "limit" in query else len(items)
+    return items[:limit], len(items) > limit
+
+
+class EmulatorHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    @property
+    def base(self):
+        return "{}://{}".format(self.server.scheme, self.headers["Host"])
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def do_GET(self):
+        self.dispatch()
+
+    def do_POST(self):
+        self.dispatch()
+
+    def do_PUT(self):
+        self.dispatch()
+
+    def do_DELETE(self):
+        self.dispatch()
+
+    def dispatch(self):
+        url = urlsplit(self.path)
+        query = {
+            key: values[-1] for key, values in parse_qs(url.query).items()
+        }
+        # image uploads are hashed as they arrive instead of being buffered
+        body = self.body_chunks()
+        if not url.path.endswith("/file"):
+            body = b"".join(body)
+        status, payload, headers = self.server.emulator.handle(
+            self.command,
+            url.path,
+            query,
+            self.headers.get("X-Auth-Token"),
+            body,
+            self.base,
+        )
+        if not isinstance(body, bytes):
+            for _ in body:
+                pass
+        self.send_json(status, payload, headers)
+
+    def body_chunks(self, chunk_size=1024 * 1024):
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            while size := int(self.rfile.readline().split(b";")[0], 16):
+                while size > 0:
+                    chunk = self.rfile.read(min(size, chunk_size))
+                    size -= len(chunk)
+                    yield chunk
+                self.rfile.readline()
+            while self.rfile.readline() not in [b"\r\n", b"\n", b""]:
+                pass
+            return
+        remaining = int(self.headers.get("Content-Length") or 0)
+        while remaining > 0:
+            chunk = self.rfile.read(min(remaining, chunk_size))
+            if not chunk:
+                return
+            remaining -= len(chunk)
+            yield chunk
+
+    def send_json(self, status, body=None, headers=None):
+        payload = b"" if body is None else json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        if body is not None:
+            self.send_header("Content-Type", "application/json")
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+class EmulatorServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, address, emulator, context=None, verbose=False):
+        super().__init__(address, EmulatorHandler)
+        self.emulator = emulator
+        self.verbose = verbose
+        self.scheme = "http"
+        if context is not None:
+            self.socket = context.wrap_socket(self.socket, server_side=True)
+            self.scheme = "https"
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return "{}://{}:{}".format(self.scheme, host, port)
+
+
+def start_emulator(emulator, host="127.0.0.1", port=0, context=None):
+    server = EmulatorServer((host, port), emulator, context)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def service_values(values, parse):
+    result = {}
+    for value in values or []:
+        service, _, setting = value.partition("=")
+        if service not in SERVICES + ["*"]:
+            raise argparse.ArgumentTypeError(
+                "不明なサービスです: {}".format(service)
+            )
+        result[service] = parse(setting)
+    return result
+
+
+def parse_error(setting):
+    rate, _, status = setting.partition(":")
+    return float(rate), int(status or 503)
+
+
+def parse_rate_limit(setting):
+    rate, _, burst = setting.partition(":")
+    return float(rate), float(burst) if burst else None
+
+
+def create_parser():
+    formatter = argparse.ArgumentDefaultsHelpFormatter
+    parser = argparse.ArgumentParser(
+        prog="conoha.emulator", formatter_class=formatter
+    )
+    parser.add_argument("--host", default="127.0.0.1", help="待ち受けアドレス")
+    parser.add_argument(
+        "--port", type=int, default=DEFAULT_PORT, help="待ち受けポート"
+    )
+    parser.add_argument(
+        "--servers",
+        type=int,
+        default=DEFAULT_SERVERS,
+        help="用意するサーバ数",
+    )
+    parser.add_argument(
+        "--transition-delay",
+        type=float,
+        default=DEFAULT_TRANSITION_DELAY,
+        help="起動, 停止, マウント等が完了するまでの秒数",
+    )
+    parser.add_argument(
+        "--token-ttl",
+        type=float,
+        default=DEFAULT_TOKEN_TTL,
+        help="トークンの有効秒数",
+    )
+    parser.add_argument(
+        "--latency",
+        action="append",
+        metavar="SERVICE=SECONDS",
+        help="応答遅延 (SERVICE は identity, compute, image 又は *)",
+    )
+    parser.add_argument(
+        "--error",
+        action="append",
+        metavar="SERVICE=RATE[:STATUS]",
+        help="エラー応答を返す割合とステータス (既定 503)",
+    )
+    parser.add_argument(
+        "--rate-limit",
+        action="append",
+        metavar="SERVICE=RATE[:BURST]",
+        help="毎秒リクエスト数の上限 (超えると 429 を返します)",
+    )
+    parser.add_argument(
+        "--region",
+        action="append",
+        help="{} の他に用意するリージョン".format(DEFAULT_REGION),
+    )
+    parser.add_argument("--seed", type=int, help="乱数シード")
+    parser.add_argument("--certfile", help="HTTPS で待ち受ける証明書")
+    parser.add_argument("--keyfile", help="証明書の秘密鍵")
+    parser.add_argument(
+        "--verbose", action="store_true", help="リクエストを表示します"
+    )
+    return parser
+
+
+def main():
+    parser = create_parser()
+    args = parser.parse_args()
+    try:
+        latencies = service_values(args.latency, float)
+        errors = service_values(args.error, parse_error)
+        rate_limits = service_values(args.rate_limit, parse_rate_limit)
+    except (argparse.ArgumentTypeError, ValueError) as error:
+        parser.error(str(error))
+    context = None
+    if args.certfile is not None:
+        context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        context.load_cert_chain(args.certfile, args.keyfile)
+    emulator = Emulator(
+        servers=args.servers,
+        transition_delay=args.transition_delay,
+        token_ttl=args.token_ttl,
+        latencies=latencies,
+        errors=errors,
+        seed=args.seed,
+        rate_limits=rate_limits,
+        regions=args.region,
+    )
+    server = EmulatorServer(
+        (args.host, args.port), emulator, context, args.verbose
+    )
+    print("listening on {}".format(server.url), flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
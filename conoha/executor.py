@@ -0,0 +1,58 @@
+DEFAULT_CONCURRENCY = 8
+
+
+class ServerExecutor:
+    def __init__(self, receiver, concurrency=DEFAULT_CONCURRENCY):
+        self.receiver = receiver
+        self.concurrency = concurrency
+
+    def execute(self, command, context, server_ids):
+        server_ids = list(server_ids)
+        if len(server_ids) == 1:
+            yield from self.execute_inline(command, context, server_ids[0])
+            return
+        yield from self.execute_parallel(command, context, server_ids)
+
+    # a single server runs on the calling thread, so Ctrl-C stops it at once
+    def execute_inline(self, command, context, server_id):
+        worker_context = context.copy()
+        worker_context.set("server_id", server_id)
+        try:
+            command.execute(self.receiver, worker_context)
+        except Exception as error:
+            yield worker_context, error
+        else:
+            yield worker_context, None
+
+    def execute_parallel(self, command, context, server_ids):
+        import contextvars
+        import threading
+        from concurrent.futures import ThreadPoolExecutor, as_completed
+
+        cancelled = context.get("cancelled") or threading.Event()
+        executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        completed = False
+        try:
+            futures = {}
+            for server_id in server_ids:
+                worker_context = context.copy()
+                worker_context.set("server_id", server_id)
+                worker_context.set("cancelled", cancelled)
+                # workers inherit the caller's context variables, such as
+                # the daemon client their output goes to
+                future = executor.submit(
+                    contextvars.copy_context().run,
+                    command.execute,
+                    self.receiver,
+                    worker_context,
+                )
+                futures[future] = worker_context
+            for future in as_completed(futures):
+                yield futures[future], future.exception()
+            completed = True
+        finally:
+            # interrupted, or the caller stopped reading: wake the waiters
+            # and drop the servers that have not started yet
+            if not completed:
+                cancelled.set()
+            executor.shutdown(wait=completed, cancel_futures=not completed)
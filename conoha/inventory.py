@@ -0,0 +1,178 @@
+import json
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+DEFAULT_MAX_AGE = 300
+
+FULL_SYNC_INTERVAL = 24 * 60 * 60
+
+CLOCK_SKEW = timedelta(minutes=1)
+
+SCHEMA = """
+create table if not exists servers (
+    id text primary key,
+    name text,
+    status text,
+    addresses text,
+    flavor text
+);
+create index if not exists servers_name on servers (name);
+create table if not exists images (
+    id text primary key,
+    name text,
+    status text,
+    updated_at text,
+    size integer,
+    checksum text,
+    os_hash_algo text,
+    os_hash_value text
+);
+create index if not exists images_name on images (name);
+create table if not exists sync (
+    kind text primary key,
+    synced_at real,
+    full_synced_at real,
+    since text
+);
+"""
+
+IMAGE_COLUMNS = [
+    "id",
+    "name",
+    "status",
+    "updated_at",
+    "size",
+    "checksum",
+    "os_hash_algo",
+    "os_hash_value",
+]
+
+
+def inventory_path(secret):
+    return "{}.inventory.sqlite3".format(secret)
+
+
+class Inventory:
+    def __init__(self, path, clock=time.time):
+        import sqlite3
+
+        self.clock = clock
+        self.__lock = threading.Lock()
+        self.__connection = sqlite3.connect(path, check_same_thread=False)
+        self.__connection.row_factory = sqlite3.Row
+        with self.__connection:
+            self.__connection.executescript(SCHEMA)
+
+    def close(self):
+        self.__connection.close()
+
+    def sync_state(self, kind):
+        with self.__lock:
+            row = self.__connection.execute(
+                "select * from sync where kind = ?", (kind,)
+            ).fetchone()
+        return row
+
+    def is_fresh(self, kind, max_age=DEFAULT_MAX_AGE):
+        state = self.sync_state(kind)
+        if state is None:
+            return False
+        return self.clock() - state["synced_at"] <= max_age
+
+    def since(self, kind):
+        state = self.sync_state(kind)
+        if state is None:
+            return None
+        if self.clock() - state["full_synced_at"] > FULL_SYNC_INTERVAL:
+            return None
+        return state["since"]
+
+    def mark_synced(self, connection, kind, since, full):
+        now = self.clock()
+        connection.execute(
+            "insert into sync (kind, synced_at, full_synced_at, since)"
+            " values (?, ?, ?, ?)"
+            " on conflict (kind) do update set"
+            " synced_at = excluded.synced_at,"
+            " full_synced_at = coalesce(?, full_synced_at),"
+            " since = excluded.since",
+            (kind, now, now, since, now if full else None),
+        )
+
+    def update_servers(self, servers, since, full):
+        with self.__lock, self.__connection as connection:
+            if full:
+                connection.execute("delete from servers")
+            for server in servers:
+                if server["status"] == "DELETED":
+                    connection.execute(
+                        "delete from servers where id = ?", (server["id"],)
+                    )
+                    continue
+                connection.execute(
+                    "insert or replace into servers"
+                    " (id, name, status, addresses, flavor)"
+                    " values (?, ?, ?, ?, ?)",
+                    (
+                        server["id"],
+                        server["name"],
+                        server["status"],
+                        json.dumps(server["addresses"]),
+                        server["flavor"],
+                    ),
+                )
+            self.mark_synced(connection, "servers", since, full)
+
+    # images are few, so every sync replaces them all and deleted images
+    # drop out of the cache
+    def update_images(self, images):
+        with self.__lock, self.__connection as connection:
+            connection.execute("delete from images")
+            for image in images:
+                connection.execute(
+                    "insert or replace into images ({}) values ({})".format(
+                        ", ".join(IMAGE_COLUMNS),
+                        ", ".join("?" for _ in IMAGE_COLUMNS),
+                    ),
+                    [image.get(column) for column in IMAGE_COLUMNS],
+                )
+            self.mark_synced(connection, "images", None, True)
+
+    def delete_image(self, image_id):
+        with self.__lock, self.__connection as connection:
+            connection.execute("delete from images where id = ?", (image_id,))
+
+    def servers(self):
+        with self.__lock:
+            rows = self.__connection.execute(
+                "select * from servers order by name, id"
+            ).fetchall()
+        return [self.server_row(row) for row in rows]
+
+    def server_row(self, row):
+        server = dict(row)
+        server["addresses"] = json.loads(server["addresses"])
+        return server
+
+    def resolve_server(self, reference):
+        with self.__lock:
+            rows = self.__connection.execute(
+                "select id from servers where id = ? or name = ?",
+                (reference, reference),
+            ).fetchall()
+        if len(rows) != 1:
+            return reference
+        return rows[0]["id"]
+
+    def images(self):
+        with self.__lock:
+            rows = self.__connection.execute(
+                "select * from images order by updated_at desc, id desc"
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+
+def changes_since(clock=time.time):
+    started = datetime.fromtimestamp(clock(), timezone.utc) - CLOCK_SKEW
+    return started.strftime("%Y-%m-%dT%H:%M:%SZ")
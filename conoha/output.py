@@ -0,0 +1,177 @@
+import contextvars
+import json
+import sys
+import threading
+from contextlib import contextmanager
+
+OUTPUT_FORMATS = ["text", "table", "json", "ndjson", "csv"]
+
+DEFAULT_OUTPUT = "text"
+
+# writer of the command the current thread is running, workers started
+# with copy_context() write to the same one
+WRITER = contextvars.ContextVar("writer", default=None)
+
+
+def format_value(value):
+    if value is None:
+        return ""
+    if isinstance(value, (list, tuple)):
+        return ",".join(format_value(item) for item in value)
+    if isinstance(value, dict):
+        return json.dumps(value)
+    return str(value)
+
+
+class Writer:
+    def __init__(self, fields=None, stream=None):
+        self.fields = fields
+        self.stream = stream
+        self.__lock = threading.Lock()
+
+    # the stream is looked up on every write so the daemon's routed stdout
+    # is honoured
+    def output(self):
+        return self.stream or sys.stdout
+
+    def project(self, record):
+        if self.fields is None:
+            return record
+        return {field: record.get(field) for field in self.fields}
+
+    def write(self, record):
+        with self.__lock:
+            self.write_record(self.project(record))
+
+    def write_record(self, record):
+        pass
+
+    def close(self):
+        pass
+
+
+class TextWriter(Writer):
+    def write_record(self, record):
+        line = " ".join(
+            "{}: {}".format(key, format_value(value))
+            for key, value in record.items()
+        )
+        print(line, file=self.output(), flush=True)
+
+
+class NdjsonWriter(Writer):
+    def write_record(self, record):
+        print(json.dumps(record), file=self.output(), flush=True)
+
+
+# a JSON array written element by element, so it streams like NDJSON
+class JsonWriter(Writer):
+    def __init__(self, fields=None, stream=None):
+        super().__init__(fields, stream)
+        self.count = 0
+
+    def write_record(self, record):
+        separator = "[\n" if self.count == 0 else ",\n"
+        self.output().write(separator + json.dumps(record))
+        self.output().flush()
+        self.count += 1
+
+    def close(self):
+        self.output().write("[]\n" if self.count == 0 else "\n]\n")
+        self.output().flush()
+
+
+class CsvWriter(Writer):
+    def __init__(self, fields=None, stream=None):
+        super().__init__(fields, stream)
+        self.writer = None
+
+    def write_record(self, record):
+        import csv
+
+        if self.writer is None:
+            # the columns are fixed by --fields or the first record
+            self.writer = csv.DictWriter(
+                self.output(),
+                fieldnames=list(record),
+                extrasaction="ignore",
+                lineterminator="\n",
+            )
+            self.writer.writeheader()
+        self.writer.writerow(
+            {key: format_value(value) for key, value in record.items()}
+        )
+        self.output().flush()
+
+
+# column widths depend on every record, the table is printed on close
+class TableWriter(Writer):
+    def __init__(self, fields=None, stream=None):
+        super().__init__(fields, stream)
+        self.records = []
+
+    def write_record(self, record):
+        self.records.append(record)
+
+    def close(self):
+        if not self.records:
+            return
+        columns = self.fields or list(
+            dict.fromkeys(key for record in self.records for key in record)
+        )
+        rows = [[column.upper() for column in columns]]
+        for record in self.records:
+            rows.append(
+                [format_value(record.get(column)) for column in columns]
+            )
+        widths = [
+            max(len(row[i]) for row in rows) for i in range(len(columns))
+        ]
+        for row in rows:
+            line = "  ".join(
+                value.ljust(width) for value, width in zip(row, widths)
+            )
+            print(line.rstrip(), file=self.output())
+        self.output().flush()
+
+
+WRITERS = {
+    "text": TextWriter,
+    "table": TableWriter,
+    "json": JsonWriter,
+    "ndjson": NdjsonWriter,
+    "csv": CsvWriter,
+}
+
+
+def create_writer(output=DEFAULT_OUTPUT, fields=None, stream=None):
+    return WRITERS[output](fields, stream)
+
+
+@contextmanager
+def writing(output=DEFAULT_OUTPUT, fields=None, stream=None):
+    writer = create_writer(output, fields, stream)
+    token = WRITER.set(writer)
+    try:
+        yield writer
+    finally:
+        WRITER.reset(token)
+        writer.close()
+
+
+# listings run only to look servers up are not part of the result
+@contextmanager
+def discarding():
+    token = WRITER.set(Writer())
+    try:
+        yield
+    finally:
+        WRITER.reset(token)
+
+
+# results are records, progress and status messages go to stderr
+def emit(record):
+    writer = WRITER.get()
+    if writer is None:
+        writer = TextWriter()
+    writer.write(record)
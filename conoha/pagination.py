@@ -0,0 +1,43 @@
+def paginate(fetch_page, prefetch=False):
+    if not prefetch:
+        marker = None
+        while True:
+            items, marker = fetch_page(marker)
+            yield from items
+            if marker is None:
+                return
+    import contextvars
+    from concurrent.futures import ThreadPoolExecutor
+
+    context = contextvars.copy_context()
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(context.run, fetch_page, None)
+        while future is not None:
+            items, marker = future.result()
+            future = None
+            if marker is not None:
+                future = executor.submit(context.run, fetch_page, marker)
+            yield from items
+
+
+async def apaginate(fetch_page, prefetch=False):
+    import asyncio
+
+    marker = None
+    task = None
+    try:
+        while True:
+            if task is None:
+                items, marker = await fetch_page(marker)
+            else:
+                items, marker = await task
+                task = None
+            if prefetch and marker is not None:
+                task = asyncio.ensure_future(fetch_page(marker))
+            for item in items:
+                yield item
+            if marker is None:
+                return
+    finally:
+        if task is not None:
+            task.cancel()
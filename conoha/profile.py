@@ -0,0 +1,38 @@
+import json
+import os
+
+DEFAULT_PROFILES = "~/.conoha/profiles.json"
+
+# name: {"secret": FILE, ...}, the secret file is the profile's token cache
+# and is taken relative to the profiles file
+PROFILE_KEYS = ["secret", "region", "identity_url", "compute_url", "image_url"]
+
+
+def load_profiles(path=None):
+    path = os.path.expanduser(path or DEFAULT_PROFILES)
+    with open(path, "r") as fp:
+        profiles = json.load(fp)
+    if not isinstance(profiles, dict):
+        raise ValueError("profiles must be a JSON object")
+    directory = os.path.dirname(os.path.abspath(path))
+    for name, profile in profiles.items():
+        unknown = sorted(set(profile) - set(PROFILE_KEYS))
+        if unknown:
+            raise ValueError(
+                "{}: unknown keys: {}".format(name, ", ".join(unknown))
+            )
+        if not profile.get("secret"):
+            raise ValueError("{}: secret is required".format(name))
+        profile["secret"] = os.path.join(
+            directory, os.path.expanduser(profile["secret"])
+        )
+    return profiles
+
+
+def select_profiles(profiles, names=None):
+    if names is None:
+        return list(profiles.items())
+    unknown = [name for name in names if name not in profiles]
+    if unknown:
+        raise ValueError("unknown profiles: {}".format(", ".join(unknown)))
+    return [(name, profiles[name]) for name in names]
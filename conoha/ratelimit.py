@@ -0,0 +1,140 @@
+import sys
+import threading
+
+SERVICES = ["identity", "compute", "image"]
+
+# multiplicative decrease on 429, additive recovery on success
+THROTTLE_FACTOR = 0.5
+
+RECOVERY_STEP = 0.01
+
+# requests already in flight answer 429 together, count them as one
+THROTTLE_COOLDOWN = 1.0
+
+MINIMUM_RATE = 0.1
+
+
+class TokenBucket:
+    def __init__(self, rate, burst=None):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst or max(rate, 1.0)
+        self.tokens = self.burst
+        self.updated = None
+        self.throttled = None
+        self.__lock = threading.Lock()
+
+    def refill(self, now):
+        if self.updated is not None and now > self.updated:
+            elapsed = now - self.updated
+            self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+        if self.updated is None or now > self.updated:
+            self.updated = now
+
+    # takes a token even when none is left and returns how long the caller
+    # has to wait for it, so waiters queue up in arrival order
+    def reserve(self, now):
+        with self.__lock:
+            self.refill(now)
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+    def take(self, now):
+        with self.__lock:
+            self.refill(now)
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+    def throttle(self, now):
+        with self.__lock:
+            if (
+                self.throttled is not None
+                and now - self.throttled < THROTTLE_COOLDOWN
+            ):
+                return None
+            self.throttled = now
+            self.rate = max(MINIMUM_RATE, self.rate * THROTTLE_FACTOR)
+            self.tokens = min(self.tokens, 0.0)
+            return self.rate
+
+    def recover(self):
+        with self.__lock:
+            if self.rate < self.max_rate:
+                step = self.max_rate * RECOVERY_STEP
+                self.rate = min(self.max_rate, self.rate + step)
+
+
+# SERVICE=RATE[:BURST], "*" applies to every service not listed
+def parse_limit(value):
+    service, _, setting = value.partition("=")
+    if service not in SERVICES + ["*"]:
+        raise ValueError("不明なサービスです: {}".format(service))
+    rate, _, burst = setting.partition(":")
+    rate = float(rate)
+    burst = float(burst) if burst else None
+    if rate <= 0 or (burst is not None and burst < 1):
+        raise ValueError("レートは正の値を指定して下さい: {}".format(value))
+    return service, rate, burst
+
+
+class RateLimiter:
+    def __init__(self, limits, stream=None):
+        settings = {service: (rate, burst) for service, rate, burst in limits}
+        default = settings.pop("*", None)
+        if default is not None:
+            for service in SERVICES:
+                settings.setdefault(service, default)
+        self.buckets = {
+            service: TokenBucket(rate, burst)
+            for service, (rate, burst) in settings.items()
+        }
+        self.stream = stream or sys.stderr
+
+    def throttle(self, service, bucket, clock):
+        rate = bucket.throttle(clock.monotonic())
+        if rate is None:
+            return
+        print(
+            "429 from {}: rate limit lowered to {:.2f}/s".format(
+                service, rate
+            ),
+            file=self.stream,
+        )
+
+    def call(self, service, request, send, clock):
+        bucket = self.buckets.get(service)
+        if bucket is None:
+            return send(request)
+        delay = bucket.reserve(clock.monotonic())
+        if delay > 0:
+            clock.sleep(delay)
+        try:
+            response = send(request)
+        except Exception as error:
+            if getattr(error, "code", None) == 429:
+                self.throttle(service, bucket, clock)
+            raise
+        bucket.recover()
+        return response
+
+    async def acall(self, service, request, send, clock):
+        import asyncio
+
+        bucket = self.buckets.get(service)
+        if bucket is None:
+            return await send(request)
+        delay = bucket.reserve(clock.monotonic())
+        if delay > 0:
+            await asyncio.sleep(delay)
+        try:
+            response = await send(request)
+        except Exception as error:
+            if getattr(error, "code", None) == 429:
+                self.throttle(service, bucket, clock)
+            raise
+        bucket.recover()
+        return response
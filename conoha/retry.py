@@ -0,0 +1,255 @@
+import random
+import sys
+import threading
+
+DEFAULT_RETRIES = 3
+
+DEFAULT_BACKOFF = 0.5
+
+DEFAULT_MAX_DELAY = 30.0
+
+DEFAULT_BREAKER_THRESHOLD = 5
+
+DEFAULT_BREAKER_RESET = 30.0
+
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+
+IDEMPOTENT_METHODS = ["GET", "HEAD", "OPTIONS", "DELETE"]
+
+
+class CircuitOpenError(ConnectionError):
+    pass
+
+
+def is_transient(error):
+    import http.client
+    from urllib.error import HTTPError
+
+    if isinstance(error, HTTPError):
+        return error.code in RETRY_STATUSES
+    return isinstance(
+        error, (ConnectionError, TimeoutError, http.client.HTTPException)
+    )
+
+
+# the host answered and only asked to slow down, that says nothing about
+# its health
+def is_throttled(error):
+    if getattr(error, "code", None) == 429:
+        return True
+    headers = getattr(error, "headers", None)
+    return headers is not None and headers.get("Retry-After") is not None
+
+
+def retry_after(error, now):
+    headers = getattr(error, "headers", None)
+    value = None if headers is None else headers.get("Retry-After")
+    if value is None:
+        return None
+    if value.strip().isdigit():
+        return float(value)
+    from email.utils import parsedate_to_datetime
+
+    try:
+        moment = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(moment.timestamp() - now, 0.0)
+
+
+class CircuitBreaker:
+    def __init__(
+        self,
+        clock,
+        threshold=DEFAULT_BREAKER_THRESHOLD,
+        reset=DEFAULT_BREAKER_RESET,
+    ):
+        self.clock = clock
+        self.threshold = threshold
+        self.reset = reset
+        self.failures = 0
+        self.opened = None
+        self.trial = False
+        self.__lock = threading.Lock()
+
+    def allow(self):
+        with self.__lock:
+            if self.opened is None:
+                return True
+            if self.clock.monotonic() - self.opened < self.reset:
+                return False
+            # half open: let a single request through to probe the host
+            if self.trial:
+                return False
+            self.trial = True
+            return True
+
+    def remaining(self):
+        with self.__lock:
+            if self.opened is None:
+                return 0.0
+            elapsed = self.clock.monotonic() - self.opened
+            return max(self.reset - elapsed, 0.0)
+
+    # a throttled trial neither closes nor reopens the circuit, the next
+    # request probes again
+    def release(self):
+        with self.__lock:
+            self.trial = False
+
+    def success(self):
+        with self.__lock:
+            self.failures = 0
+            self.opened = None
+            self.trial = False
+
+    def failure(self):
+        with self.__lock:
+            self.failures += 1
+            if self.trial or self.failures >= self.threshold:
+                self.opened = self.clock.monotonic()
+            self.trial = False
+
+
+class RetryPolicy:
+    def __init__(
+        self,
+        retries=DEFAULT_RETRIES,
+        backoff=DEFAULT_BACKOFF,
+        max_delay=DEFAULT_MAX_DELAY,
+        retry_actions=False,
+        breaker_threshold=DEFAULT_BREAKER_THRESHOLD,
+        breaker_reset=DEFAULT_BREAKER_RESET,
+        rand=None,
+        stream=None,
+    ):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_delay = max_delay
+        self.retry_actions = retry_actions
+        self.breaker_threshold = breaker_threshold
+        self.breaker_reset = breaker_reset
+        self.rand = rand or random.random
+        self.stream = stream or sys.stderr
+        self.retried = 0
+        self.__breakers = {}
+        self.__lock = threading.Lock()
+
+    def is_idempotent(self, request):
+        method = request.get_method()
+        if method in IDEMPOTENT_METHODS:
+            return True
+        if method == "POST":
+            # issuing another token is harmless, server actions are not
+            if request.selector.endswith("/auth/tokens"):
+                return True
+            if request.selector.endswith("/action"):
+                return self.retry_actions
+        return False
+
+    def breaker(self, host, clock):
+        with self.__lock:
+            if host not in self.__breakers:
+                self.__breakers[host] = CircuitBreaker(
+                    clock, self.breaker_threshold, self.breaker_reset
+                )
+            return self.__breakers[host]
+
+    def delay(self, attempt, error, clock):
+        requested = retry_after(error, clock.time())
+        if requested is not None:
+            if requested > self.max_delay:
+                return None
+            return requested
+        # full jitter
+        return self.rand() * min(self.max_delay, self.backoff * 2**attempt)
+
+    # delay before the next attempt, None when the error is final
+    def failed(self, breaker, retryable, attempt, error, clock):
+        if not is_transient(error):
+            breaker.success()
+            return None
+        if is_throttled(error):
+            breaker.release()
+        else:
+            breaker.failure()
+        if not retryable or attempt >= self.retries:
+            return None
+        return self.delay(attempt, error, clock)
+
+    # an open circuit is waited out like any other retry, as long as the
+    # budget allows
+    def blocked(self, request, breaker, retryable, attempt, clock):
+        delay = max(breaker.remaining(), self.delay(attempt, None, clock))
+        if not retryable or attempt >= self.retries or delay > self.max_delay:
+            raise CircuitOpenError("circuit open for {}".format(request.host))
+        return delay
+
+    def report(self, attempt, request, delay, error):
+        with self.__lock:
+            self.retried += 1
+        print(
+            "retry {}/{} {} {} in {:.1f}s: {}".format(
+                attempt,
+                self.retries,
+                request.get_method(),
+                request.full_url,
+                delay,
+                error,
+            ),
+            file=self.stream,
+        )
+
+    def call(self, request, send, clock):
+        breaker = self.breaker(request.host, clock)
+        retryable = self.is_idempotent(request)
+        attempt = 0
+        while True:
+            if not breaker.allow():
+                delay = self.blocked(
+                    request, breaker, retryable, attempt, clock
+                )
+                attempt += 1
+                self.report(attempt, request, delay, "circuit open")
+                clock.sleep(delay)
+                continue
+            try:
+                response = send(request)
+            except Exception as error:
+                delay = self.failed(breaker, retryable, attempt, error, clock)
+                if delay is None:
+                    raise
+                attempt += 1
+                self.report(attempt, request, delay, error)
+                clock.sleep(delay)
+                continue
+            breaker.success()
+            return response
+
+    async def acall(self, request, send, clock):
+        import asyncio
+
+        breaker = self.breaker(request.host, clock)
+        retryable = self.is_idempotent(request)
+        attempt = 0
+        while True:
+            if not breaker.allow():
+                delay = self.blocked(
+                    request, breaker, retryable, attempt, clock
+                )
+                attempt += 1
+                self.report(attempt, request, delay, "circuit open")
+                await asyncio.sleep(delay)
+                continue
+            try:
+                response = await send(request)
+            except Exception as error:
+                delay = self.failed(breaker, retryable, attempt, error, clock)
+                if delay is None:
+                    raise
+                attempt += 1
+                self.report(attempt, request, delay, error)
+                await asyncio.sleep(delay)
+                continue
+            breaker.success()
+            return response
@@ -0,0 +1,125 @@
+import json
+import os
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+
+TOKEN_REFRESH_MARGIN = timedelta(minutes=5)
+
+# path: ((mtime, size), secrets), lets a long running process skip
+# reading and rewriting a secret file nobody else has touched
+SECRET_CACHE = {}
+
+
+def file_version(path):
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def read_secrets(path):
+    version = file_version(path)
+    cached = SECRET_CACHE.get(path)
+    if cached is not None and cached[0] == version:
+        return dict(cached[1])
+    with open(path, "r") as fp:
+        secrets = json.load(fp)
+    SECRET_CACHE[path] = (version, secrets)
+    return dict(secrets)
+
+
+def load_secret(context):
+    secrets = read_secrets(context.get("secret"))
+    context.set("auth_token", secrets.get("auth_token"))
+    context.set("expires_at", secrets.get("expires_at"))
+    context.set("catalog", secrets.get("catalog"))
+    for key in ["user_id", "password", "tenant_id"]:
+        if secrets[key]:
+            context.set(key, secrets[key])
+
+
+# the secret file is replaced on every write, so processes agree on a
+# sibling lock file instead; closing the descriptor releases the lock
+@contextmanager
+def secret_lock(path):
+    import fcntl
+
+    fd = os.open("{}.lock".format(path), os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
+
+
+def save_secret(context):
+    secrets = {
+        "auth_token": context.get("auth_token"),
+        "expires_at": context.get("expires_at"),
+        "catalog": context.get("catalog"),
+        "user_id": context.get("user_id"),
+        "password": context.get("password"),
+        "tenant_id": context.get("tenant_id"),
+    }
+    path = context.get("secret")
+    try:
+        if read_secrets(path) == secrets:
+            return
+    except (FileNotFoundError, ValueError):
+        pass
+    import tempfile
+
+    # readers see either the old or the new file, never a partial one
+    directory, name = os.path.split(os.path.abspath(path))
+    fd, temporary = tempfile.mkstemp(prefix=".{}.".format(name), dir=directory)
+    try:
+        with os.fdopen(fd, "w") as fp:
+            json.dump(secrets, fp, indent=2, sort_keys=True)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(temporary, path)
+    except BaseException:
+        os.unlink(temporary)
+        raise
+    SECRET_CACHE[path] = (file_version(path), secrets)
+
+
+# a token saved before the catalog was kept is renewed once a region is
+# asked for
+def needs_token(context, rejected=None):
+    return (
+        context.get("auth_token") is None
+        or context.get("auth_token") == rejected
+        or is_token_expiring(context)
+        or (
+            context.get("region") is not None
+            and context.get("catalog") is None
+        )
+    )
+
+
+# exactly one process renews a missing, expiring or rejected token; the
+# others wait on the lock and then reuse the token it saved
+def renew_token(context, generate, rejected=None):
+    path = context.get("secret")
+    if path is None:
+        return generate(context)
+    with secret_lock(path):
+        if os.path.exists(path):
+            load_secret(context)
+        if needs_token(context, rejected):
+            generate(context)
+        save_secret(context)
+
+
+def is_token_expiring(context, margin=TOKEN_REFRESH_MARGIN):
+    expires_at = context.get("expires_at")
+    if expires_at is None:
+        return False
+    expires_at = datetime.fromisoformat(expires_at)
+    return expires_at - margin <= datetime.now(timezone.utc)
+
+
+def has_credentials(context):
+    return all(
+        context.get(key) is not None
+        for key in ["user_id", "password", "tenant_id"]
+    )
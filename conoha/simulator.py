@@ -0,0 +1,90 @@
+import json
+import threading
+import time
+from http import HTTPStatus
+from http.client import HTTPMessage
+from io import BytesIO
+from urllib.error import HTTPError
+from urllib.parse import parse_qs, urlsplit
+
+from conoha.conoha import ConohaRestApi, RestApi
+from conoha.emulator import Emulator
+from conoha.retry import RetryPolicy
+from conoha.transport import Response
+
+
+class VirtualClock:
+    def __init__(self, start=None):
+        self.epoch = time.time() if start is None else start
+        self.__latest = 0.0
+        self.__local = threading.local()
+        self.__lock = threading.Lock()
+
+    def time(self):
+        return self.epoch + self.monotonic()
+
+    # every thread runs on its own timeline, starting from the furthest
+    # point reached when it first reads the clock, so concurrent waiters
+    # do not eat into each other's timeouts
+    def monotonic(self):
+        now = getattr(self.__local, "now", None)
+        if now is None:
+            now = self.__local.now = self.latest()
+        return now
+
+    def latest(self):
+        with self.__lock:
+            return self.__latest
+
+    def sleep(self, seconds):
+        self.advance(seconds)
+
+    def wait(self, event, seconds):
+        if not event.is_set():
+            self.advance(seconds)
+        return event.is_set()
+
+    def advance(self, seconds):
+        now = self.monotonic() + max(seconds, 0.0)
+        self.__local.now = now
+        with self.__lock:
+            self.__latest = max(self.__latest, now)
+
+
+class SimulatedConohaRestApi(ConohaRestApi):
+    def __init__(self, clock=None, endpoints=None, **options):
+        clock = clock or VirtualClock()
+        RestApi.__init__(self, clock, endpoints)
+        self.retry = RetryPolicy()
+        self.emulator = Emulator(
+            clock=clock.time, sleep=clock.sleep, **options
+        )
+        self.requests = 0
+
+    def send_request(self, request):
+        url = urlsplit(request.full_url)
+        query = {
+            key: values[-1] for key, values in parse_qs(url.query).items()
+        }
+        status, payload, headers = self.emulator.handle(
+            request.get_method(),
+            url.path,
+            query,
+            request.get_header("X-auth-token"),
+            request.data,
+            "{}://{}".format(url.scheme, url.netloc),
+        )
+        self.requests += 1
+        message = HTTPMessage()
+        for key, value in headers.items():
+            message[key] = value
+        body = b"" if payload is None else json.dumps(payload).encode("utf-8")
+        reason = HTTPStatus(status).phrase
+        if status >= 400:
+            raise HTTPError(
+                request.full_url, status, reason, message, BytesIO(body)
+            )
+        return Response(status, reason, message, body)
+
+    def close(self):
+        pass
@@ -0,0 +1,137 @@
+import json
+import os
+import sys
+import threading
+import time
+
+
+class Span:
+    def __init__(self, tracer, name, category, args):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.args = args
+        self.thread = threading.get_ident()
+        self.started_at = time.time()
+        self.started = time.perf_counter()
+        self.duration = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.duration = time.perf_counter() - self.started
+        if exc is not None:
+            self.args["error"] = type(exc).__name__
+            if hasattr(exc, "code"):
+                self.args["status"] = exc.code
+        self.tracer.finish(self)
+
+    def record(self):
+        return {
+            "name": self.name,
+            "cat": self.category,
+            "time": self.started_at,
+            "duration": self.duration,
+            "thread": self.thread,
+            "args": self.args,
+        }
+
+
+class Tracer:
+    def __init__(self, sinks):
+        self.sinks = sinks
+        self.origin = time.perf_counter()
+        self.__lock = threading.Lock()
+
+    def span(self, name, category, **args):
+        return Span(self, name, category, args)
+
+    def finish(self, span):
+        with self.__lock:
+            for sink in self.sinks:
+                sink.add(self, span)
+
+    def close(self):
+        with self.__lock:
+            for sink in self.sinks:
+                sink.close()
+
+
+def milliseconds(seconds):
+    return round(seconds * 1000, 3)
+
+
+class NdjsonSink:
+    def __init__(self, path):
+        self.fp = open(path, "a")
+
+    def add(self, tracer, span):
+        self.fp.write(json.dumps(span.record()) + "\n")
+
+    def close(self):
+        self.fp.close()
+
+
+class ChromeTraceSink:
+    def __init__(self, path):
+        self.path = path
+        self.events = []
+
+    def add(self, tracer, span):
+        self.events.append(
+            {
+                "name": span.name,
+                "cat": span.category,
+                "ph": "X",
+                "ts": (span.started - tracer.origin) * 1000000,
+                "dur": span.duration * 1000000,
+                "pid": os.getpid(),
+                "tid": span.thread,
+                "args": span.args,
+            }
+        )
+
+    def close(self):
+        with open(self.path, "w") as fp:
+            json.dump({"traceEvents": self.events}, fp)
+
+
+class TimingSink:
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stderr
+        self.durations = {}
+
+    def add(self, tracer, span):
+        key = (span.category, span.name)
+        self.durations.setdefault(key, []).append(span.duration)
+
+    def close(self):
+        import statistics
+
+        line = "{:<8} {:<28} {:>6} {:>10} {:>10} {:>10} {:>10}"
+        print(
+            line.format("", "", "count", "total", "p50", "p99", "max"),
+            file=self.stream,
+        )
+        for (category, name), durations in sorted(self.durations.items()):
+            if len(durations) > 1:
+                p99 = statistics.quantiles(
+                    durations, n=100, method="inclusive"
+                )[98]
+            else:
+                p99 = durations[0]
+            print(
+                line.format(
+                    category,
+                    name,
+                    len(durations),
+                    "{:.1f}ms".format(milliseconds(sum(durations))),
+                    "{:.1f}ms".format(
+                        milliseconds(statistics.median(durations))
+                    ),
+                    "{:.1f}ms".format(milliseconds(p99)),
+                    "{:.1f}ms".format(milliseconds(max(durations))),
+                ),
+                file=self.stream,
+            )
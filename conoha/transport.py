@@ -0,0 +1,234 @@
+import threading
+import time
+from io import BytesIO
+
+from conoha.trace import milliseconds
+
+# http.client, ssl and urllib.error are imported on first use so that
+# importing this module stays cheap for the CLI
+
+DEFAULT_POOL_SIZE = 4
+
+
+def body_size(body):
+    if body is None:
+        return 0
+    if isinstance(body, bytes):
+        return len(body)
+    progress = getattr(body, "progress", None)
+    return None if progress is None else progress.sent
+
+
+class Response:
+    def __init__(self, status, reason, headers, body):
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+
+    def read(self):
+        return self.body
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+# the proxy urllib would use for the host, from HTTP_PROXY, HTTPS_PROXY
+# and NO_PROXY, None to connect directly
+def find_proxy(scheme, host):
+    from urllib.parse import urlsplit
+    from urllib.request import getproxies, proxy_bypass
+
+    proxy = getproxies().get(scheme)
+    if not proxy or proxy_bypass(host):
+        return None
+    if "://" not in proxy:
+        proxy = "http://" + proxy
+    return urlsplit(proxy)
+
+
+def proxy_address(proxy):
+    return proxy.hostname, proxy.port or 80
+
+
+def proxy_headers(proxy):
+    import base64
+    from urllib.parse import unquote
+
+    if proxy.username is None:
+        return {}
+    credentials = "{}:{}".format(
+        unquote(proxy.username), unquote(proxy.password or "")
+    )
+    token = base64.b64encode(credentials.encode()).decode("ascii")
+    return {"Proxy-Authorization": "Basic {}".format(token)}
+
+
+class ConnectionPool:
+    def __init__(
+        self, pool_size=DEFAULT_POOL_SIZE, timeout=None, context=None
+    ):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.context = context
+        self.__idle = {}
+        self.__proxies = {}
+        self.__lock = threading.Lock()
+
+    # looked up once per host, the environment is not read per request
+    def proxy(self, scheme, host):
+        key = (scheme, host)
+        if key not in self.__proxies:
+            self.__proxies[key] = find_proxy(scheme, host)
+        return self.__proxies[key]
+
+    def connect(self, scheme, host, timings=None):
+        import http.client
+        import ssl
+        from urllib.parse import urlsplit
+
+        kwargs = {}
+        if self.timeout is not None:
+            kwargs["timeout"] = self.timeout
+        proxy = self.proxy(scheme, host)
+        if scheme == "https":
+            if self.context is None:
+                self.context = ssl.create_default_context()
+            if proxy is None:
+                connection = http.client.HTTPSConnection(
+                    host, context=self.context, **kwargs
+                )
+            else:
+                # TLS to the server inside a CONNECT tunnel
+                connection = http.client.HTTPSConnection(
+                    *proxy_address(proxy), context=self.context, **kwargs
+                )
+                connection.set_tunnel(host, headers=proxy_headers(proxy))
+        elif proxy is None:
+            connection = http.client.HTTPConnection(host, **kwargs)
+        else:
+            connection = http.client.HTTPConnection(
+                *proxy_address(proxy), **kwargs
+            )
+        if timings is not None:
+            # connect eagerly so that TCP and TLS setup are timed apart
+            started = time.perf_counter()
+            http.client.HTTPConnection.connect(connection)
+            connected = time.perf_counter()
+            timings["connect_ms"] = milliseconds(connected - started)
+            if scheme == "https":
+                connection.sock = self.context.wrap_socket(
+                    connection.sock,
+                    server_hostname=urlsplit("//" + host).hostname,
+                )
+                tls = time.perf_counter() - connected
+                timings["tls_ms"] = milliseconds(tls)
+        return connection
+
+    def acquire(self, scheme, host, timings=None):
+        with self.__lock:
+            idle = self.__idle.get((scheme, host))
+            if idle:
+                return idle.pop(), True
+        return self.connect(scheme, host, timings), False
+
+    def release(self, scheme, host, connection):
+        with self.__lock:
+            idle = self.__idle.setdefault((scheme, host), [])
+            if len(idle) < self.pool_size:
+                idle.append(connection)
+                return
+        connection.close()
+
+    def close(self):
+        with self.__lock:
+            idle, self.__idle = self.__idle, {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+    # a plain HTTP proxy is sent the absolute URL and its credentials
+    def target(self, request):
+        proxy = self.proxy(request.type, request.host)
+        headers = dict(request.header_items())
+        if proxy is None or request.type == "https":
+            return request.selector, headers
+        headers.update(proxy_headers(proxy))
+        return request.full_url, headers
+
+    def send_to(self, connection, request, body):
+        selector, headers = self.target(request)
+        connection.putrequest(request.get_method(), selector)
+        for name, value in headers.items():
+            connection.putheader(name, value)
+        connection.endheaders()
+        body.send_to(connection.sock)
+
+    # redirects are not followed as urllib did, the API does not send them
+    # and a 3xx is raised as an HTTPError like any other failure
+    def urlopen(self, request, timings=None):
+        import http.client
+        from urllib.error import HTTPError
+
+        stale_errors = (http.client.BadStatusLine, ConnectionError)
+        scheme, host = request.type, request.host
+        body = request.data
+        position = body.tell() if hasattr(body, "seek") else None
+        while True:
+            connection, reused = self.acquire(scheme, host, timings)
+            try:
+                started = time.perf_counter()
+                if hasattr(body, "send_to"):
+                    self.send_to(connection, request, body)
+                else:
+                    selector, headers = self.target(request)
+                    connection.request(
+                        request.get_method(),
+                        selector,
+                        body=body,
+                        headers=headers,
+                    )
+                sent = time.perf_counter()
+                response = connection.getresponse()
+                waited = time.perf_counter()
+                payload = response.read()
+            except stale_errors:
+                connection.close()
+                # only a reused keep-alive connection may have gone stale
+                if not reused:
+                    raise
+                if position is not None:
+                    body.seek(position)
+                elif body is not None and not isinstance(body, bytes):
+                    raise
+                continue
+            except BaseException:
+                connection.close()
+                raise
+            if response.will_close:
+                connection.close()
+            else:
+                self.release(scheme, host, connection)
+            break
+        if timings is not None:
+            timings["reused"] = reused
+            timings["send_ms"] = milliseconds(sent - started)
+            timings["wait_ms"] = milliseconds(waited - sent)
+            timings["receive_ms"] = milliseconds(time.perf_counter() - waited)
+            timings["status"] = response.status
+            timings["bytes_sent"] = body_size(body)
+            timings["bytes_received"] = len(payload)
+        if not 200 <= response.status < 300:
+            raise HTTPError(
+                request.full_url,
+                response.status,
+                response.reason,
+                response.msg,
+                BytesIO(payload),
+            )
+        return Response(
+            response.status, response.reason, response.msg, payload
+        )
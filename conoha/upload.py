@@ -0,0 +1,199 @@
+import os
+import sys
+import time
+
+from conoha.digest import Digester
+
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+
+DEFAULT_PROGRESS_INTERVAL = 5.0
+
+ZERO_COPY_CHUNK_SIZE = 8 * 1024 * 1024
+
+
+def open_zstd(path):
+    try:
+        from compression import zstd
+    except ImportError:
+        raise ValueError(
+            "zstd に対応していない Python です: {}".format(path)
+        ) from None
+    return zstd.open(path, "rb")
+
+
+def source_size(path):
+    if path == "-" or path.endswith((".gz", ".xz", ".zst")):
+        return None
+    return os.path.getsize(path)
+
+
+def open_source(path):
+    if path == "-":
+        return sys.stdin.buffer
+    if path.endswith(".gz"):
+        import gzip
+
+        return gzip.open(path, "rb")
+    if path.endswith(".xz"):
+        import lzma
+
+        return lzma.open(path, "rb")
+    if path.endswith(".zst"):
+        return open_zstd(path)
+    return open(path, "rb", buffering=0)
+
+
+def format_bytes(size):
+    for unit in ["B", "KiB", "MiB", "GiB"]:
+        if size < 1024:
+            return "{:.1f} {}".format(size, unit)
+        size /= 1024
+    return "{:.1f} TiB".format(size)
+
+
+class Progress:
+    def __init__(
+        self,
+        total=None,
+        interval=DEFAULT_PROGRESS_INTERVAL,
+        clock=time.monotonic,
+        stream=None,
+    ):
+        self.total = total
+        self.interval = interval
+        self.clock = clock
+        self.stream = stream or sys.stderr
+        self.sent = 0
+        self.read_seconds = 0.0
+        self.started = None
+        self.reported = None
+
+    def start(self):
+        self.started = self.reported = self.clock()
+
+    def update(self, size, read_seconds):
+        self.sent += size
+        self.read_seconds += read_seconds
+        now = self.clock()
+        if self.interval is not None and now - self.reported >= self.interval:
+            self.reported = now
+            self.report(now)
+
+    def rate(self, now):
+        elapsed = now - self.started
+        return self.sent / elapsed if elapsed > 0 else 0.0
+
+    def report(self, now):
+        rate = self.rate(now)
+        line = "{} sent {}/s".format(
+            format_bytes(self.sent), format_bytes(rate)
+        )
+        if self.total is not None and rate > 0:
+            line += " {:.0f}% ETA {:.0f}s".format(
+                self.sent * 100 / self.total, (self.total - self.sent) / rate
+            )
+        print(line, file=self.stream, flush=True)
+
+    def summary(self):
+        now = self.clock()
+        elapsed = now - self.started
+        line = (
+            "uploaded {} in {:.1f}s ({}/s, source read {:.1f}s, send {:.1f}s)"
+        )
+        print(
+            line.format(
+                format_bytes(self.sent),
+                elapsed,
+                format_bytes(self.rate(now)),
+                self.read_seconds,
+                elapsed - self.read_seconds,
+            ),
+            file=self.stream,
+            flush=True,
+        )
+
+
+class UploadSource:
+    def __init__(
+        self,
+        path,
+        chunk_size=DEFAULT_CHUNK_SIZE,
+        digester=None,
+        progress=None,
+        clock=time.monotonic,
+    ):
+        self.path = path
+        self.size = source_size(path)
+        self.chunk_size = chunk_size
+        self.digester = digester or Digester()
+        self.progress = progress or Progress(self.size)
+        self.progress.total = self.size
+        self.clock = clock
+        # stdin is consumed by the first attempt and cannot be sent again
+        self.replayable = path != "-"
+        self.fp = open_source(path)
+
+    def __iter__(self):
+        self.progress.start()
+        while True:
+            started = self.clock()
+            chunk = self.fp.read(self.chunk_size)
+            if not chunk:
+                return
+            self.digester.update(chunk)
+            self.progress.update(len(chunk), self.clock() - started)
+            yield chunk
+
+    def close(self):
+        if self.fp is not sys.stdin.buffer:
+            self.fp.close()
+
+
+class ZeroCopySource:
+    def __init__(self, path, chunk_size=ZERO_COPY_CHUNK_SIZE, progress=None):
+        self.path = path
+        self.size = os.path.getsize(path)
+        self.chunk_size = chunk_size
+        self.digester = None
+        self.progress = progress or Progress(self.size)
+        self.progress.total = self.size
+        self.replayable = True
+        self.fp = open(path, "rb", buffering=0)
+
+    def send_to(self, sock):
+        import ssl
+
+        self.progress.start()
+        if self.size == 0:
+            return
+        if isinstance(sock, ssl.SSLSocket):
+            self.send_mapped(sock)
+        else:
+            offset = 0
+            while offset < self.size:
+                count = min(self.chunk_size, self.size - offset)
+                offset += sock.sendfile(self.fp, offset, count)
+                self.progress.update(count, 0.0)
+
+    def send_mapped(self, sock):
+        import mmap
+
+        # the ssl module has no SSL_sendfile binding, so TLS falls back to
+        # large writes straight out of the page cache
+        with mmap.mmap(self.fp.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            with memoryview(data) as view:
+                for offset in range(0, self.size, self.chunk_size):
+                    end = offset + self.chunk_size
+                    chunk = view[offset:end]
+                    sock.sendall(chunk)
+                    self.progress.update(len(chunk), 0.0)
+                    chunk.release()
+
+    def __iter__(self):
+        self.progress.start()
+        while chunk := self.fp.read(self.chunk_size):
+            self.progress.update(len(chunk), 0.0)
+            yield chunk
+
+    def close(self):
+        self.fp.close()
@@ -0,0 +1,125 @@
+import random
+import threading
+import time
+from collections import deque
+
+DEFAULT_TIMEOUT = 600
+
+
+class WaitCancelledError(Exception):
+    pass
+
+
+class SystemClock:
+    def time(self):
+        return time.time()
+
+    def monotonic(self):
+        return time.monotonic()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def wait(self, event, seconds):
+        return event.wait(seconds)
+
+
+class Backoff:
+    def __init__(
+        self, initial=2.0, factor=1.5, maximum=15.0, jitter=0.2, rand=None
+    ):
+        self.initial = initial
+        self.factor = factor
+        self.maximum = maximum
+        self.jitter = jitter
+        self.rand = rand or random.random
+
+    def delays(self, first=None):
+        delay = self.initial
+        if first is not None:
+            yield first
+        while True:
+            yield delay * (1 - self.jitter * self.rand())
+            delay = min(delay * self.factor, self.maximum)
+
+
+class TransitionHistory:
+    def __init__(self, size=20, ratio=0.9):
+        self.size = size
+        self.ratio = ratio
+        self.__durations = {}
+        self.__lock = threading.Lock()
+
+    def record(self, status, duration):
+        with self.__lock:
+            durations = self.__durations.setdefault(
+                status, deque(maxlen=self.size)
+            )
+            durations.append(duration)
+
+    def first_delay(self, status):
+        import statistics
+
+        with self.__lock:
+            durations = list(self.__durations.get(status, []))
+        if not durations:
+            return None
+        return statistics.median(durations) * self.ratio
+
+
+class Waiter:
+    def __init__(
+        self,
+        status,
+        clock=None,
+        timeout=DEFAULT_TIMEOUT,
+        backoff=None,
+        history=None,
+        cancelled=None,
+    ):
+        self.status = status
+        self.clock = clock or SystemClock()
+        self.timeout = timeout
+        self.backoff = backoff or Backoff()
+        self.history = history
+        self.cancelled = cancelled
+        self.started = None
+
+    def delays(self):
+        self.started = self.clock.monotonic()
+        first = None
+        if self.history is not None:
+            first = self.history.first_delay(self.status)
+        for delay in self.backoff.delays(first):
+            if self.timeout is not None:
+                elapsed = self.clock.monotonic() - self.started
+                remaining = self.timeout - elapsed
+                if remaining <= 0:
+                    raise TimeoutError(
+                        "timed out waiting for {} after {:.1f}s".format(
+                            self.status, elapsed
+                        )
+                    )
+                delay = min(delay, remaining)
+            yield delay
+
+    def done(self):
+        elapsed = self.clock.monotonic() - self.started
+        if self.history is not None:
+            self.history.record(self.status, elapsed)
+        return elapsed
+
+    # a set cancel event wakes the sleep at once instead of after the delay
+    def sleep(self, delay):
+        if self.cancelled is None:
+            self.clock.sleep(delay)
+        elif self.clock.wait(self.cancelled, delay):
+            raise WaitCancelledError(
+                "wait for {} cancelled".format(self.status)
+            )
+
+    def wait(self, poll):
+        for delay in self.delays():
+            self.sleep(delay)
+            if poll():
+                return self.done()
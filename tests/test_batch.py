@@ -0,0 +1,107 @@
+import argparse
+import json
+
+from conoha.__main__ import execute
+from conoha.batch import BatchExecutor
+from conoha.command import Context, LoadToken
+from conoha.simulator import SimulatedConohaRestApi
+
+
+def run(api, *records):
+    context = Context(
+        argparse.Namespace(user_id="u", password="p", tenant_id="t")
+    )
+    LoadToken().execute(api, context)
+    lines = [
+        record if isinstance(record, str) else json.dumps(record)
+        for record in records
+    ]
+    results = list(BatchExecutor(api).execute(context, lines))
+    return sorted(results, key=lambda result: result["line"])
+
+
+def test_listings_are_returned_as_results(capsys):
+    api = SimulatedConohaRestApi(servers=2, seed=0)
+    api.emulator.new_image({"name": "a.iso"})
+    ids, detail, images = run(
+        api,
+        {"op": "server.list"},
+        {"op": "server.list", "detail": True},
+        {"op": "image.list"},
+    )
+    assert capsys.readouterr().out == ""
+    assert ids["ok"] and detail["ok"] and images["ok"]
+    assert ids["result"] == sorted(
+        api.emulator.servers, key=lambda id: api.emulator.servers[id].name
+    )
+    assert [server["name"] for server in detail["result"]] == [
+        "vps-0001",
+        "vps-0002",
+    ]
+    assert [server["id"] for server in detail["result"]] == ids["result"]
+    assert [image["name"] for image in images["result"]] == ["a.iso"]
+
+
+def test_server_operations_report_their_result():
+    api = SimulatedConohaRestApi(servers=1, seed=0, transition_delay=5.0)
+    server_id = next(iter(api.emulator.servers))
+    stop, status = run(
+        api,
+        {"op": "server.stop", "server_id": server_id, "id": "a"},
+        {"op": "server.status", "server_id": server_id},
+    )
+    assert stop == {
+        "line": 1,
+        "id": "a",
+        "op": "server.stop",
+        "server_id": server_id,
+        "ok": True,
+    }
+    assert status["result"] == "SHUTOFF"
+
+
+def test_bad_lines_fail_alone():
+    api = SimulatedConohaRestApi(servers=1, seed=0)
+    bad, unknown, missing, good = run(
+        api,
+        "{not json",
+        {"op": "server.reboot"},
+        {"op": "server.status", "server_id": "missing"},
+        {"op": "server.list"},
+    )
+    assert not bad["ok"]
+    assert unknown == {
+        "line": 2,
+        "ok": False,
+        "error": "unknown op: server.reboot",
+    }
+    assert not missing["ok"] and "404" in missing["error"]
+    assert good["ok"]
+
+
+def test_pretend_lists_return_empty_results(tmp_path, capsys):
+    secret = tmp_path / "secret.json"
+    secret.write_text(
+        json.dumps(
+            {
+                "auth_token": None,
+                "expires_at": None,
+                "user_id": "u",
+                "password": "p",
+                "tenant_id": "t",
+            }
+        )
+    )
+    batch = tmp_path / "batch.ndjson"
+    batch.write_text(
+        '{"op": "server.list", "detail": true}\n{"op": "image.list"}\n'
+    )
+    argv = ["--pretend", "1", "batch", "run", "--secret", str(secret)]
+    assert execute(argv + [str(batch)], environ={}) == 0
+    results = [
+        json.loads(line) for line in capsys.readouterr().out.splitlines()
+    ]
+    assert sorted(results, key=lambda result: result["line"]) == [
+        {"line": 1, "op": "server.list", "ok": True, "result": []},
+        {"line": 2, "op": "image.list", "ok": True, "result": []},
+    ]
@@ -0,0 +1,179 @@
+import queue
+import signal
+import threading
+
+import pytest
+
+from conoha.command import Command, Context, GraphCommand
+from conoha.wait import Backoff, WaitCancelledError, Waiter
+
+
+class Step(Command):
+    def __init__(self, name, reads, writes, log, action=None):
+        self.name = name
+        self.reads = reads
+        self.writes = writes
+        self.log = log
+        self.action = action
+
+    def execute(self, receiver, context):
+        self.log.append(("start", self.name))
+        if self.action is not None:
+            self.action(context)
+        for key in self.writes or ():
+            context.set(key, self.name)
+        self.log.append(("end", self.name))
+
+
+def graph(*steps):
+    command = GraphCommand()
+    for step in steps:
+        command.append(step)
+    return command
+
+
+def test_dependent_commands_run_in_order():
+    log = []
+    seen = {}
+    command = graph(
+        Step("token", (), ("auth_token",), log),
+        Step(
+            "list",
+            ("auth_token",),
+            ("servers",),
+            log,
+            lambda context: seen.update(token=context.get("auth_token")),
+        ),
+    )
+    context = Context(None)
+    command.execute(None, context)
+    assert log == [
+        ("start", "token"),
+        ("end", "token"),
+        ("start", "list"),
+        ("end", "list"),
+    ]
+    assert seen == {"token": "token"}
+    assert context.get("servers") == "list"
+
+
+def test_independent_commands_run_side_by_side():
+    barrier = threading.Barrier(2, timeout=5)
+    log = []
+    command = graph(
+        Step("images", (), ("images",), log, lambda _: barrier.wait()),
+        Step("servers", (), ("servers",), log, lambda _: barrier.wait()),
+    )
+    context = Context(None)
+    command.execute(None, context)
+    assert context.get("images") == "images"
+    assert context.get("servers") == "servers"
+
+
+def test_unknown_keys_order_after_everything():
+    log = []
+    command = graph(
+        Step("first", (), ("a",), log),
+        Step("unknown", None, None, log),
+        Step("last", (), ("b",), log),
+    )
+    command.execute(None, Context(None))
+    assert [name for event, name in log if event == "start"] == [
+        "first",
+        "unknown",
+        "last",
+    ]
+
+
+def test_the_first_error_is_raised_and_dependents_never_start():
+    def fail(message):
+        def action(context):
+            raise RuntimeError(message)
+
+        return action
+
+    log = []
+    command = graph(
+        Step("token", (), ("auth_token",), log, fail("token")),
+        Step("images", (), ("images",), log, fail("images")),
+        Step("list", ("auth_token",), ("servers",), log),
+    )
+    with pytest.raises(RuntimeError, match="^token$"):
+        command.execute(None, Context(None))
+    assert ("start", "list") not in log
+
+
+def test_a_chain_runs_on_the_calling_thread():
+    threads = []
+    command = graph(
+        Step(
+            "token",
+            (),
+            ("auth_token",),
+            [],
+            lambda _: threads.append(threading.current_thread()),
+        ),
+        Step(
+            "list",
+            ("auth_token",),
+            ("servers",),
+            [],
+            lambda _: threads.append(threading.current_thread()),
+        ),
+    )
+    command.execute(None, Context(None))
+    assert threads == [threading.current_thread()] * 2
+
+
+def test_an_interrupt_cancels_the_waiters_and_the_queued_commands():
+    started = threading.Semaphore(0)
+    cancelled = threading.Event()
+    results = queue.Queue()
+
+    def wait(context):
+        waiter = Waiter(
+            "ACTIVE",
+            backoff=Backoff(initial=60.0),
+            cancelled=context.get("cancelled"),
+        )
+        started.release()
+        try:
+            waiter.wait(lambda: False)
+        except WaitCancelledError as error:
+            results.put(error)
+            raise
+
+    # a signal landing just before the main thread blocks is not seen
+    # until the next one, so it is sent until the graph reacts
+    def interrupt():
+        started.acquire(timeout=5)
+        started.acquire(timeout=5)
+        while not cancelled.wait(0.05):
+            signal.pthread_kill(threading.main_thread().ident, signal.SIGINT)
+
+    interrupted = []
+
+    def handler(signum, frame):
+        if not interrupted:
+            interrupted.append(signum)
+            raise KeyboardInterrupt
+
+    log = []
+    command = GraphCommand(max_workers=2)
+    command.append(Step("a", (), ("a",), log, wait))
+    command.append(Step("b", (), ("b",), log, wait))
+    command.append(Step("queued", (), ("c",), log))
+    context = Context(None)
+    context.set("cancelled", cancelled)
+    previous = signal.signal(signal.SIGINT, handler)
+    try:
+        threading.Thread(target=interrupt).start()
+        with pytest.raises(KeyboardInterrupt):
+            command.execute(None, context)
+        assert cancelled.is_set()
+    finally:
+        cancelled.set()
+        signal.signal(signal.SIGINT, previous)
+    errors = [results.get(timeout=5), results.get(timeout=5)]
+    assert all(isinstance(error, WaitCancelledError) for error in errors)
+    assert ("start", "queued") not in log
@@ -0,0 +1,94 @@
+import queue
+import signal
+import threading
+
+import pytest
+
+from conoha.command import Command, Context
+from conoha.executor import ServerExecutor
+from conoha.wait import Backoff, WaitCancelledError, Waiter
+
+
+class Recorder(Command):
+    def __init__(self, action=None):
+        self.action = action
+        self.threads = []
+        self.servers = []
+
+    def execute(self, receiver, context):
+        self.threads.append(threading.current_thread())
+        self.servers.append(context.get("server_id"))
+        if self.action is not None:
+            self.action(context)
+
+
+def test_a_single_server_runs_on_the_calling_thread():
+    def fail(context):
+        raise RuntimeError("stopped")
+
+    command = Recorder(fail)
+    results = list(ServerExecutor(None).execute(command, Context(None), ["a"]))
+    assert command.threads == [threading.current_thread()]
+    [(worker_context, error)] = results
+    assert worker_context.get("server_id") == "a"
+    assert str(error) == "stopped"
+
+
+def test_servers_run_side_by_side():
+    barrier = threading.Barrier(2, timeout=5)
+    command = Recorder(lambda _: barrier.wait())
+    executor = ServerExecutor(None, concurrency=2)
+    results = list(executor.execute(command, Context(None), ["a", "b"]))
+    assert sorted(command.servers) == ["a", "b"]
+    assert [error for _, error in results] == [None, None]
+
+
+def test_an_interrupt_cancels_the_waiters_and_the_queued_servers():
+    started = threading.Semaphore(0)
+    cancelled = threading.Event()
+    errors = queue.Queue()
+
+    def wait(context):
+        waiter = Waiter(
+            "ACTIVE",
+            backoff=Backoff(initial=60.0),
+            cancelled=context.get("cancelled"),
+        )
+        started.release()
+        try:
+            waiter.wait(lambda: False)
+        except WaitCancelledError as error:
+            errors.put(error)
+            raise
+
+    # a signal landing just before the main thread blocks is not seen
+    # until the next one, so it is sent until the executor reacts
+    def interrupt():
+        started.acquire(timeout=5)
+        started.acquire(timeout=5)
+        while not cancelled.wait(0.05):
+            signal.pthread_kill(threading.main_thread().ident, signal.SIGINT)
+
+    interrupted = []
+
+    def handler(signum, frame):
+        if not interrupted:
+            interrupted.append(signum)
+            raise KeyboardInterrupt
+
+    command = Recorder(wait)
+    executor = ServerExecutor(None, concurrency=2)
+    context = Context(None)
+    context.set("cancelled", cancelled)
+    previous = signal.signal(signal.SIGINT, handler)
+    try:
+        threading.Thread(target=interrupt).start()
+        with pytest.raises(KeyboardInterrupt):
+            list(executor.execute(command, context, ["a", "b", "c"]))
+        assert cancelled.is_set()
+    finally:
+        cancelled.set()
+        signal.signal(signal.SIGINT, previous)
+    for _ in range(2):
+        assert isinstance(errors.get(timeout=5), WaitCancelledError)
+    assert "c" not in command.servers
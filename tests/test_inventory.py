@@ -0,0 +1,107 @@
+import argparse
+
+from conoha.command import Context, DeleteImage, ListImage, LoadToken
+from conoha.inventory import FULL_SYNC_INTERVAL, Inventory
+from conoha.output import discarding
+from conoha.simulator import SimulatedConohaRestApi
+
+
+def login(api, inventory):
+    context = Context(
+        argparse.Namespace(user_id="u", password="p", tenant_id="t")
+    )
+    LoadToken().execute(api, context)
+    context.set("inventory", inventory)
+    return context
+
+
+def new_images(api, *names):
+    image_ids = []
+    for name in names:
+        api.clock.advance(10.0)
+        image_ids.append(api.emulator.new_image({"name": name})["id"])
+    return image_ids
+
+
+def test_cached_images_keep_the_api_order(tmp_path):
+    api = SimulatedConohaRestApi(servers=1, seed=0)
+    inventory = Inventory(str(tmp_path / "inventory"))
+    context = login(api, inventory)
+    new_images(api, "a.iso", "b.iso", "c.iso")
+    api.sync_images(context, inventory)
+    with discarding():
+        ListImage().execute(api, context)
+    listed = [image["id"] for image in context.get("images")]
+    assert [image["id"] for image in inventory.images()] == listed
+    assert [image["name"] for image in inventory.images()] == [
+        "c.iso",
+        "b.iso",
+        "a.iso",
+    ]
+
+
+def test_a_sync_drops_images_deleted_elsewhere(tmp_path):
+    api = SimulatedConohaRestApi(servers=1, seed=0)
+    inventory = Inventory(str(tmp_path / "inventory"))
+    context = login(api, inventory)
+    kept, deleted = new_images(api, "kept.iso", "deleted.iso")
+    api.sync_images(context, inventory)
+    api.emulator.remove_image(deleted)
+    api.sync_images(context, inventory)
+    assert [image["id"] for image in inventory.images()] == [kept]
+
+
+def test_deleting_an_image_drops_its_row(tmp_path):
+    api = SimulatedConohaRestApi(servers=1, seed=0)
+    inventory = Inventory(str(tmp_path / "inventory"))
+    context = login(api, inventory)
+    kept, deleted = new_images(api, "kept.iso", "deleted.iso")
+    api.sync_images(context, inventory)
+    context.set("image_id", deleted)
+    DeleteImage().execute(api, context)
+    assert deleted not in api.emulator.images
+    assert [image["id"] for image in inventory.images()] == [kept]
+
+
+def server(server_id, name, status="ACTIVE"):
+    return {
+        "id": server_id,
+        "name": name,
+        "status": status,
+        "addresses": ["10.0.0.1"],
+        "flavor": "g-1gb",
+    }
+
+
+def test_incremental_server_syncs_apply_changes(tmp_path):
+    now = [1000.0]
+    inventory = Inventory(str(tmp_path / "inventory"), clock=lambda: now[0])
+    assert inventory.since("servers") is None
+    inventory.update_servers(
+        [server("1", "web"), server("2", "db")], "t0", full=True
+    )
+    inventory.update_servers(
+        [server("1", "web", "SHUTOFF"), server("2", "db", "DELETED")],
+        "t1",
+        full=False,
+    )
+    assert [(row["id"], row["status"]) for row in inventory.servers()] == [
+        ("1", "SHUTOFF")
+    ]
+    assert inventory.since("servers") == "t1"
+    assert inventory.resolve_server("web") == "1"
+    assert inventory.resolve_server("unknown") == "unknown"
+    now[0] += FULL_SYNC_INTERVAL + 1
+    # a full listing is due again once a day
+    assert inventory.since("servers") is None
+
+
+def test_freshness_follows_the_max_age(tmp_path):
+    now = [1000.0]
+    inventory = Inventory(str(tmp_path / "inventory"), clock=lambda: now[0])
+    assert not inventory.is_fresh("images", 60)
+    inventory.update_images([])
+    now[0] += 60
+    assert inventory.is_fresh("images", 60)
+    now[0] += 1
+    assert not inventory.is_fresh("images", 60)
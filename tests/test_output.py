@@ -0,0 +1,125 @@
+import argparse
+import io
+import json
+
+import pytest
+
+from conoha.command import Context, ListImage, ListServer, LoadToken
+from conoha.output import OUTPUT_FORMATS, discarding, emit, writing
+from conoha.simulator import SimulatedConohaRestApi
+
+RECORDS = [
+    {"id": "a", "status": "ACTIVE", "addresses": ["10.0.0.1", "10.0.0.2"]},
+    {"id": "bb", "status": "SHUTOFF", "addresses": []},
+]
+
+
+def render(output, records=RECORDS, fields=None):
+    stream = io.StringIO()
+    with writing(output, fields, stream):
+        for record in records:
+            emit(record)
+    return stream.getvalue()
+
+
+def test_text():
+    assert render("text").splitlines() == [
+        "id: a status: ACTIVE addresses: 10.0.0.1,10.0.0.2",
+        "id: bb status: SHUTOFF addresses: ",
+    ]
+
+
+def test_json_is_one_array():
+    assert json.loads(render("json")) == RECORDS
+
+
+@pytest.mark.parametrize("output", ["json", "table", "csv", "ndjson"])
+def test_no_records(output):
+    expected = "[]\n" if output == "json" else ""
+    assert render(output, []) == expected
+
+
+def test_ndjson_is_a_record_a_line():
+    lines = render("ndjson").splitlines()
+    assert [json.loads(line) for line in lines] == RECORDS
+
+
+def test_csv():
+    assert render("csv") == (
+        "id,status,addresses\n"
+        'a,ACTIVE,"10.0.0.1,10.0.0.2"\n'
+        "bb,SHUTOFF,\n"
+    )
+
+
+def test_table_aligns_the_columns():
+    assert render("table").splitlines() == [
+        "ID  STATUS   ADDRESSES",
+        "a   ACTIVE   10.0.0.1,10.0.0.2",
+        "bb  SHUTOFF",
+    ]
+
+
+def test_fields_pick_and_order_the_columns():
+    records = [
+        json.loads(line)
+        for line in render("ndjson", fields=["status", "id"]).splitlines()
+    ]
+    assert [list(record) for record in records] == [["status", "id"]] * 2
+    assert render("csv", fields=["status", "id"]).splitlines()[0] == (
+        "status,id"
+    )
+
+
+@pytest.mark.parametrize("output", OUTPUT_FORMATS)
+def test_missing_fields_are_empty(output):
+    assert "10.0.0.1" not in render(output, fields=["id", "name"])
+
+
+def test_discarded_records_are_not_written():
+    stream = io.StringIO()
+    with writing("ndjson", stream=stream):
+        with discarding():
+            emit({"id": "hidden"})
+        emit({"id": "shown"})
+    assert stream.getvalue() == '{"id": "shown"}\n'
+
+
+def simulated_context(api):
+    context = Context(
+        argparse.Namespace(user_id="u", password="p", tenant_id="t")
+    )
+    LoadToken().execute(api, context)
+    return context
+
+
+def test_the_api_returns_records_and_the_commands_write_them(capsys):
+    api = SimulatedConohaRestApi(servers=3, seed=0)
+    context = simulated_context(api)
+    records = list(api.list_server_detail(context))
+    assert capsys.readouterr().out == ""
+    assert [record["name"] for record in records] == [
+        "vps-0001",
+        "vps-0002",
+        "vps-0003",
+    ]
+    assert context.get("server_ids") == [record["id"] for record in records]
+    stream = io.StringIO()
+    with writing("ndjson", stream=stream):
+        ListServer().execute(api, context)
+    lines = stream.getvalue().splitlines()
+    assert [json.loads(line) for line in lines] == [
+        {"id": server_id} for server_id in context.get("server_ids")
+    ]
+
+
+def test_image_listings_are_kept_in_the_context():
+    api = SimulatedConohaRestApi(servers=1, seed=0)
+    context = simulated_context(api)
+    api.emulator.new_image({"name": "a.iso"})
+    stream = io.StringIO()
+    with writing("ndjson", stream=stream):
+        ListImage().execute(api, context)
+    images = context.get("images")
+    assert [image["name"] for image in images] == ["a.iso"]
+    assert json.loads(stream.getvalue()) == images[0]
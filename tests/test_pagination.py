@@ -0,0 +1,96 @@
+import argparse
+import asyncio
+import threading
+
+import pytest
+
+from conoha.command import Context, LoadToken
+from conoha.pagination import apaginate, paginate
+from conoha.simulator import SimulatedConohaRestApi
+
+PAGES = {None: ([1, 2], "a"), "a": ([3, 4], "b"), "b": ([5], None)}
+
+
+def pages(fetched, requested=None):
+    def fetch_page(marker):
+        fetched.append(marker)
+        if requested is not None:
+            requested[marker].set()
+        return PAGES[marker]
+
+    return fetch_page
+
+
+@pytest.mark.parametrize("prefetch", [False, True])
+def test_paginate_follows_the_markers(prefetch):
+    fetched = []
+    items = list(paginate(pages(fetched), prefetch=prefetch))
+    assert items == [1, 2, 3, 4, 5]
+    assert fetched == [None, "a", "b"]
+
+
+def test_paginate_fetches_the_next_page_while_one_is_consumed():
+    requested = {marker: threading.Event() for marker in PAGES}
+    items = paginate(pages([], requested), prefetch=True)
+    assert next(items) == 1
+    assert requested["a"].wait(timeout=5)
+    assert not requested["b"].is_set()
+    assert list(items) == [2, 3, 4, 5]
+
+
+def test_paginate_without_prefetch_fetches_on_demand():
+    fetched = []
+    items = paginate(pages(fetched))
+    assert next(items) == 1
+    assert fetched == [None]
+
+
+def apages(fetched):
+    async def fetch_page(marker):
+        fetched.append(marker)
+        await asyncio.sleep(0)
+        return PAGES[marker]
+
+    return fetch_page
+
+
+@pytest.mark.parametrize("prefetch", [False, True])
+def test_apaginate_follows_the_markers(prefetch):
+    fetched = []
+
+    async def collect():
+        pages = apaginate(apages(fetched), prefetch=prefetch)
+        return [item async for item in pages]
+
+    assert asyncio.run(collect()) == [1, 2, 3, 4, 5]
+    assert fetched == [None, "a", "b"]
+
+
+def test_apaginate_starts_the_next_page_before_yielding():
+    fetched = []
+
+    async def first():
+        pages = apaginate(apages(fetched), prefetch=True)
+        item = await pages.__anext__()
+        await asyncio.sleep(0)
+        await pages.aclose()
+        return item
+
+    assert asyncio.run(first()) == 1
+    assert fetched == [None, "a"]
+
+
+@pytest.mark.parametrize("prefetch", [False, True])
+def test_servers_are_listed_page_by_page(prefetch):
+    api = SimulatedConohaRestApi(servers=23, seed=0)
+    context = Context(
+        argparse.Namespace(user_id="u", password="p", tenant_id="t")
+    )
+    LoadToken().execute(api, context)
+    context.set("page_size", 5)
+    context.set("prefetch", prefetch)
+    requests = api.requests
+    servers = list(api.iter_servers(context, detail=True))
+    names = [server["name"] for server in servers]
+    assert names == ["vps-{:04d}".format(index + 1) for index in range(23)]
+    assert api.requests - requests == 5
@@ -0,0 +1,145 @@
+import json
+
+import pytest
+
+from conoha.__main__ import execute
+from conoha.emulator import Emulator, start_emulator
+from conoha.profile import load_profiles, select_profiles
+
+
+def write_profiles(path, profiles):
+    path.write_text(json.dumps(profiles))
+    return str(path)
+
+
+def test_secrets_are_relative_to_the_profiles_file(tmp_path, monkeypatch):
+    monkeypatch.setenv("HOME", str(tmp_path / "home"))
+    path = write_profiles(
+        tmp_path / "profiles.json",
+        {
+            "work": {"secret": "work.json", "region": "tyo2"},
+            "home": {"secret": "~/home.json"},
+        },
+    )
+    assert load_profiles(path) == {
+        "work": {"secret": str(tmp_path / "work.json"), "region": "tyo2"},
+        "home": {"secret": str(tmp_path / "home" / "home.json")},
+    }
+
+
+@pytest.mark.parametrize(
+    "profiles, message",
+    [
+        ([], "profiles must be a JSON object"),
+        ({"work": {"secret": "a", "user": "u"}}, "work: unknown keys: user"),
+        ({"work": {"region": "c3j1"}}, "work: secret is required"),
+    ],
+)
+def test_invalid_profiles_are_rejected(tmp_path, profiles, message):
+    path = write_profiles(tmp_path / "profiles.json", profiles)
+    with pytest.raises(ValueError, match="^{}$".format(message)):
+        load_profiles(path)
+
+
+def test_profiles_are_selected_in_the_given_order():
+    profiles = {"a": {"secret": "a"}, "b": {"secret": "b"}}
+    assert [name for name, _ in select_profiles(profiles)] == ["a", "b"]
+    assert [name for name, _ in select_profiles(profiles, ["b", "a"])] == [
+        "b",
+        "a",
+    ]
+    with pytest.raises(ValueError, match="^unknown profiles: c, d$"):
+        select_profiles(profiles, ["a", "c", "d"])
+
+
+@pytest.fixture
+def accounts(tmp_path):
+    servers = {
+        name: start_emulator(Emulator(servers=2, seed=seed))
+        for seed, name in enumerate(["work", "home"])
+    }
+    profiles = {}
+    for name, server in servers.items():
+        secret = tmp_path / "{}.json".format(name)
+        secret.write_text(
+            json.dumps(
+                {
+                    "auth_token": None,
+                    "expires_at": None,
+                    "user_id": name,
+                    "password": "p",
+                    "tenant_id": name,
+                }
+            )
+        )
+        profiles[name] = {"secret": secret.name, "identity_url": server.url}
+    path = write_profiles(tmp_path / "profiles.json", profiles)
+    yield path, servers
+    for server in servers.values():
+        server.shutdown()
+        server.server_close()
+
+
+def run(capsys, *argv):
+    status = execute(["--output", "ndjson"] + list(argv), environ={})
+    out, err = capsys.readouterr()
+    return status, [json.loads(line) for line in out.splitlines()], err
+
+
+def test_every_profile_is_listed_with_its_own_account(accounts, capsys):
+    path, servers = accounts
+    status, records, _ = run(
+        capsys, "--profiles-file", path, "server", "list", "--all-profiles"
+    )
+    assert status == 0
+    for name, server in servers.items():
+        assert sorted(
+            record["id"] for record in records if record["profile"] == name
+        ) == sorted(server.emulator.servers)
+    # the profiles are printed in the order of the file
+    assert [record["profile"] for record in records] == ["work"] * 2 + [
+        "home"
+    ] * 2
+
+
+def test_only_the_named_profiles_are_listed(accounts, capsys):
+    path, servers = accounts
+    status, records, _ = run(
+        capsys, "--profiles-file", path, "server", "list", "--profiles", "home"
+    )
+    assert status == 0
+    assert {record["profile"] for record in records} == {"home"}
+
+
+def test_an_unknown_profile_fails_before_any_request(accounts, capsys):
+    path, servers = accounts
+    status, records, err = run(
+        capsys,
+        "--profiles-file",
+        path,
+        "server",
+        "list",
+        "--profiles",
+        "work,office",
+    )
+    assert (status, records) == (1, [])
+    assert err == "profiles: unknown profiles: office\n"
+
+
+def test_a_failing_profile_does_not_stop_the_others(accounts, capsys):
+    path, servers = accounts
+    servers["work"].shutdown()
+    servers["work"].server_close()
+    status, records, err = run(
+        capsys,
+        "--profiles-file",
+        path,
+        "--retries",
+        "0",
+        "server",
+        "list",
+        "--all-profiles",
+    )
+    assert status == 1
+    assert {record["profile"] for record in records} == {"home"}
+    assert [line.partition(": ")[0] for line in err.splitlines()] == ["work"]
@@ -0,0 +1,116 @@
+import io
+from urllib.error import HTTPError
+
+import pytest
+
+from conoha.ratelimit import (
+    MINIMUM_RATE,
+    RateLimiter,
+    TokenBucket,
+    parse_limit,
+)
+from conoha.simulator import VirtualClock
+
+
+def test_a_full_bucket_allows_a_burst_then_queues():
+    bucket = TokenBucket(2.0, burst=5)
+    assert [bucket.reserve(0.0) for _ in range(7)] == [0.0] * 5 + [0.5, 1.0]
+
+
+def test_the_bucket_refills_at_the_rate_up_to_the_burst():
+    bucket = TokenBucket(2.0, burst=3)
+    for _ in range(3):
+        assert bucket.take(10.0)
+    assert not bucket.take(10.0)
+    assert not bucket.take(10.4)
+    assert bucket.take(10.5)
+    # a long idle spell refills no more than the burst
+    assert [bucket.take(100.0) for _ in range(4)] == [True] * 3 + [False]
+
+
+def test_the_burst_defaults_to_one_second_of_requests():
+    assert TokenBucket(4.0).burst == 4.0
+    assert TokenBucket(0.5).burst == 1.0
+
+
+def test_a_throttle_halves_the_rate_once_per_cooldown():
+    bucket = TokenBucket(4.0)
+    assert bucket.throttle(0.0) == 2.0
+    assert bucket.tokens == 0.0
+    # the other requests in flight answer 429 together
+    assert bucket.throttle(0.5) is None
+    assert bucket.throttle(1.0) == 1.0
+    for _ in range(100):
+        bucket.recover()
+    assert bucket.rate == 4.0
+
+
+def test_the_rate_never_drops_below_the_minimum():
+    bucket = TokenBucket(0.1)
+    assert bucket.throttle(0.0) == MINIMUM_RATE
+
+
+def test_requests_are_spaced_out_on_the_clock():
+    clock = VirtualClock()
+    limiter = RateLimiter([("compute", 5.0, 1)])
+    sent = []
+
+    def send(request):
+        sent.append((request, clock.monotonic()))
+        return request
+
+    for index in range(4):
+        assert limiter.call("compute", index, send, clock) == index
+    assert [request for request, _ in sent] == [0, 1, 2, 3]
+    assert [at for _, at in sent] == pytest.approx([0.0, 0.2, 0.4, 0.6])
+    # services without a limit are not held back
+    limiter.call("image", "image", send, clock)
+    assert sent[-1] == ("image", pytest.approx(0.6))
+
+
+def test_the_default_limit_applies_to_every_other_service():
+    limiter = RateLimiter(
+        [("*", 10.0, None), ("image", 1.0, 2.0)], stream=io.StringIO()
+    )
+    rates = {
+        service: (bucket.rate, bucket.burst)
+        for service, bucket in limiter.buckets.items()
+    }
+    assert rates == {
+        "identity": (10.0, 10.0),
+        "compute": (10.0, 10.0),
+        "image": (1.0, 2.0),
+    }
+
+
+def test_a_429_lowers_the_rate():
+    clock = VirtualClock()
+    stream = io.StringIO()
+    limiter = RateLimiter([("compute", 4.0, None)], stream=stream)
+
+    def throttled(request):
+        raise HTTPError(request, 429, "Too Many Requests", {}, None)
+
+    with pytest.raises(HTTPError):
+        limiter.call("compute", "url", throttled, clock)
+    assert limiter.buckets["compute"].rate == 2.0
+    assert stream.getvalue() == (
+        "429 from compute: rate limit lowered to 2.00/s\n"
+    )
+
+
+@pytest.mark.parametrize(
+    "value, expected",
+    [
+        ("compute=5", ("compute", 5.0, None)),
+        ("*=0.5:3", ("*", 0.5, 3.0)),
+    ],
+)
+def test_parse_limit(value, expected):
+    assert parse_limit(value) == expected
+
+
+@pytest.mark.parametrize("value", ["network=1", "compute=0", "image=1:0.5"])
+def test_parse_limit_rejects_bad_settings(value):
+    with pytest.raises(ValueError):
+        parse_limit(value)
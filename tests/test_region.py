@@ -0,0 +1,93 @@
+import json
+
+import pytest
+
+from conoha.__main__ import execute
+from conoha.conoha import UnknownRegionError, catalog_endpoints
+from conoha.emulator import Emulator, start_emulator
+
+
+@pytest.fixture
+def emulator():
+    server = start_emulator(Emulator(servers=2, seed=0, regions=["tyo2"]))
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def run(emulator, capsys, *argv):
+    options = ["--identity-url", emulator.url, "--output", "ndjson"]
+    credentials = ["--user-id", "u", "--password", "p", "--tenant-id", "t"]
+    status = execute(options + list(argv) + credentials, environ={})
+    out, err = capsys.readouterr()
+    return status, [json.loads(line) for line in out.splitlines()], err
+
+
+def ids(emulator):
+    return sorted(emulator.servers)
+
+
+def test_the_catalog_picks_the_region(emulator, capsys):
+    status, records, _ = run(
+        emulator, capsys, "--region", "tyo2", "server", "list"
+    )
+    assert status == 0
+    regional = emulator.emulator.regions["tyo2"]
+    assert sorted(record["id"] for record in records) == ids(regional)
+
+
+def test_without_a_region_the_default_is_used(emulator, capsys):
+    status, records, _ = run(emulator, capsys, "server", "list")
+    assert status == 0
+    assert sorted(record["id"] for record in records) == ids(emulator.emulator)
+
+
+@pytest.mark.parametrize(
+    "argv",
+    [
+        ["--region", "osa1", "server", "list"],
+        ["server", "list", "--regions", "tyo2", "osa1"],
+    ],
+)
+def test_an_unknown_region_lists_the_known_ones(emulator, capsys, argv):
+    with pytest.raises(SystemExit) as raised:
+        run(emulator, capsys, *argv)
+    assert raised.value.code == 2
+    err = capsys.readouterr().err
+    assert (
+        "不明なリージョンです: osa1 (指定できるリージョン: c3j1, tyo2)" in err
+    )
+    assert "Traceback" not in err
+
+
+def test_all_regions_are_listed_side_by_side(emulator, capsys):
+    status, records, _ = run(
+        emulator, capsys, "server", "list", "--all-regions"
+    )
+    assert status == 0
+    regions = {"c3j1": emulator.emulator}
+    regions.update(emulator.emulator.regions)
+    assert sorted({record["region"] for record in records}) == sorted(regions)
+    for name, region in regions.items():
+        assert sorted(
+            record["id"] for record in records if record["region"] == name
+        ) == ids(region)
+
+
+def test_catalog_endpoints_reject_an_unknown_region():
+    catalog = [
+        {
+            "type": "compute",
+            "endpoints": [
+                {
+                    "interface": "public",
+                    "region": "tyo2",
+                    "url": "https://compute.tyo2/v2.1/t",
+                }
+            ],
+        }
+    ]
+    assert catalog_endpoints(catalog) == {"compute": "https://compute.tyo2"}
+    with pytest.raises(UnknownRegionError) as raised:
+        catalog_endpoints(catalog, "c3j1")
+    assert raised.value.regions == ["tyo2"]
@@ -0,0 +1,123 @@
+import io
+from email.message import Message
+from urllib.error import HTTPError
+from urllib.request import Request
+
+import pytest
+
+from conoha.retry import CircuitBreaker, CircuitOpenError, RetryPolicy
+from conoha.simulator import VirtualClock
+
+
+def http_error(code, retry_after=None):
+    headers = Message()
+    if retry_after is not None:
+        headers["Retry-After"] = str(retry_after)
+    return HTTPError("http://api/", code, "error", headers, io.BytesIO())
+
+
+def sender(*outcomes):
+    outcomes = list(outcomes)
+    sent = []
+
+    def send(request):
+        sent.append(request)
+        outcome = outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    return send, sent
+
+
+def policy(**options):
+    return RetryPolicy(rand=lambda: 1, stream=io.StringIO(), **options)
+
+
+def test_transient_errors_are_retried_with_backoff():
+    clock = VirtualClock()
+    send, sent = sender(http_error(503), http_error(502), "ok")
+    retry = policy(backoff=0.5)
+    assert retry.call(Request("http://api/servers"), send, clock) == "ok"
+    assert len(sent) == 3
+    assert retry.retried == 2
+    assert clock.monotonic() == 0.5 + 1.0
+
+
+def test_retry_after_is_honoured():
+    clock = VirtualClock()
+    send, _ = sender(http_error(503, retry_after=7), "ok")
+    policy().call(Request("http://api/servers"), send, clock)
+    assert clock.monotonic() == 7.0
+
+
+def test_errors_past_the_budget_are_raised():
+    clock = VirtualClock()
+    send, sent = sender(*[http_error(500)] * 3)
+    with pytest.raises(HTTPError):
+        policy(retries=2).call(Request("http://api/servers"), send, clock)
+    assert len(sent) == 3
+
+
+def test_server_actions_are_not_retried():
+    clock = VirtualClock()
+    request = Request("http://api/servers/1/action", data=b"{}")
+    send, sent = sender(http_error(503), "ok")
+    with pytest.raises(HTTPError):
+        policy().call(request, send, clock)
+    assert len(sent) == 1
+    send, sent = sender(http_error(503), "ok")
+    assert policy(retry_actions=True).call(request, send, clock) == "ok"
+
+
+def test_client_errors_are_final_and_keep_the_circuit_closed():
+    clock = VirtualClock()
+    retry = policy(breaker_threshold=1)
+    send, sent = sender(http_error(404), "ok")
+    with pytest.raises(HTTPError):
+        retry.call(Request("http://api/servers"), send, clock)
+    assert len(sent) == 1
+    assert retry.breaker("api", clock).allow()
+
+
+def test_throttling_does_not_open_the_circuit():
+    clock = VirtualClock()
+    retry = policy(breaker_threshold=1)
+    send, sent = sender(http_error(429, retry_after=1), "ok")
+    assert retry.call(Request("http://api/servers"), send, clock) == "ok"
+    assert retry.breaker("api", clock).opened is None
+
+
+def test_an_open_circuit_is_waited_out_within_the_budget():
+    clock = VirtualClock()
+    retry = policy(breaker_threshold=2, breaker_reset=5.0, backoff=0.5)
+    send, sent = sender(http_error(503), http_error(503), "ok")
+    assert retry.call(Request("http://api/servers"), send, clock) == "ok"
+    assert len(sent) == 3
+    assert clock.monotonic() >= 0.5 + 5.0
+
+
+def test_an_open_circuit_past_the_budget_fails_fast():
+    clock = VirtualClock()
+    retry = policy(breaker_threshold=1, breaker_reset=60.0, max_delay=10.0)
+    send, sent = sender(http_error(503), "ok")
+    with pytest.raises(CircuitOpenError):
+        retry.call(Request("http://api/servers"), send, clock)
+    assert len(sent) == 1
+
+
+def test_a_half_open_circuit_lets_one_trial_through():
+    clock = VirtualClock()
+    breaker = CircuitBreaker(clock, threshold=1, reset=10.0)
+    breaker.failure()
+    assert not breaker.allow()
+    assert breaker.remaining() == 10.0
+    clock.sleep(10.0)
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.failure()
+    assert not breaker.allow()
+    clock.sleep(10.0)
+    assert breaker.allow()
+    breaker.success()
+    assert breaker.allow() and breaker.allow()
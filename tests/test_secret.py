@@ -0,0 +1,100 @@
+import json
+import os
+import threading
+import time
+
+import pytest
+
+from conoha.command import Context
+from conoha.secret import load_secret, renew_token, save_secret
+
+CREDENTIALS = {"user_id": "u", "password": "p", "tenant_id": "t"}
+
+
+def write_secret(path, **values):
+    secrets = {"auth_token": None, "expires_at": None, **CREDENTIALS}
+    secrets.update(values)
+    path.write_text(json.dumps(secrets))
+    return str(path)
+
+
+def secret_context(path):
+    context = Context(None)
+    context.set("secret", path)
+    return context
+
+
+def test_one_process_renews_and_the_others_reuse_its_token(tmp_path):
+    path = write_secret(tmp_path / "secret.json")
+    generated = []
+
+    def generate(context):
+        generated.append(context)
+        time.sleep(0.05)
+        context.set("auth_token", "token-{}".format(len(generated)))
+
+    tokens = []
+
+    def worker():
+        context = secret_context(path)
+        load_secret(context)
+        renew_token(context, generate)
+        tokens.append(context.get("auth_token"))
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(generated) == 1
+    assert tokens == ["token-1"] * 8
+    with open(path) as fp:
+        assert json.load(fp)["auth_token"] == "token-1"
+
+
+def test_a_rejected_token_is_renewed(tmp_path):
+    path = write_secret(tmp_path / "secret.json", auth_token="stale")
+    context = secret_context(path)
+    load_secret(context)
+    renew_token(context, lambda context: context.set("auth_token", "fresh"))
+    assert context.get("auth_token") == "stale"
+    renew_token(
+        context,
+        lambda context: context.set("auth_token", "fresh"),
+        rejected="stale",
+    )
+    assert context.get("auth_token") == "fresh"
+
+
+def test_save_replaces_the_file_and_leaves_no_temporary(tmp_path):
+    path = write_secret(tmp_path / "secret.json")
+    context = secret_context(path)
+    load_secret(context)
+    context.set("auth_token", "saved")
+    save_secret(context)
+    assert sorted(os.listdir(tmp_path)) == ["secret.json"]
+    with open(path) as fp:
+        assert json.load(fp)["auth_token"] == "saved"
+
+
+def test_an_unchanged_secret_is_not_rewritten(tmp_path):
+    path = write_secret(tmp_path / "secret.json")
+    context = secret_context(path)
+    load_secret(context)
+    save_secret(context)
+    version = os.stat(path).st_mtime_ns
+    time.sleep(0.01)
+    save_secret(context)
+    assert os.stat(path).st_mtime_ns == version
+
+
+def test_a_failed_save_keeps_the_old_file(tmp_path):
+    path = write_secret(tmp_path / "secret.json", auth_token="old")
+    context = secret_context(path)
+    load_secret(context)
+    context.set("auth_token", object())
+    with pytest.raises(TypeError):
+        save_secret(context)
+    assert sorted(os.listdir(tmp_path)) == ["secret.json"]
+    with open(path) as fp:
+        assert json.load(fp)["auth_token"] == "old"
@@ -0,0 +1,101 @@
+import argparse
+import threading
+from urllib.error import HTTPError
+
+import pytest
+
+from conoha.command import (
+    CompositeCommand,
+    Context,
+    ListServer,
+    LoadToken,
+    MountImage,
+    StopServerAndWait,
+    UnmountImage,
+    WaitServerStatus,
+)
+from conoha.executor import ServerExecutor
+from conoha.simulator import SimulatedConohaRestApi, VirtualClock
+
+
+def test_virtual_clock_keeps_a_timeline_per_thread():
+    clock = VirtualClock(start=1000.0)
+    clock.sleep(5.0)
+    seen = []
+
+    def worker():
+        seen.append(clock.monotonic())
+        clock.sleep(2.0)
+        seen.append(clock.monotonic())
+
+    thread = threading.Thread(target=worker)
+    thread.start()
+    thread.join()
+    # a new thread starts from the furthest point and sleeps on its own
+    assert seen == [5.0, 7.0]
+    assert clock.monotonic() == 5.0
+    assert clock.latest() == 7.0
+    assert clock.time() == 1005.0
+
+
+def test_virtual_clock_stands_still_until_the_thread_sleeps():
+    clock = VirtualClock()
+    started = threading.Event()
+    moved = threading.Event()
+    seen = []
+
+    def worker():
+        seen.append(clock.monotonic())
+        started.set()
+        moved.wait(timeout=5)
+        seen.append(clock.monotonic())
+
+    thread = threading.Thread(target=worker)
+    thread.start()
+    started.wait(timeout=5)
+    clock.sleep(100.0)
+    moved.set()
+    thread.join()
+    assert seen == [0.0, 0.0]
+
+
+def login(api):
+    context = Context(
+        argparse.Namespace(user_id="u", password="p", tenant_id="t")
+    )
+    LoadToken().execute(api, context)
+    return context
+
+
+def test_mount_chain_runs_over_a_fleet():
+    api = SimulatedConohaRestApi(servers=200, seed=0, transition_delay=20.0)
+    context = login(api)
+    context.set("page_size", 50)
+    context.set("image_id", "rescue-image")
+    ListServer().execute(api, context)
+    server_ids = context.get("server_ids")
+    command = CompositeCommand()
+    command.append(StopServerAndWait())
+    command.append(MountImage())
+    command.append(WaitServerStatus("RESCUE"))
+    executor = ServerExecutor(api, concurrency=8)
+    errors = [
+        error
+        for _, error in executor.execute(command, context, server_ids)
+        if error is not None
+    ]
+    assert len(server_ids) == 200
+    assert errors == []
+    statuses = {server.status for server in api.emulator.servers.values()}
+    assert statuses == {"RESCUE"}
+    # 25 servers a worker, each waiting out two 20s transitions
+    assert api.clock.latest() >= 25 * 40.0
+
+
+def test_unmount_requires_a_rescued_server():
+    api = SimulatedConohaRestApi(servers=1, seed=0)
+    context = login(api)
+    context.set("server_id", next(iter(api.emulator.servers)))
+    with pytest.raises(HTTPError) as raised:
+        UnmountImage().execute(api, context)
+    assert raised.value.code == 409
@@ -0,0 +1,236 @@
+import base64
+import http.client
+import json
+import os
+import select
+import socket
+import ssl
+import subprocess
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+from urllib.request import Request
+
+import pytest
+
+from conoha.emulator import Emulator, start_emulator
+from conoha.transport import ConnectionPool
+
+
+@pytest.fixture(autouse=True)
+def no_proxy(monkeypatch):
+    for name in list(os.environ):
+        if name.lower().endswith("_proxy"):
+            monkeypatch.delenv(name)
+
+
+def token_request(url):
+    return Request(
+        url + "/v3/auth/tokens",
+        data=json.dumps({"auth": {}}).encode("utf-8"),
+        headers={"Content-Type": "application/json"},
+        method="POST",
+    )
+
+
+@pytest.fixture
+def emulator():
+    server = start_emulator(Emulator(servers=1, seed=0))
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_a_keep_alive_connection_is_reused(emulator):
+    pool = ConnectionPool()
+    timings = [{}, {}]
+    for request_timings in timings:
+        response = pool.urlopen(token_request(emulator.url), request_timings)
+        assert response.status == 201
+    assert [request_timings["reused"] for request_timings in timings] == [
+        False,
+        True,
+    ]
+    pool.close()
+
+
+def test_a_stale_keep_alive_connection_is_replaced(emulator):
+    pool = ConnectionPool()
+    pool.urlopen(token_request(emulator.url))
+    host = urlsplit(emulator.url).netloc
+    connection, reused = pool.acquire("http", host)
+    assert reused
+    # the server dropping the idle connection looks the same to the client
+    connection.sock.shutdown(socket.SHUT_RDWR)
+    pool.release("http", host, connection)
+    timings = {}
+    response = pool.urlopen(token_request(emulator.url), timings)
+    assert response.status == 201
+    assert timings["reused"] is False
+    pool.close()
+
+
+def test_a_fresh_connection_that_fails_is_not_retried():
+    with socket.socket() as listener:
+        listener.bind(("127.0.0.1", 0))
+        host, port = listener.getsockname()
+    pool = ConnectionPool()
+    with pytest.raises(ConnectionRefusedError):
+        pool.urlopen(token_request("http://{}:{}".format(host, port)))
+
+
+def test_idle_connections_are_kept_up_to_the_pool_size(emulator):
+    pool = ConnectionPool(pool_size=1)
+    host = urlsplit(emulator.url).netloc
+    connections = [pool.acquire("http", host)[0] for _ in range(2)]
+    for connection in connections:
+        connection.request("GET", "/")
+        connection.getresponse().read()
+        pool.release("http", host, connection)
+    # the second one did not fit and was closed
+    assert connections[1].sock is None
+    assert pool.acquire("http", host) == (connections[0], True)
+    connection, reused = pool.acquire("http", host)
+    assert connection not in connections and not reused
+    pool.close()
+
+
+def relay(client, upstream):
+    sockets = [client, upstream]
+    while True:
+        readable, _, _ = select.select(sockets, [], [], 5)
+        if not readable:
+            return
+        for sock in readable:
+            data = sock.recv(65536)
+            if not data:
+                return
+            (upstream if sock is client else client).sendall(data)
+
+
+class ProxyHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def record(self):
+        self.server.seen.append(
+            (
+                self.command,
+                self.path,
+                self.headers.get("Proxy-Authorization"),
+            )
+        )
+
+    def do_CONNECT(self):
+        self.record()
+        host, port = self.path.rsplit(":", 1)
+        with socket.create_connection((host, int(port))) as upstream:
+            self.send_response(200)
+            self.end_headers()
+            relay(self.connection, upstream)
+        self.close_connection = True
+
+    def do_POST(self):
+        self.record()
+        url = urlsplit(self.path)
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        headers = {
+            name: value
+            for name, value in self.headers.items()
+            if name.lower() != "proxy-authorization"
+        }
+        connection = http.client.HTTPConnection(url.netloc)
+        connection.request("POST", url.path, body, headers)
+        response = connection.getresponse()
+        payload = response.read()
+        connection.close()
+        self.send_response(response.status)
+        for name, value in response.getheaders():
+            if name.lower() not in ("server", "date", "connection"):
+                self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+@pytest.fixture
+def proxy():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), ProxyHandler)
+    server.daemon_threads = True
+    server.seen = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def proxy_url(proxy):
+    host, port = proxy.server_address[:2]
+    return "http://user:pa%40ss@{}:{}".format(host, port)
+
+
+BASIC = "Basic {}".format(base64.b64encode(b"user:pa@ss").decode("ascii"))
+
+
+def test_a_plain_request_goes_to_the_proxy(emulator, proxy, monkeypatch):
+    monkeypatch.setenv("http_proxy", proxy_url(proxy))
+    pool = ConnectionPool()
+    for _ in range(2):
+        assert pool.urlopen(token_request(emulator.url)).status == 201
+    url = emulator.url + "/v3/auth/tokens"
+    assert proxy.seen == [("POST", url, BASIC)] * 2
+    pool.close()
+
+
+@pytest.fixture
+def tls(tmp_path):
+    certfile, keyfile = tmp_path / "cert.pem", tmp_path / "key.pem"
+    try:
+        subprocess.run(
+            [
+                "openssl",
+                "req",
+                "-x509",
+                "-newkey",
+                "rsa:2048",
+                "-nodes",
+                "-days",
+                "1",
+                "-subj",
+                "/CN=127.0.0.1",
+                "-addext",
+                "subjectAltName=IP:127.0.0.1",
+                "-keyout",
+                str(keyfile),
+                "-out",
+                str(certfile),
+            ],
+            check=True,
+            capture_output=True,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        pytest.skip("openssl cannot make a test certificate")
+    server_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    server_context.load_cert_chain(certfile, keyfile)
+    server = start_emulator(
+        Emulator(servers=1, seed=0), context=server_context
+    )
+    yield server, ssl.create_default_context(cafile=str(certfile))
+    server.shutdown()
+    server.server_close()
+
+
+def test_tls_is_tunnelled_through_the_proxy(tls, proxy, monkeypatch):
+    emulator, context = tls
+    monkeypatch.setenv("https_proxy", proxy_url(proxy))
+    pool = ConnectionPool(context=context)
+    timings = [{}, {}]
+    for request_timings in timings:
+        response = pool.urlopen(token_request(emulator.url), request_timings)
+        assert response.status == 201
+    # one tunnel carries both requests
+    host = urlsplit(emulator.url).netloc
+    assert proxy.seen == [("CONNECT", host, BASIC)]
+    assert timings[1]["reused"]
+    pool.close()
@@ -0,0 +1,42 @@
+import argparse
+import asyncio
+
+import pytest
+
+from conoha.aio import AsyncConohaRestApi
+from conoha.command import Context, LoadToken
+from conoha.conoha import FakeConohaRestApi
+from conoha.simulator import SimulatedConohaRestApi
+
+
+def upload_context(api, tmp_path):
+    context = Context(
+        argparse.Namespace(user_id="u", password="p", tenant_id="t")
+    )
+    LoadToken().execute(api, context)
+    context.set("image_id", "image")
+    context.set("iso_file", str(tmp_path / "missing.iso"))
+    return context
+
+
+@pytest.mark.parametrize(
+    "api",
+    [FakeConohaRestApi(), SimulatedConohaRestApi(servers=1, seed=0)],
+    ids=["fake", "rest"],
+)
+def test_a_missing_file_fails_before_there_is_a_source(api, tmp_path):
+    context = upload_context(api, tmp_path)
+    with pytest.raises(FileNotFoundError):
+        api.upload_image(context)
+    assert context.get("upload_source") is None
+
+
+def test_a_missing_file_fails_before_there_is_a_source_async(tmp_path):
+    api = AsyncConohaRestApi()
+    context = Context(None)
+    context.set("auth_token", "token")
+    context.set("image_id", "image")
+    context.set("iso_file", str(tmp_path / "missing.iso"))
+    with pytest.raises(FileNotFoundError):
+        asyncio.run(api.upload_image(context))
+    assert context.get("upload_source") is None
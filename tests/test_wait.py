@@ -0,0 +1,163 @@
+import argparse
+import io
+import json
+from itertools import islice
+
+import pytest
+
+from conoha.__main__ import create_parser, wait_server
+from conoha.command import Context, LoadToken, StopServerAndWait
+from conoha.output import writing
+from conoha.simulator import SimulatedConohaRestApi, VirtualClock
+from conoha.wait import Backoff, TransitionHistory, Waiter
+
+
+def test_backoff_grows_to_the_maximum():
+    backoff = Backoff(initial=2.0, factor=1.5, maximum=5.0, rand=lambda: 0)
+    assert list(islice(backoff.delays(), 5)) == [2.0, 3.0, 4.5, 5.0, 5.0]
+
+
+def test_backoff_jitter_shortens_delays():
+    backoff = Backoff(initial=2.0, factor=2.0, jitter=0.25, rand=lambda: 1)
+    assert list(islice(backoff.delays(), 3)) == [1.5, 3.0, 6.0]
+
+
+def test_backoff_starts_with_the_first_delay():
+    backoff = Backoff(initial=2.0, rand=lambda: 0)
+    assert list(islice(backoff.delays(first=7.0), 2)) == [7.0, 2.0]
+
+
+def test_history_first_delay_is_a_fraction_of_the_median():
+    history = TransitionHistory(ratio=0.5)
+    assert history.first_delay("SHUTOFF") is None
+    for duration in [4.0, 10.0, 6.0]:
+        history.record("SHUTOFF", duration)
+    assert history.first_delay("SHUTOFF") == 3.0
+    assert history.first_delay("ACTIVE") is None
+
+
+def test_waiter_clips_the_last_delay_and_times_out():
+    clock = VirtualClock()
+    backoff = Backoff(initial=4.0, factor=1.0, rand=lambda: 0)
+    waiter = Waiter("SHUTOFF", clock=clock, timeout=10, backoff=backoff)
+    delays = []
+    with pytest.raises(TimeoutError):
+        for delay in waiter.delays():
+            delays.append(delay)
+            clock.sleep(delay)
+    assert delays == [4.0, 4.0, 2.0]
+    assert clock.monotonic() == 10.0
+
+
+def test_waiter_records_the_elapsed_time():
+    clock = VirtualClock()
+    history = TransitionHistory(ratio=1.0)
+    backoff = Backoff(initial=1.0, factor=2.0, rand=lambda: 0)
+    waiter = Waiter("SHUTOFF", clock=clock, backoff=backoff, history=history)
+    polls = iter([False, False, True])
+    assert waiter.wait(lambda: next(polls)) == 7.0
+    assert history.first_delay("SHUTOFF") == 7.0
+
+
+def simulated_api(**options):
+    api = SimulatedConohaRestApi(seed=0, **options)
+    methods = []
+    send_request = api.send_request
+
+    def recording(request):
+        methods.append((request.get_method(), request.selector))
+        return send_request(request)
+
+    api.send_request = recording
+    context = Context(
+        argparse.Namespace(user_id="u", password="p", tenant_id="t")
+    )
+    LoadToken().execute(api, context)
+    server_id = sorted(api.emulator.servers)[0]
+    context.set("server_id", server_id)
+    return api, context, methods
+
+
+def test_stop_server_and_wait_submits_the_action_once():
+    api, context, methods = simulated_api(servers=1, transition_delay=30.0)
+    StopServerAndWait().execute(api, context)
+    assert context.get("server_status") == "SHUTOFF"
+    actions = [method for method in methods if method[0] == "POST"]
+    assert actions[1:] == [
+        ("POST", "/v2.1/servers/{}/action".format(context.get("server_id")))
+    ]
+    assert 30.0 <= api.clock.latest() < 60.0
+
+
+def test_stop_server_and_wait_gives_up_at_the_timeout():
+    api, context, _ = simulated_api(servers=1, transition_delay=300.0)
+    context.set("timeout", 60)
+    with pytest.raises(TimeoutError):
+        StopServerAndWait().execute(api, context)
+    assert api.clock.latest() == pytest.approx(60.0)
+
+
+def fleet():
+    api = SimulatedConohaRestApi(servers=3, seed=0, transition_delay=30.0)
+    stopped, failed, stuck = sorted(
+        api.emulator.servers, key=lambda id: api.emulator.servers[id].name
+    )
+    api.emulator.act(stopped, "os-stop")
+    api.emulator.servers[failed].status = "ERROR"
+    # stuck stays ACTIVE and never reaches SHUTOFF
+    return api, stopped, failed, stuck
+
+
+def test_wait_servers_yields_the_finished_servers():
+    api, stopped, failed, stuck = fleet()
+    context = Context(
+        argparse.Namespace(user_id="u", password="p", tenant_id="t")
+    )
+    LoadToken().execute(api, context)
+    context.set("timeout", 120)
+    transitions = list(
+        api.wait_servers(context, [stopped, failed, stuck], "SHUTOFF")
+    )
+    assert [(id, status) for id, status, _ in transitions] == [
+        (failed, "ERROR"),
+        (stopped, "SHUTOFF"),
+    ]
+    elapsed = dict((id, seconds) for id, _, seconds in transitions)
+    assert elapsed[failed] == 0.0
+    assert 30.0 <= elapsed[stopped] < 120.0
+    # the stuck server is waited for until the timeout
+    assert api.clock.latest() >= 120.0
+
+
+def test_server_wait_reports_errors_and_timeouts(capsys):
+    api, stopped, failed, stuck = fleet()
+    argv = [
+        "server",
+        "wait",
+        "--user-id",
+        "u",
+        "--password",
+        "p",
+        "--tenant-id",
+        "t",
+        "--status",
+        "SHUTOFF",
+        "--timeout",
+        "120",
+        "--server-id",
+        stopped,
+        failed,
+        stuck,
+    ]
+    args = create_parser(argv, {}).parse_args(argv)
+    stream = io.StringIO()
+    with writing("ndjson", stream=stream):
+        status = wait_server(api, args)
+    assert status == 2
+    records = [json.loads(line) for line in stream.getvalue().splitlines()]
+    assert [(record["id"], record["status"]) for record in records] == [
+        (stopped, "SHUTOFF")
+    ]
+    errors = capsys.readouterr().err.splitlines()
+    assert "{}: server is in ERROR state".format(failed) in errors
+    assert "{}: timed out waiting for SHUTOFF".format(stuck) in errors